@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of a project
+# Created by the Natural History Museum in London, UK
+
+import csv
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from ckan import model
+from ckan.plugins import toolkit
+from flask import current_app
+
+from ckanext.tiledmap.lib.query_store import get_query_store
+from ckanext.tiledmap.routes._helpers import MapViewSettings
+
+# the columns in the profile report, in order
+REPORT_COLUMNS = [
+    'view_id',
+    'resource_id',
+    'total',
+    'base_map_info',
+    'query_body',
+    'extent',
+    'templates',
+    'query_body_size',
+    'geom_count',
+    'error',
+]
+# the columns the report can be sorted by, largest first
+SORT_COLUMNS = [
+    'total',
+    'base_map_info',
+    'query_body',
+    'extent',
+    'templates',
+    'query_body_size',
+    'geom_count',
+]
+
+
+def get_commands():
+    return [tiledmap]
+
+
+@click.group()
+def tiledmap():
+    """
+    Versioned tiledmap CLI commands.
+    """
+    pass
+
+
+def get_view_ids():
+    """
+    Returns the ids of all the versioned_tiledmap resource views on this instance.
+
+    :returns: a list of resource view ids
+    """
+    query = model.Session.query(model.ResourceView.id).filter(
+        model.ResourceView.view_type == 'versioned_tiledmap'
+    )
+    return [view_id for (view_id,) in query]
+
+
+def profile_view(view_id):
+    """
+    Creates the map info for the given view with the default query and returns a row
+    of the profile report for it. Creating the map info warms any server side caches
+    used by /map-info. The records are read whatever the view's dataset's visibility,
+    so views of private datasets are profiled too. If the map info can't be created
+    the error is recorded in the row.
+
+    :param view_id: the resource view id
+    :returns: a dict of report column names to values
+    """
+    row = {'view_id': view_id}
+    try:
+        context = {'ignore_auth': True}
+        view = toolkit.get_action('resource_view_show')(context, {'id': view_id})
+        resource = toolkit.get_action('resource_show')(
+            context, {'id': view['resource_id']}
+        )
+        row['resource_id'] = resource['id']
+        view_settings = MapViewSettings(0, view, resource, context=context)
+        if not view_settings.is_enabled():
+            row['error'] = 'no map styles enabled'
+            return row
+        start = time.perf_counter()
+        map_info = view_settings.create_map_info()
+        row['total'] = time.perf_counter() - start
+        row.update(view_settings.timings)
+        row['query_body_size'] = view_settings.query_body_size
+        row['geom_count'] = map_info['geom_count']
+    except Exception as e:
+        row['error'] = str(e) or e.__class__.__name__
+    return row
+
+
+@tiledmap.command()
+@click.option(
+    '-p',
+    '--parallel',
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help='The number of views to profile at once.',
+)
+@click.option(
+    '-s',
+    '--sort',
+    type=click.Choice(SORT_COLUMNS),
+    default='total',
+    show_default=True,
+    help='The column to sort the report by, largest first.',
+)
+@click.option(
+    '--csv',
+    'as_csv',
+    is_flag=True,
+    default=False,
+    help='Write the report as CSV instead of a table.',
+)
+def profile(parallel, sort, as_csv):
+    """
+    Creates the map info for every versioned_tiledmap view with the default query and
+    reports how long each stage took, the size of the encoded query body and the
+    number of records with geometric data. This also warms any server side caches.
+    """
+    view_ids = get_view_ids()
+    click.echo(f'Profiling {len(view_ids)} views', err=True)
+
+    # the map info is created in worker threads which each need their own request
+    # context to render the templates in
+    app = current_app._get_current_object()
+
+    def run(view_id):
+        with app.test_request_context():
+            try:
+                return profile_view(view_id)
+            finally:
+                # each thread has its own database session
+                model.Session.remove()
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        rows = list(executor.map(run, view_ids))
+
+    # views which failed have no values and go to the bottom
+    rows.sort(key=lambda row: row.get(sort) or 0, reverse=True)
+
+    if as_csv:
+        writer = csv.DictWriter(sys.stdout, REPORT_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        click.echo(format_report(rows))
+
+
+@tiledmap.command('evict-queries')
+@click.option(
+    '--max-age',
+    type=click.IntRange(min=1),
+    default=30,
+    show_default=True,
+    help='The number of days since a query was last used after which it is deleted.',
+)
+def evict_queries(max_age):
+    """
+    Deletes the queries in the query store which haven't been used by a map for
+    max-age days. The query store never deletes queries itself so this should be run
+    regularly (e.g. daily by cron) when the versioned_tilemap.query_store option is
+    set.
+    """
+    query_store = get_query_store()
+    if query_store is None:
+        raise click.UsageError('The query store is not enabled')
+    evicted = query_store.evict(max_age * 24 * 60 * 60)
+    click.echo(f'Deleted {evicted} queries')
+
+
+def format_report(rows):
+    """
+    Formats the given report rows as an aligned table. Timings are shown in
+    milliseconds.
+
+    :param rows: the report rows
+    :returns: the table as a string
+    """
+    timing_columns = {'total', 'base_map_info', 'query_body', 'extent', 'templates'}
+
+    def format_value(column, value):
+        if value is None:
+            return ''
+        if column in timing_columns:
+            return f'{value * 1000:.1f}'
+        return str(value)
+
+    table = [
+        [
+            f'{column} (ms)' if column in timing_columns else column
+            for column in REPORT_COLUMNS
+        ]
+    ]
+    for row in rows:
+        table.append(
+            [format_value(column, row.get(column)) for column in REPORT_COLUMNS]
+        )
+    widths = [max(len(line[i]) for line in table) for i in range(len(REPORT_COLUMNS))]
+    return '\n'.join(
+        '  '.join(value.ljust(width) for value, width in zip(line, widths)).rstrip()
+        for line in table
+    )
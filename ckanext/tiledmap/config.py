@@ -11,6 +11,12 @@ config = {
     'versioned_tilemap.tile_layer.url': 'https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png',
     'versioned_tilemap.tile_layer.attribution': 'Base tiles provided by OpenStreetMap. <a href="openstreetmap.org/copyright">View copyright information</a>',
     'versioned_tilemap.tile_layer.opacity': 0.8,
+    # the size in pixels of the tiles requested from the tile server, either 256 or 512. Larger
+    # tiles mean fewer requests per viewport
+    'versioned_tilemap.tile_size': 256,
+    # when using 512 pixel tiles, display them at 256 pixels on high-DPI screens to get sharper
+    # tiles with the same number of requests as the standard 256 pixel tiles
+    'versioned_tilemap.detect_retina': False,
     # max/min zoom constraints
     'versioned_tilemap.zoom_bounds.min': 3,
     'versioned_tilemap.zoom_bounds.max': 18,
@@ -24,6 +30,9 @@ config = {
     'versioned_tilemap.style.plot.border_width': 1,
     'versioned_tilemap.style.plot.border_colour': '#ffffff',
     'versioned_tilemap.style.plot.grid_resolution': 4,
+    # the maximum estimated number of records per tile the plot map will be used for, if there
+    # are more than this then the map falls back to the grid map or heatmap until zoomed in further
+    'versioned_tilemap.style.plot.max_tile_count': 100000,
     # the default style parameters for the grid map
     'versioned_tilemap.style.gridded.grid_resolution': 8,
     'versioned_tilemap.style.gridded.cold_colour': '#f4f11a',
@@ -37,4 +46,56 @@ config = {
     # templates used for hover and click information on the map
     'versioned_tilemap.info_template': 'point_detail',
     'versioned_tilemap.quick_info_template': 'point_detail_hover',
+    # the number of map-info responses the browser keeps so that returning to a previously seen
+    # set of filters doesn't require another request, and the number of milliseconds to wait after
+    # a filter change before requesting new map-info
+    'versioned_tilemap.info_cache.size': 20,
+    'versioned_tilemap.info_cache.debounce': 300,
+    # when enabled, the map view requests the map-info for the filters on a filter link (e.g. a
+    # facet) on the page when the user hovers over it for delay milliseconds. These requests are
+    # low priority and fill the server's caches so that clicking the link redraws the map quickly
+    'versioned_tilemap.prefetch.enabled': False,
+    'versioned_tilemap.prefetch.delay': 150,
+    # profiling of map-info requests. When enabled, sysadmins can profile a request by setting the
+    # X-Tiledmap-Profile header and a fraction of all requests can be sampled. Profiles are written
+    # to the directory in the path option
+    'versioned_tilemap.profiling.enabled': False,
+    'versioned_tilemap.profiling.sample_rate': 0,
+    # admission control for the requests which query the datastore. When enabled, at most
+    # max_concurrent of these requests are processed at once by each CKAN process, the rest wait up
+    # to queue_timeout seconds with requests from the map view going first. Each client can make
+    # up to burst requests at once and then rate requests per second, 0 disables the rate limit.
+    # Behind a reverse proxy, set client_header to the header the proxy puts the client's address
+    # in (e.g. X-Forwarded-For) so that anonymous users aren't all limited as the proxy's address
+    'versioned_tilemap.admission.enabled': False,
+    'versioned_tilemap.admission.max_concurrent': 4,
+    'versioned_tilemap.admission.queue_timeout': 5,
+    'versioned_tilemap.admission.rate': 2,
+    'versioned_tilemap.admission.burst': 10,
+    'versioned_tilemap.admission.client_header': '',
+    # the records at a location on the map are returned by /map-records in pages of page_size
+    # records (a request can ask for up to max_page_size)
+    'versioned_tilemap.records.page_size': 20,
+    'versioned_tilemap.records.max_page_size': 100,
+    # the cache used for the record pages, the tile server statuses and each client's latest
+    # map-info request, either memory (per process), sqlite (shared by the processes on a
+    # server, at the path option), redis (CKAN's redis server) or the path to a Cache subclass.
+    # The memory and sqlite caches evict the least recently used values when they hold more
+    # than max_size bytes. Superseded map-info requests are only abandoned across processes
+    # with a shared cache
+    'versioned_tilemap.cache': 'memory',
+    'versioned_tilemap.cache.max_size': 64 * 1024 * 1024,
+    # the built in tile renderer, which needs numpy (pip install
+    # ckanext-versioned-tiledmap[renderer]). When enabled, tiles are rendered by CKAN at
+    # /map-tiles if no tile servers are configured or none are available. At most max_points
+    # records are drawn on each tile
+    'versioned_tilemap.renderer.enabled': False,
+    'versioned_tilemap.renderer.max_points': 50000,
+    # when enabled, the grid map is drawn by the browser from the cell counts for the whole
+    # viewport, fetched from /map-aggregate in one request, rather than from PNG and UTF grid
+    # tiles. A request can cover at most max_cells cells, which is also the most buckets
+    # elasticsearch is asked for (its default search.max_buckets is 10000). Viewports
+    # covering more cells are counted in bigger cells
+    'versioned_tilemap.aggregate.enabled': False,
+    'versioned_tilemap.aggregate.max_cells': 10000,
 }
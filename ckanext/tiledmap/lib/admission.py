@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of a project
+# Created by the Natural History Museum in London, UK
+
+import functools
+import heapq
+import itertools
+import math
+import threading
+import time
+
+from cachetools import LRUCache
+from ckan.plugins import toolkit
+from flask import jsonify
+
+from ckanext.tiledmap.config import config
+
+# request priorities, lower values are admitted first
+INTERACTIVE = 0
+BULK = 1
+
+
+class AdmissionController:
+    """
+    Limits the number of requests doing expensive work at the same time. Requests wait
+    in a queue for a free slot and are admitted in order of priority and then arrival,
+    so interactive requests skip ahead of bulk ones. Requests which can't get a slot
+    within their timeout are rejected rather than left to pile up.
+    """
+
+    def __init__(self, max_concurrent):
+        """
+        :param max_concurrent: the maximum number of requests admitted at once
+        """
+        self.max_concurrent = max_concurrent
+        self._active = 0
+        # a heap of (priority, sequence) tuples, one for each waiting request
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def acquire(self, priority, timeout):
+        """
+        Waits for a slot. If a slot is acquired, release must be called once the work is
+        done.
+
+        :param priority: the priority of the request (INTERACTIVE or BULK)
+        :param timeout: the maximum number of seconds to wait
+        :returns: True if a slot was acquired, False if the timeout expired first
+        """
+        entry = (priority, next(self._sequence))
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while self._active >= self.max_concurrent or self._waiting[0] != entry:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._condition.wait(remaining)
+                self._active += 1
+                return True
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                # the head of the queue may have changed
+                self._condition.notify_all()
+
+    def release(self):
+        """
+        Releases a slot acquired with acquire.
+        """
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+
+class RateLimiter:
+    """
+    Per client token bucket rate limiter. Each client's bucket holds up to burst tokens
+    and is refilled at rate tokens per second, each request takes one token.
+    """
+
+    def __init__(self, rate, burst, max_clients=10000):
+        """
+        :param rate: the number of tokens added to each bucket per second
+        :param burst: the maximum number of tokens in a bucket
+        :param max_clients: the maximum number of buckets to keep, the least recently
+            used buckets are dropped first (which resets them to full)
+        """
+        self.rate = rate
+        self.burst = burst
+        # client -> (tokens, time the tokens were counted)
+        self._buckets = LRUCache(maxsize=max_clients)
+        self._lock = threading.Lock()
+
+    def _count(self, client, now):
+        """
+        Counts the tokens in the given client's bucket. Must be called with the lock
+        held.
+
+        :param client: the client key
+        :param now: the current time
+        :returns: the number of tokens
+        """
+        tokens, last = self._buckets.get(client, (self.burst, now))
+        return min(self.burst, tokens + (now - last) * self.rate)
+
+    def take(self, client):
+        """
+        Takes a token from the given client's bucket if there is one.
+
+        :param client: the client key
+        :returns: 0 if a token was taken, otherwise the number of seconds until there
+            will be a token available
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens = self._count(client, now)
+            if tokens >= 1:
+                self._buckets[client] = (tokens - 1, now)
+                return 0
+            self._buckets[client] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+    def wait_time(self, client):
+        """
+        Checks whether the given client's bucket has a token without taking it.
+
+        :param client: the client key
+        :returns: 0 if there is a token available, otherwise the number of seconds
+            until there will be
+        """
+        with self._lock:
+            tokens = self._count(client, time.monotonic())
+        return 0 if tokens >= 1 else (1 - tokens) / self.rate
+
+
+# the controller and limiter instances, keyed on the options they were created from
+_admission_controllers = {}
+_rate_limiters = {}
+
+
+def is_enabled():
+    """
+    Returns True if admission control has been enabled with the
+    versioned_tilemap.admission.enabled option, False if not.
+
+    :returns: True or False
+    """
+    return toolkit.asbool(config['versioned_tilemap.admission.enabled'])
+
+
+def get_admission_controller():
+    """
+    Returns the admission controller for the versioned_tilemap.admission.max_concurrent
+    option.
+
+    :returns: an AdmissionController
+    """
+    max_concurrent = int(config['versioned_tilemap.admission.max_concurrent'])
+    if max_concurrent not in _admission_controllers:
+        _admission_controllers[max_concurrent] = AdmissionController(max_concurrent)
+    return _admission_controllers[max_concurrent]
+
+
+def get_rate_limiter():
+    """
+    Returns the rate limiter for the versioned_tilemap.admission.rate and
+    versioned_tilemap.admission.burst options, or None if rate limiting is disabled
+    (i.e. the rate is 0).
+
+    :returns: a RateLimiter or None
+    """
+    rate = float(config['versioned_tilemap.admission.rate'])
+    if rate <= 0:
+        return None
+    burst = int(config['versioned_tilemap.admission.burst'])
+    if (rate, burst) not in _rate_limiters:
+        _rate_limiters[(rate, burst)] = RateLimiter(rate, burst)
+    return _rate_limiters[(rate, burst)]
+
+
+def get_client():
+    """
+    Returns the key the current request's client is rate limited under. This is the
+    user name for logged in users and the remote address for everyone else. Behind a
+    reverse proxy the remote address is the proxy's, so if the
+    versioned_tilemap.admission.client_header option is set (e.g. to X-Forwarded-For)
+    the address is taken from that header instead. Only set the option if every
+    request comes through a proxy which sets the header, otherwise clients can choose
+    their own address.
+
+    :returns: the client key
+    """
+    user = toolkit.c.user
+    if user:
+        return f'user:{user}'
+    header = config.get('versioned_tilemap.admission.client_header')
+    address = toolkit.request.headers.get(header) if header else None
+    if address:
+        # each proxy adds the address it received the request from to the end of the
+        # list, so the last address is the one our proxy added
+        address = address.split(',')[-1].strip()
+    return f'ip:{address or toolkit.request.remote_addr}'
+
+
+def is_low_priority():
+    """
+    Returns True if the current request has asked for low priority (with
+    priority=low), like the map view's prefetches, False if not.
+
+    :returns: True or False
+    """
+    return toolkit.request.params.get('priority') == 'low'
+
+
+def get_priority():
+    """
+    Returns the priority of the current request. Requests made by the map view's
+    javascript are interactive unless they've asked for low priority, everything else
+    is bulk.
+
+    :returns: INTERACTIVE or BULK
+    """
+    if is_low_priority():
+        return BULK
+    if toolkit.request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return INTERACTIVE
+    return BULK
+
+
+def reject(status, message, retry_after):
+    """
+    Creates a rejection response.
+
+    :param status: the HTTP status code
+    :param message: the error message
+    :param retry_after: the number of seconds the client should wait before retrying
+    :returns: a response
+    """
+    response = jsonify({'success': False, 'error': message})
+    response.status_code = status
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+def admit(view=None, rate_limit=True):
+    """
+    Decorator for views which do expensive datastore work. When admission control is
+    enabled, clients exceeding their rate limit get a 429 response and requests which
+    can't be admitted within the versioned_tilemap.admission.queue_timeout get a 503
+    response, both with a Retry-After header.
+
+    Low priority requests take their tokens from a separate bucket so that they can't
+    use up the tokens the client's interactive requests need, and they're rejected
+    whenever the client's interactive bucket is empty.
+
+    This can be used as @admit or, for views like tiles which the map requests lots of
+    at once, as @admit(rate_limit=False) so that the requests are only limited by the
+    number admitted at once.
+
+    :param view: the view function
+    :param rate_limit: whether to apply the per client rate limit
+    :returns: the wrapped view function
+    """
+    if view is None:
+        return functools.partial(admit, rate_limit=rate_limit)
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not is_enabled():
+            return view(*args, **kwargs)
+
+        rate_limiter = get_rate_limiter() if rate_limit else None
+        if rate_limiter is not None:
+            client = get_client()
+            if is_low_priority():
+                retry_after = rate_limiter.wait_time(client) or rate_limiter.take(
+                    f'{client}:low'
+                )
+            else:
+                retry_after = rate_limiter.take(client)
+            if retry_after:
+                return reject(429, 'Too many requests', retry_after)
+
+        controller = get_admission_controller()
+        timeout = float(config['versioned_tilemap.admission.queue_timeout'])
+        if not controller.acquire(get_priority(), timeout):
+            return reject(503, 'The server is busy', timeout)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            controller.release()
+
+    return wrapper
@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of a project
+# Created by the Natural History Museum in London, UK
+
+import abc
+import hashlib
+import importlib
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from ckan.common import json
+
+from ckanext.tiledmap.config import config
+
+log = logging.getLogger(__name__)
+
+# serialised values larger than this many bytes are compressed
+COMPRESSION_THRESHOLD = 512
+# the first byte of each serialised value says how the rest of it is encoded
+_JSON = b'j'
+_COMPRESSED_JSON = b'z'
+
+
+def serialise(value):
+    """
+    Serialises the given value as compact JSON, compressed if it's large.
+
+    :param value: a JSON serialisable value
+    :returns: bytes
+    """
+    data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+    if len(data) > COMPRESSION_THRESHOLD:
+        return _COMPRESSED_JSON + zlib.compress(data, 1)
+    return _JSON + data
+
+
+def deserialise(data):
+    """
+    Deserialises a value serialised by the serialise function.
+
+    :param data: bytes
+    :returns: the value
+    """
+    data = bytes(data)
+    if data[:1] == _COMPRESSED_JSON:
+        return json.loads(zlib.decompress(data[1:]).decode('utf-8'))
+    return json.loads(data[1:].decode('utf-8'))
+
+
+class Cache(abc.ABC):
+    """
+    A cache of JSON serialisable values. The values are serialised (see serialise) so
+    the cache can be shared with other processes and so that callers always get a fresh
+    copy of the value they can modify. Keys can be any string, they're hashed before
+    they're passed to the backend. Errors from the backend (e.g. a cache server which
+    is down) are logged and treated as a miss, as the cache is only ever an
+    optimisation.
+
+    Subclasses must implement _get and _set.
+    """
+
+    @staticmethod
+    def key(key):
+        """
+        Returns the key the backend stores the value for the given key under.
+
+        :param key: the key string
+        :returns: a hex string
+        """
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+
+    def get(self, key):
+        """
+        Returns the value stored under the given key.
+
+        :param key: the key string
+        :returns: the value, or None if there isn't one or it has expired
+        """
+        try:
+            data = self._get(self.key(key))
+        except Exception:
+            log.warning('Failed to get a value from the cache', exc_info=True)
+            return None
+        return None if data is None else deserialise(data)
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores the given value under the given key.
+
+        :param key: the key string
+        :param value: a JSON serialisable value
+        :param ttl: the number of seconds the value should be kept for, or None to
+            keep it until it's evicted
+        """
+        data = serialise(value)
+        try:
+            self._set(self.key(key), data, ttl)
+        except Exception:
+            log.warning('Failed to set a value in the cache', exc_info=True)
+
+    @abc.abstractmethod
+    def _get(self, key):
+        """
+        Returns the serialised value stored under the given hashed key.
+
+        :param key: the hashed key
+        :returns: bytes, or None if there isn't a value or it has expired
+        """
+
+    @abc.abstractmethod
+    def _set(self, key, data, ttl):
+        """
+        Stores the serialised value under the given hashed key.
+
+        :param key: the hashed key
+        :param data: the serialised value
+        :param ttl: the number of seconds to keep the value for, or None
+        """
+
+
+class MemoryCache(Cache):
+    """
+    Stores the values in memory, in this process only. When the total size of the
+    serialised values goes over max_size bytes, the least recently used are evicted.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        # key -> (expiry time or None, serialised value)
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                return None
+            expires, data = entry
+            if expires is not None and expires <= time.monotonic():
+                self._remove(key)
+                return None
+            self._values.move_to_end(key)
+            return data
+
+    def _set(self, key, data, ttl):
+        if len(data) > self.max_size:
+            return
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            if key in self._values:
+                self._remove(key)
+            self._values[key] = (expires, data)
+            self.size += len(data)
+            while self.size > self.max_size:
+                self._remove(next(iter(self._values)))
+
+    def _remove(self, key):
+        _, data = self._values.pop(key)
+        self.size -= len(data)
+
+
+class SQLiteCache(Cache):
+    """
+    Stores the values in an SQLite database at the given path, which all of the CKAN
+    processes on the server can share. Putting the database on a memory backed file
+    system (e.g. /dev/shm) avoids disk writes. When the total size of the serialised
+    values goes over max_size bytes, the least recently used are evicted until the total
+    is back under 90% of max_size, so that eviction doesn't run on every write.
+
+    So that reads don't have to take the database's write lock, the times values are
+    read at are kept in memory and written with the next value this process sets (or
+    once there are max_pending of them).
+    """
+
+    def __init__(self, path, max_size, max_pending=1000):
+        self.path = path
+        self.max_size = max_size
+        self.max_pending = max_pending
+        # hashed key -> the time it was last read, not yet written to the database
+        self._pending = {}
+        self._lock = threading.Lock()
+        connection = self._connect()
+        try:
+            # write ahead logging lets readers carry on while a value is being written
+            connection.execute('PRAGMA journal_mode=WAL')
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, '
+                    'value BLOB, size INTEGER, expires REAL, accessed REAL)'
+                )
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)'
+                )
+                # the running total of the sizes of the values, so that it doesn't
+                # have to be summed on every write
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY, '
+                    'total INTEGER)'
+                )
+                connection.execute(
+                    'INSERT OR IGNORE INTO cache_size (id, total) '
+                    'SELECT 0, COALESCE(SUM(size), 0) FROM cache'
+                )
+        finally:
+            connection.close()
+
+    def _connect(self):
+        # use a new connection each time as connections can't be shared between threads
+        return sqlite3.connect(self.path, timeout=10)
+
+    @staticmethod
+    @contextmanager
+    def _write(connection):
+        """
+        Context manager for a write transaction. The transaction takes the database's
+        write lock straight away, so other processes can't change the values between
+        this one reading their sizes and replacing them, which would throw the running
+        total off. The transaction is committed on exit or rolled back on an error.
+
+        :param connection: the database connection
+        """
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            yield
+
+    def _get(self, key):
+        now = time.time()
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                'SELECT value, expires FROM cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            data, expires = row
+            if expires is not None and expires <= now:
+                with self._write(connection):
+                    self._delete(connection, key)
+                return None
+            with self._lock:
+                self._pending[key] = now
+                flush = len(self._pending) >= self.max_pending
+            if flush:
+                with self._write(connection):
+                    self._write_pending(connection)
+        finally:
+            connection.close()
+        return data
+
+    def _set(self, key, data, ttl):
+        if len(data) > self.max_size:
+            return
+        now = time.time()
+        expires = None if ttl is None else now + ttl
+        connection = self._connect()
+        try:
+            with self._write(connection):
+                self._write_pending(connection)
+                self._delete(connection, key)
+                connection.execute(
+                    'INSERT INTO cache '
+                    '(key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)',
+                    (key, data, len(data), expires, now),
+                )
+                connection.execute(
+                    'UPDATE cache_size SET total = total + ? WHERE id = 0', (len(data),)
+                )
+                (total,) = connection.execute(
+                    'SELECT total FROM cache_size WHERE id = 0'
+                ).fetchone()
+                if total > self.max_size:
+                    self._evict(connection, total - int(self.max_size * 0.9))
+        finally:
+            connection.close()
+
+    def _write_pending(self, connection):
+        """
+        Writes the access times of the values read since the last write.
+
+        :param connection: the database connection, in a write transaction
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if pending:
+            connection.executemany(
+                'UPDATE cache SET accessed = MAX(accessed, ?) WHERE key = ?',
+                [(accessed, key) for key, accessed in pending.items()],
+            )
+
+    @staticmethod
+    def _delete(connection, key):
+        """
+        Deletes the value stored under the given key, if there is one.
+
+        :param connection: the database connection, in a write transaction
+        :param key: the hashed key
+        """
+        row = connection.execute(
+            'SELECT size FROM cache WHERE key = ?', (key,)
+        ).fetchone()
+        if row is not None:
+            connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+            connection.execute(
+                'UPDATE cache_size SET total = total - ? WHERE id = 0', (row[0],)
+            )
+
+    @staticmethod
+    def _evict(connection, size):
+        """
+        Deletes the least recently used values until at least the given number of bytes
+        have been freed.
+
+        :param connection: the database connection, in a write transaction
+        :param size: the number of bytes to free
+        """
+        keys = []
+        freed = 0
+        for key, value_size in connection.execute(
+            'SELECT key, size FROM cache ORDER BY accessed'
+        ):
+            keys.append((key,))
+            freed += value_size
+            if freed >= size:
+                break
+        connection.executemany('DELETE FROM cache WHERE key = ?', keys)
+        connection.execute(
+            'UPDATE cache_size SET total = total - ? WHERE id = 0', (freed,)
+        )
+
+
+class ExternalCache(Cache):
+    """
+    Stores the values in an external cache server shared by all the CKAN servers. The
+    client must provide redis-py style get(key) and set(key, value, ex=ttl) methods,
+    by default the client for CKAN's own Redis server is used. The server is expected
+    to evict values itself when it's full (e.g. Redis with an allkeys-lru maxmemory
+    policy) so max_size is ignored.
+    """
+
+    def __init__(self, max_size=None, client=None, prefix='ckanext-tiledmap:'):
+        if client is None:
+            from ckan.lib.redis import connect_to_redis
+
+            client = connect_to_redis()
+        self.client = client
+        self.prefix = prefix
+
+    def _get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def _set(self, key, data, ttl):
+        self.client.set(self.prefix + key, data, ex=None if ttl is None else int(ttl))
+
+
+class LocalClient:
+    """
+    Stand-in for an external cache server's client which keeps the values in memory.
+    This is useful for testing the ExternalCache without a server.
+    """
+
+    def __init__(self):
+        # key -> (expiry time or None, value)
+        self._values = {}
+
+    def get(self, key):
+        expires, value = self._values.get(key, (None, None))
+        if expires is not None and expires <= time.monotonic():
+            del self._values[key]
+            return None
+        return value
+
+    def set(self, key, value, ex=None):
+        expires = None if ex is None else time.monotonic() + ex
+        self._values[key] = (expires, value)
+
+
+# the cache backends that can be used in the versioned_tilemap.cache option
+CACHES = {
+    'memory': MemoryCache,
+    'sqlite': SQLiteCache,
+    'redis': ExternalCache,
+}
+
+# cache instances, keyed on the options they were created from
+_caches = {}
+
+
+def get_cache():
+    """
+    Returns the cache configured by the versioned_tilemap.cache option. The option is
+    either the name of one of the built in caches (memory, sqlite or redis) or the
+    dotted path to a Cache subclass (e.g. my.module:MyCache). The sqlite cache is
+    created with the path in the versioned_tilemap.cache.path option and the maximum
+    size in bytes in the versioned_tilemap.cache.max_size option, other caches are
+    created with just the maximum size.
+
+    :returns: a Cache instance
+    """
+    cache = config['versioned_tilemap.cache']
+    max_size = int(config['versioned_tilemap.cache.max_size'])
+    path = config.get('versioned_tilemap.cache.path')
+
+    if (cache, max_size, path) not in _caches:
+        if cache in CACHES:
+            cache_class = CACHES[cache]
+        elif ':' in cache:
+            module_name, class_name = cache.split(':', 1)
+            cache_class = getattr(importlib.import_module(module_name), class_name)
+        else:
+            raise ValueError(f'Unknown cache {cache}')
+        if cache_class is SQLiteCache:
+            if not path:
+                raise ValueError('versioned_tilemap.cache.path must be set')
+            instance = SQLiteCache(path, max_size)
+        else:
+            instance = cache_class(max_size)
+        _caches[(cache, max_size, path)] = instance
+    return _caches[(cache, max_size, path)]
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of a project
+# Created by the Natural History Museum in London, UK
+
+from ckan.common import json
+
+from ckanext.tiledmap.lib.cache import get_cache
+
+# the number of seconds each client's latest fetch for a view is remembered for
+FETCH_TTL = 60
+
+
+class FetchSuperseded(Exception):
+    """
+    Raised when a map-info request is abandoned because the same client has made a
+    newer request for the same view.
+    """
+
+    def __init__(self, fetch_id):
+        super().__init__(f'Fetch {fetch_id} has been superseded')
+        self.fetch_id = fetch_id
+
+
+class FetchTracker:
+    """
+    Keeps track of the latest fetch id each client has requested map info with for
+    each view. The map view's javascript only uses the response to its latest request
+    so work on older requests can be abandoned.
+
+    The latest fetch ids are kept in the cache (see get_cache) so that a request is
+    abandoned whichever process the newer request went to. With the memory cache,
+    which isn't shared, only newer requests made to the same process are noticed.
+    """
+
+    def __init__(self, cache=None, ttl=FETCH_TTL):
+        """
+        :param cache: the Cache to keep the fetch ids in, defaults to the one returned
+            by get_cache
+        :param ttl: the number of seconds to remember each fetch id for
+        """
+        self._cache = cache
+        self.ttl = ttl
+
+    @property
+    def cache(self):
+        return self._cache if self._cache is not None else get_cache()
+
+    @staticmethod
+    def _key(client_id, view_id):
+        return 'fetch:' + json.dumps([client_id, view_id], separators=(',', ':'))
+
+    def start(self, client_id, view_id, fetch_id):
+        """
+        Records that the given fetch has started.
+
+        :param client_id: the id of the client, as provided by the javascript module
+        :param view_id: the id of the view
+        :param fetch_id: the id of the fetch
+        """
+        key = self._key(client_id, view_id)
+        latest = self.cache.get(key)
+        if latest is None or fetch_id > latest:
+            self.cache.set(key, fetch_id, ttl=self.ttl)
+
+    def is_superseded(self, client_id, view_id, fetch_id):
+        """
+        Checks whether the client has started a newer fetch for the view than the given
+        one.
+
+        :param client_id: the id of the client
+        :param view_id: the id of the view
+        :param fetch_id: the id of the fetch
+        :returns: True if there is a newer fetch, False if not
+        """
+        latest = self.cache.get(self._key(client_id, view_id))
+        return latest is not None and latest > fetch_id
+
+
+fetch_tracker = FetchTracker()
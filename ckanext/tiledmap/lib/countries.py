@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of a project
+# Created by the Natural History Museum in London, UK
+
+import json
+import math
+import os
+import threading
+from collections import defaultdict
+
+# the countries dataset shipped with the plugin, this is also used by the map's javascript
+COUNTRIES_PATH = os.path.join(
+    os.path.dirname(__file__), '..', 'theme', 'public', 'data', 'countries.geojson'
+)
+
+
+class CountryIndex:
+    """
+    Spatial index of country polygons for hit-testing points. The world is divided into
+    a uniform grid of cells, each of which lists the countries whose bounding boxes
+    overlap it. For each country, the edges crossing each row of cells are precomputed
+    so that a hit-test only has to cast a ray across the handful of edges near the
+    point rather than every edge in the country.
+    """
+
+    def __init__(self, features, cell_size=1.0):
+        """
+        :param features: a list of GeoJSON features with Polygon or MultiPolygon
+            geometries
+        :param cell_size: the width and height of the grid cells in degrees
+        """
+        self.cell_size = cell_size
+        self.countries = []
+        # (column, row) -> list of country indexes
+        self.cells = defaultdict(list)
+        # (country index, row) -> list of (x1, y1, x2, y2) edges
+        self.edges = {}
+
+        for feature in features:
+            geometry = feature['geometry']
+            if geometry['type'] == 'Polygon':
+                polygons = [geometry['coordinates']]
+            elif geometry['type'] == 'MultiPolygon':
+                polygons = geometry['coordinates']
+            else:
+                continue
+            index = len(self.countries)
+            properties = feature.get('properties', {})
+            self.countries.append(
+                {
+                    'id': properties.get('adm0_a3', index),
+                    'name': properties.get('name'),
+                    'geometry': geometry,
+                }
+            )
+            self._add(index, polygons)
+
+    def _cell(self, lng, lat):
+        """
+        Returns the column and row of the cell containing the given point.
+        """
+        column = min(int((lng + 180) // self.cell_size), self._columns() - 1)
+        row = min(int((lat + 90) // self.cell_size), self._rows() - 1)
+        return max(column, 0), max(row, 0)
+
+    def _columns(self):
+        return math.ceil(360 / self.cell_size)
+
+    def _rows(self):
+        return math.ceil(180 / self.cell_size)
+
+    def _add(self, index, polygons):
+        """
+        Adds the given country's polygons to the grid.
+        """
+        points = [point for polygon in polygons for ring in polygon for point in ring]
+        min_column, min_row = self._cell(
+            min(x for x, _ in points), min(y for _, y in points)
+        )
+        max_column, max_row = self._cell(
+            max(x for x, _ in points), max(y for _, y in points)
+        )
+        for column in range(min_column, max_column + 1):
+            for row in range(min_row, max_row + 1):
+                self.cells[(column, row)].append(index)
+
+        rows = defaultdict(list)
+        for polygon in polygons:
+            for ring in polygon:
+                for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+                    if y1 == y2:
+                        # horizontal edges never cross the ray
+                        continue
+                    first_row = self._cell(0, min(y1, y2))[1]
+                    last_row = self._cell(0, max(y1, y2))[1]
+                    for row in range(first_row, last_row + 1):
+                        rows[row].append((x1, y1, x2, y2))
+        for row, edges in rows.items():
+            self.edges[(index, row)] = edges
+
+    def _contains(self, index, row, lng, lat):
+        """
+        Checks whether the given country contains the given point by casting a ray from
+        the point and counting the edges it crosses.
+        """
+        inside = False
+        for x1, y1, x2, y2 in self.edges.get((index, row), ()):
+            if (y1 > lat) != (y2 > lat):
+                if lng < (x2 - x1) * (lat - y1) / (y2 - y1) + x1:
+                    inside = not inside
+        return inside
+
+    def hit_test(self, lat, lng):
+        """
+        Returns the country at the given point.
+
+        :param lat: the latitude
+        :param lng: the longitude, this is wrapped into the -180 to 180 range
+        :returns: a dict containing the country's id, name and GeoJSON geometry, or
+            None if there isn't a country at the point
+        """
+        if not -90 <= lat <= 90:
+            return None
+        lng = (lng + 180) % 360 - 180
+        column, row = self._cell(lng, lat)
+        for index in self.cells.get((column, row), ()):
+            if self._contains(index, row, lng, lat):
+                return self.countries[index]
+        return None
+
+
+_country_index = None
+_country_index_lock = threading.Lock()
+
+
+def get_country_index():
+    """
+    Returns the index of the countries dataset shipped with the plugin. The index is
+    built the first time this is called and then reused.
+
+    :returns: a CountryIndex
+    """
+    global _country_index
+    if _country_index is None:
+        with _country_index_lock:
+            if _country_index is None:
+                with open(COUNTRIES_PATH, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                # the file may hold a single feature collection or a list of them
+                collections = data if isinstance(data, list) else [data]
+                _country_index = CountryIndex(
+                    [
+                        feature
+                        for collection in collections
+                        for feature in collection['features']
+                    ]
+                )
+    return _country_index
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of a project
+# Created by the Natural History Museum in London, UK
+
+import cProfile
+import os
+import random
+import time
+import uuid
+
+from ckan import authz
+from ckan.plugins import toolkit
+
+from ckanext.tiledmap.config import config
+
+# the request header sysadmins can set to profile a single request
+PROFILE_HEADER = 'X-Tiledmap-Profile'
+
+
+def is_enabled():
+    """
+    Returns True if profiling has been enabled with the
+    versioned_tilemap.profiling.enabled option, False if not.
+
+    :returns: True or False
+    """
+    return toolkit.asbool(config['versioned_tilemap.profiling.enabled'])
+
+
+def check_config():
+    """
+    Checks the profiling options, this is called when the plugin is configured so that
+    a missing path is reported when CKAN starts rather than when the first request is
+    profiled.
+    """
+    if is_enabled() and not config.get('versioned_tilemap.profiling.path'):
+        raise ValueError(
+            'versioned_tilemap.profiling.path must be set when profiling is enabled'
+        )
+
+
+def should_profile():
+    """
+    Decides whether the current request should be profiled. When profiling is enabled,
+    requests are profiled if they include the profile header and were made by a
+    sysadmin, or if they're picked by the versioned_tilemap.profiling.sample_rate
+    option, which is the fraction of requests to profile (between 0 and 1).
+
+    :returns: True if the request should be profiled, False if not
+    """
+    # without a path there's nowhere to write the profile, see check_config
+    if not is_enabled() or not config.get('versioned_tilemap.profiling.path'):
+        return False
+    if toolkit.request.headers.get(PROFILE_HEADER) and authz.is_sysadmin(
+        toolkit.c.user
+    ):
+        return True
+    sample_rate = float(config['versioned_tilemap.profiling.sample_rate'])
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+def profile(name, function, *args, **kwargs):
+    """
+    Calls the given function with the given arguments under cProfile and writes the
+    profile to the directory in the versioned_tilemap.profiling.path option. The
+    profile is written in pstats format and can be read with the pstats module or
+    visualised with tools such as snakeviz or flameprof.
+
+    :param name: a name for the profile, used as the start of the file name
+    :param function: the function to call
+    :param args: the positional arguments to pass to the function
+    :param kwargs: the keyword arguments to pass to the function
+    :returns: a 2-tuple of the function's return value and the path of the profile
+    """
+    path = config.get('versioned_tilemap.profiling.path')
+    if not path:
+        raise ValueError('versioned_tilemap.profiling.path must be set')
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        profiler.disable()
+        os.makedirs(path, exist_ok=True)
+        # include the time so that the profiles sort in the order they were made, and
+        # a random suffix so that profiles made at the same time don't overwrite each
+        # other
+        timestamp = time.strftime('%Y%m%d%H%M%S')
+        profile_path = os.path.join(
+            path, f'{name}-{timestamp}-{uuid.uuid4().hex[:8]}.prof'
+        )
+        profiler.dump_stats(profile_path)
+    return result, profile_path
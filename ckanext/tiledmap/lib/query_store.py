@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of a project
+# Created by the Natural History Museum in London, UK
+
+import abc
+import hashlib
+import importlib
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from ckanext.tiledmap.config import config
+
+# the number of seconds after which a process stores a query body it has already stored
+# again, to record that it's still in use (see QueryStore.evict)
+TOUCH_INTERVAL = 60 * 60
+# the number of keys each process remembers storing
+SEEN_KEYS = 10000
+
+
+class QueryStore(abc.ABC):
+    """
+    Stores encoded query bodies under a hash of their content. This allows the map to
+    send the short hash to the tile server instead of the whole query, the tile server
+    can then look the query up using the /map-query endpoint.
+
+    Subclasses must call QueryStore.__init__ and implement get and _put, and should
+    implement evict.
+    """
+
+    def __init__(self):
+        # key -> when this process last stored it, least recently used first
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(query_body):
+        """
+        Returns the key the given query body is stored under.
+
+        :param query_body: the encoded query body
+        :returns: a hex string
+        """
+        return hashlib.sha256(query_body.encode('utf-8')).hexdigest()[:32]
+
+    @staticmethod
+    def is_valid_key(key):
+        """
+        Checks whether the given value could be a key returned by the key method. Keys
+        from requests should be checked with this before they're used.
+
+        :param key: the value to check
+        :returns: True if the value is a valid key, False if not
+        """
+        return re.fullmatch('[0-9a-f]{32}', key) is not None
+
+    def put(self, query_body):
+        """
+        Stores the given query body and returns its key. Storing the same query body
+        more than once is harmless. As this is called for every map, the query body
+        is only written if this process hasn't stored it in the last TOUCH_INTERVAL
+        seconds.
+
+        :param query_body: the encoded query body, as a str or bytes
+        :returns: the key
+        """
+        if isinstance(query_body, bytes):
+            query_body = query_body.decode('utf-8')
+        key = self.key(query_body)
+        now = time.time()
+        with self._lock:
+            stored = self._seen.get(key)
+            if stored is not None and stored + TOUCH_INTERVAL > now:
+                self._seen.move_to_end(key)
+                return key
+        self._put(key, query_body)
+        with self._lock:
+            self._seen[key] = now
+            self._seen.move_to_end(key)
+            while len(self._seen) > SEEN_KEYS:
+                self._seen.popitem(last=False)
+        return key
+
+    @abc.abstractmethod
+    def get(self, key):
+        """
+        Returns the query body stored under the given key. The key must be valid (see
+        is_valid_key).
+
+        :param key: the key
+        :returns: the encoded query body as a str, or None if there isn't one
+        """
+
+    @abc.abstractmethod
+    def _put(self, key, query_body):
+        """
+        Stores the given query body under the given key, or if it's already stored,
+        records that it's still in use.
+
+        :param key: the key
+        :param query_body: the encoded query body as a str
+        """
+
+    def evict(self, max_age):
+        """
+        Deletes the query bodies which haven't been stored for max_age seconds. Query
+        bodies are stored again at least every TOUCH_INTERVAL seconds while maps are
+        using them, so max_age should be much longer than this. The stores never evict
+        query bodies themselves, this is run by the tiledmap evict-queries command.
+
+        :param max_age: the number of seconds
+        :returns: the number of query bodies deleted
+        """
+        return 0
+
+
+class FileQueryStore(QueryStore):
+    """
+    Stores each query body in a file in the given directory. The directory can be shared
+    between CKAN servers using a network file system.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def _file_path(self, key):
+        # split the files up into subdirectories to avoid having one huge directory
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+        try:
+            with open(self._file_path(key), 'r', encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _put(self, key, query_body):
+        file_path = self._file_path(key)
+        if os.path.exists(file_path):
+            # the file's modification time records when it was last used
+            os.utime(file_path)
+            return
+        directory = os.path.dirname(file_path)
+        os.makedirs(directory, exist_ok=True)
+        # write to a temporary file and move it into place so that readers never see a
+        # partially written query
+        fd, temp_path = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(query_body)
+            os.replace(temp_path, file_path)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+
+    def evict(self, max_age):
+        cutoff = time.time() - max_age
+        evicted = 0
+        for directory, _, file_names in os.walk(self.path):
+            for file_name in file_names:
+                file_path = os.path.join(directory, file_name)
+                try:
+                    if os.path.getmtime(file_path) < cutoff:
+                        os.unlink(file_path)
+                        evicted += 1
+                except FileNotFoundError:
+                    # another server evicted it first
+                    pass
+        return evicted
+
+
+class SQLiteQueryStore(QueryStore):
+    """
+    Stores the query bodies in an SQLite database at the given path.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS queries '
+                    '(key TEXT PRIMARY KEY, body TEXT, used REAL)'
+                )
+                columns = {
+                    row[1] for row in connection.execute('PRAGMA table_info(queries)')
+                }
+                if 'used' not in columns:
+                    # databases created before eviction was added
+                    connection.execute('ALTER TABLE queries ADD COLUMN used REAL')
+                    connection.execute('UPDATE queries SET used = ?', (time.time(),))
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS queries_used ON queries (used)'
+                )
+        finally:
+            connection.close()
+
+    def _connect(self):
+        # use a new connection each time as connections can't be shared between threads
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, key):
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                'SELECT body FROM queries WHERE key = ?', (key,)
+            ).fetchone()
+        finally:
+            connection.close()
+        return None if row is None else row[0]
+
+    def _put(self, key, query_body):
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO queries (key, body, used) VALUES (?, ?, ?)',
+                    (key, query_body, time.time()),
+                )
+        finally:
+            connection.close()
+
+    def evict(self, max_age):
+        connection = self._connect()
+        try:
+            with connection:
+                cursor = connection.execute(
+                    'DELETE FROM queries WHERE used < ?', (time.time() - max_age,)
+                )
+        finally:
+            connection.close()
+        return cursor.rowcount
+
+
+# the query store types that can be used in the versioned_tilemap.query_store option
+QUERY_STORES = {
+    'file': FileQueryStore,
+    'sqlite': SQLiteQueryStore,
+}
+
+# query store instances, keyed on the store option and path they were created from
+_query_stores = {}
+
+
+def get_query_store():
+    """
+    Returns the query store configured by the versioned_tilemap.query_store option, or
+    None if query bodies should be sent to the tile server in full. The option is either
+    the name of one of the built in stores (file or sqlite) or the dotted path to a
+    QueryStore subclass (e.g. my.module:MyQueryStore), which will be created with the
+    path in the versioned_tilemap.query_store.path option.
+
+    :returns: a QueryStore instance or None
+    """
+    store = config.get('versioned_tilemap.query_store')
+    if not store:
+        return None
+    path = config.get('versioned_tilemap.query_store.path')
+    if not path:
+        raise ValueError('versioned_tilemap.query_store.path must be set')
+
+    if (store, path) not in _query_stores:
+        if store in QUERY_STORES:
+            store_class = QUERY_STORES[store]
+        elif ':' in store:
+            module_name, class_name = store.split(':', 1)
+            store_class = getattr(importlib.import_module(module_name), class_name)
+        else:
+            raise ValueError(f'Unknown query store {store}')
+        _query_stores[(store, path)] = store_class(path)
+    return _query_stores[(store, path)]
@@ -0,0 +1,573 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# This file is part of a project
+# Created by the Natural History Museum in London, UK
+
+import base64
+import math
+import re
+import struct
+import zlib
+
+from ckan.common import json
+from ckan.plugins import toolkit
+
+from ckanext.tiledmap.config import config
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# the maximum latitude that can be shown on a web mercator map
+MAX_LATITUDE = 85.0511
+# the maximum size in bytes of a decompressed query body
+MAX_QUERY_SIZE = 1024 * 1024
+# the maximum point radius in pixels, the time and memory taken to draw the points
+# grow with the square of the radius
+MAX_POINT_RADIUS = 32
+
+
+def colour(value):
+    """
+    Checks the given value is a hex colour.
+
+    :param value: the value
+    :returns: the value
+    :raises: ValueError if the value isn't a #rrggbb colour
+    """
+    if not re.fullmatch(r'#?[0-9a-fA-F]{6}', value):
+        raise ValueError(f'Invalid colour {value}')
+    return value
+
+
+# the functions used to convert each of the style parameters passed in the tile URLs
+PARAM_TYPES = {
+    'point_radius': int,
+    'point_colour': colour,
+    'border_width': int,
+    'border_colour': colour,
+    'grid_resolution': int,
+    'cold_colour': colour,
+    'hot_colour': colour,
+    'range_size': int,
+    'intensity': float,
+}
+
+
+def check_style_params(params, size):
+    """
+    Checks the given style parameters, as converted with PARAM_TYPES, are in the ranges
+    the renderer can draw.
+
+    :param params: a dict of style parameters
+    :param size: the width and height of the tile in pixels
+    :raises: ValueError if any of the parameters are out of range
+    """
+    point_radius = params.get('point_radius')
+    if point_radius is not None and not 1 <= point_radius <= MAX_POINT_RADIUS:
+        raise ValueError(f'The point radius must be between 1 and {MAX_POINT_RADIUS}')
+    border_width = params.get('border_width')
+    if border_width is not None and not 0 <= border_width <= point_radius:
+        raise ValueError('The border width must be between 0 and the point radius')
+    grid_resolution = params.get('grid_resolution')
+    if grid_resolution is not None and (grid_resolution < 1 or size % grid_resolution):
+        raise ValueError('The grid resolution must divide the tile size')
+    if params.get('range_size', 1) < 1:
+        raise ValueError('The range size must be at least 1')
+    if not 0 <= params.get('intensity', 0) <= 1:
+        raise ValueError('The intensity must be between 0 and 1')
+
+
+def is_available():
+    """
+    Returns True if NumPy, which the renderer needs, is installed.
+
+    :returns: True or False
+    """
+    return np is not None
+
+
+def is_enabled():
+    """
+    Returns True if the renderer has been enabled with the
+    versioned_tilemap.renderer.enabled option, False if not.
+
+    :returns: True or False
+    """
+    return toolkit.asbool(config['versioned_tilemap.renderer.enabled'])
+
+
+def decode_query_body(query_body, max_size=MAX_QUERY_SIZE):
+    """
+    Decodes the given query body, as created by MapViewSettings.get_query_body. Query
+    bodies come from requests so at most max_size bytes are decompressed.
+
+    :param query_body: the url safe base64 encoded, gzipped, JSON query as a str or
+        bytes
+    :param max_size: the maximum size in bytes of the decompressed query
+    :returns: a dict containing the indexes to search and the search
+    :raises: ValueError if the query body is invalid or too large
+    """
+    if isinstance(query_body, str):
+        query_body = query_body.encode('utf-8')
+    # 16 + MAX_WBITS tells zlib to expect a gzip header
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        data = decompressor.decompress(base64.urlsafe_b64decode(query_body), max_size)
+    except zlib.error as e:
+        raise ValueError(f'Invalid query body: {e}')
+    if decompressor.unconsumed_tail:
+        raise ValueError('The query body is too large')
+    return json.loads(data)
+
+
+def tile_bounds(z, x, y, margin=0.0):
+    """
+    Returns the bounds of the given tile, optionally expanded by a margin.
+
+    :param z: the zoom level of the tile
+    :param x: the column of the tile
+    :param y: the row of the tile
+    :param margin: the fraction of a tile to expand the bounds by on each side
+    :returns: a 4-tuple of the north, west, south and east bounds in degrees, the
+        latitudes are clamped to those a web mercator map can show and the longitudes
+        to -180 to 180
+    """
+    n = 2**z
+
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    def lng(column):
+        return column / n * 360 - 180
+
+    return (
+        min(lat(y - margin), MAX_LATITUDE),
+        max(lng(x - margin), -180),
+        max(lat(y + 1 + margin), -MAX_LATITUDE),
+        min(lng(x + 1 + margin), 180),
+    )
+
+
+def project(lats, lngs, z, x, y, size):
+    """
+    Projects the given points onto the pixels of the given tile.
+
+    :param lats: an array of latitudes
+    :param lngs: an array of longitudes
+    :param z: the zoom level of the tile
+    :param x: the column of the tile
+    :param y: the row of the tile
+    :param size: the width and height of the tile in pixels
+    :returns: a 2-tuple of arrays of the pixel columns and rows of the points, these
+        can be outside the tile
+    """
+    n = 2**z
+    lats = np.radians(np.clip(lats, -MAX_LATITUDE, MAX_LATITUDE))
+    columns = ((lngs + 180) / 360 * n - x) * size
+    rows = ((1 - np.log(np.tan(lats) + 1 / np.cos(lats)) / np.pi) / 2 * n - y) * size
+    return columns, rows
+
+
+def parse_colour(value):
+    """
+    Converts the given hex colour into an RGBA array.
+
+    :param value: the colour as a #rrggbb string
+    :returns: an array of 4 floats
+    """
+    value = value.lstrip('#')
+    return np.array(
+        [int(value[i : i + 2], 16) for i in (0, 2, 4)] + [255], dtype=np.float64
+    )
+
+
+def bin_points(columns, rows, width, cell_size=1, pad=0):
+    """
+    Counts the points in each cell of a square grid over the tile.
+
+    :param columns: an array of the pixel columns of the points
+    :param rows: an array of the pixel rows of the points
+    :param width: the width of the tile in pixels
+    :param cell_size: the width and height of the cells in pixels
+    :param pad: the number of cells to add around the edge of the grid, so that
+        points just outside the tile are counted too
+    :returns: a square 2D array of counts
+    """
+    n = width // cell_size + 2 * pad
+    cell_columns = np.floor(columns / cell_size).astype(np.int64) + pad
+    cell_rows = np.floor(rows / cell_size).astype(np.int64) + pad
+    inside = (cell_columns >= 0) & (cell_columns < n) & (cell_rows >= 0)
+    inside &= cell_rows < n
+    cells = cell_rows[inside] * n + cell_columns[inside]
+    return np.bincount(cells, minlength=n * n).reshape(n, n)
+
+
+def dilate(mask, radius, pad):
+    """
+    Grows each set pixel in the given padded mask into a disc of the given radius and
+    removes the padding.
+
+    :param mask: a 2D boolean array with pad pixels of padding on each side
+    :param radius: the radius of the discs, at most pad
+    :param pad: the padding
+    :returns: a 2D boolean array without the padding
+    """
+    size = mask.shape[0] - 2 * pad
+    result = np.zeros((size, size), dtype=bool)
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            if dx * dx + dy * dy <= radius * radius:
+                result |= mask[
+                    pad + dy : pad + dy + size,
+                    pad + dx : pad + dx + size,
+                ]
+    return result
+
+
+def blur(values, radius, pad):
+    """
+    Applies a gaussian blur of the given radius to the given padded array and removes
+    the padding.
+
+    :param values: a 2D array with pad pixels of padding on each side
+    :param radius: the radius of the blur, at most pad
+    :param pad: the padding
+    :returns: a 2D array without the padding
+    """
+    sigma = max(radius / 2, 0.5)
+    offsets = range(-radius, radius + 1)
+    weights = np.exp(-(np.array(offsets) ** 2) / (2 * sigma**2))
+    weights /= weights.sum()
+    size = values.shape[0] - 2 * pad
+    # the blur is separable so blur the columns, then the rows
+    columns = np.zeros((values.shape[0], size))
+    for offset, weight in zip(offsets, weights):
+        columns += weight * values[:, pad + offset : pad + offset + size]
+    result = np.zeros((size, size))
+    for offset, weight in zip(offsets, weights):
+        result += weight * columns[pad + offset : pad + offset + size, :]
+    return result
+
+
+def render_plot(
+    columns, rows, size, point_radius, point_colour, border_width, border_colour
+):
+    """
+    Renders the given points as discs.
+
+    :param columns: an array of the pixel columns of the points
+    :param rows: an array of the pixel rows of the points
+    :param size: the width and height of the tile in pixels
+    :param point_radius: the radius of the points, including the border
+    :param point_colour: the colour of the points
+    :param border_width: the width of the points' borders
+    :param border_colour: the colour of the points' borders
+    :returns: an RGBA image array
+    """
+    image = np.zeros((size, size, 4), dtype=np.uint8)
+    pad = point_radius
+    centres = bin_points(columns, rows, size, pad=pad) > 0
+    image[dilate(centres, point_radius, pad)] = parse_colour(border_colour)
+    if border_width < point_radius:
+        fill = dilate(centres, point_radius - border_width, pad)
+        image[fill] = parse_colour(point_colour)
+    return image
+
+
+def render_gridded(
+    columns, rows, size, grid_resolution, cold_colour, hot_colour, range_size
+):
+    """
+    Renders the number of points in each cell of a grid, coloured on a log scale from
+    the cold colour for the emptiest cells to the hot colour for the fullest.
+
+    :param columns: an array of the pixel columns of the points
+    :param rows: an array of the pixel rows of the points
+    :param size: the width and height of the tile in pixels
+    :param grid_resolution: the width and height of the grid cells in pixels
+    :param cold_colour: the colour of the cells with the fewest points
+    :param hot_colour: the colour of the cells with the most points
+    :param range_size: the number of colours between the cold and hot colours
+    :returns: an RGBA image array
+    """
+    counts = bin_points(columns, rows, size, cell_size=grid_resolution)
+    cells = np.zeros(counts.shape + (4,), dtype=np.uint8)
+    if counts.max() > 0:
+        scale = np.log1p(counts) / np.log1p(counts.max())
+        levels = np.minimum((scale * range_size).astype(np.int64), range_size - 1)
+        fractions = levels / max(range_size - 1, 1)
+        cold = parse_colour(cold_colour)
+        hot = parse_colour(hot_colour)
+        colours = cold + (hot - cold) * fractions[..., np.newaxis]
+        cells[counts > 0] = colours[counts > 0]
+    image = np.repeat(np.repeat(cells, grid_resolution, 0), grid_resolution, 1)
+    # the tile size might not be a multiple of the resolution
+    padded = np.zeros((size, size, 4), dtype=np.uint8)
+    padded[: image.shape[0], : image.shape[1]] = image
+    return padded
+
+
+def render_heatmap(
+    columns, rows, size, point_radius, cold_colour, hot_colour, intensity
+):
+    """
+    Renders the density of the points, blending from the cold colour where there are
+    few points to the hot colour where there are many.
+
+    :param columns: an array of the pixel columns of the points
+    :param rows: an array of the pixel rows of the points
+    :param size: the width and height of the tile in pixels
+    :param point_radius: the radius each point is spread over
+    :param cold_colour: the colour of the least dense areas
+    :param hot_colour: the colour of the most dense areas
+    :param intensity: how quickly the colour saturates as the density increases,
+        between 0 and 1
+    :returns: an RGBA image array
+    """
+    pad = point_radius
+    counts = bin_points(columns, rows, size, pad=pad).astype(np.float64)
+    density = blur(counts, point_radius, pad) * (point_radius**2)
+    heat = 1 - np.exp(-density * intensity)
+    cold = parse_colour(cold_colour)
+    hot = parse_colour(hot_colour)
+    image = cold + (hot - cold) * heat[..., np.newaxis]
+    image[..., 3] = heat * 255
+    return np.round(image).astype(np.uint8)
+
+
+def render_utf_grid(lats, lngs, columns, rows, records, z, x, y, size, grid_resolution):
+    """
+    Creates a UTFGrid for the given points. Each cell of the grid containing points
+    has a key and the data for the key contains the number of points in the cell, the
+    location and data of the first point and a geo_filter which can be used as a
+    __geo__ filter to find the points in the cell.
+
+    :param lats: an array of the latitudes of the points
+    :param lngs: an array of the longitudes of the points
+    :param columns: an array of the pixel columns of the points
+    :param rows: an array of the pixel rows of the points
+    :param records: a list of the points' records
+    :param z: the zoom level of the tile
+    :param x: the column of the tile
+    :param y: the row of the tile
+    :param size: the width and height of the tile in pixels
+    :param grid_resolution: the width and height of the grid cells in pixels
+    :returns: a UTFGrid dict
+    """
+    n = size // grid_resolution
+    cell_columns = np.floor(columns / grid_resolution).astype(np.int64)
+    cell_rows = np.floor(rows / grid_resolution).astype(np.int64)
+    inside = (cell_columns >= 0) & (cell_columns < n) & (cell_rows >= 0)
+    inside &= cell_rows < n
+    (indexes,) = np.nonzero(inside)
+    cells = cell_rows[inside] * n + cell_columns[inside]
+    counts = np.bincount(cells, minlength=n * n)
+    unique_cells, firsts = np.unique(cells, return_index=True)
+
+    keys = ['']
+    data = {}
+    key_indexes = np.zeros(n * n, dtype=np.int64)
+    for cell, first in zip(unique_cells.tolist(), firsts.tolist()):
+        key = str(cell)
+        key_indexes[cell] = len(keys)
+        keys.append(key)
+        index = indexes[first]
+        # the cell's bounds, as a fraction of a tile
+        cell_y, cell_x = divmod(cell, n)
+        north, west, south, east = tile_bounds(
+            z + math.log2(n),
+            x * n + cell_x,
+            y * n + cell_y,
+        )
+        data[key] = {
+            'count': int(counts[cell]),
+            'record_latitude': float(lats[index]),
+            'record_longitude': float(lngs[index]),
+            'geo_filter': {
+                'type': 'Polygon',
+                'coordinates': [
+                    [
+                        [west, north],
+                        [east, north],
+                        [east, south],
+                        [west, south],
+                        [west, north],
+                    ]
+                ],
+            },
+            'data': records[index] if records is not None else {},
+        }
+
+    # encode the key indexes as characters, skipping " and \ which need escaping
+    codes = key_indexes + 32
+    codes += codes >= 34
+    codes += codes >= 92
+    grid = [''.join(map(chr, row)) for row in codes.reshape(n, n).tolist()]
+    return {'grid': grid, 'keys': keys, 'data': data}
+
+
+def encode_png(image):
+    """
+    Encodes the given RGBA image as a PNG.
+
+    :param image: an RGBA image array of 8 bit values
+    :returns: the PNG as bytes
+    """
+    height, width, _ = image.shape
+    # each row is prefixed with its filter type, 0 (none)
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = image.reshape(height, width * 4)
+
+    def chunk(chunk_type, data):
+        checksum = zlib.crc32(chunk_type + data) & 0xFFFFFFFF
+        return (
+            struct.pack('>I', len(data))
+            + chunk_type
+            + data
+            + struct.pack('>I', checksum)
+        )
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    return b''.join(
+        [
+            b'\x89PNG\r\n\x1a\n',
+            chunk(b'IHDR', header),
+            chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)),
+            chunk(b'IEND', b''),
+        ]
+    )
+
+
+def search_points(query, bounds, fields=None):
+    """
+    Pages through the records in the given query which are within the given bounds
+    and returns their locations. This searches elasticsearch directly using the
+    versioned datastore's client, like the tile server does. Only the query part of the
+    search is used, so a query body can't add aggregations or scripts, and the caller
+    must check the indexes are ones the user can read. At most
+    versioned_tilemap.renderer.max_points records are returned.
+
+    :param query: the decoded query body, see decode_query_body
+    :param bounds: the north, west, south and east bounds to search in
+    :param fields: the fields of the records' data to return, or None to only return
+        the locations
+    :returns: a 3-tuple of an array of latitudes, an array of longitudes and a list of
+        the records' data (or None if no fields were given)
+    """
+    from elasticsearch_dsl import Search
+
+    from ckanext.versioned_datastore.lib import common
+
+    max_points = int(config['versioned_tilemap.renderer.max_points'])
+    page_size = min(max_points, 10000)
+    north, west, south, east = bounds
+    search = (
+        Search.from_dict({'query': query['search'].get('query', {'match_all': {}})})
+        .index(query['indexes'])
+        .using(common.ES_CLIENT)
+        .filter(
+            'geo_bounding_box',
+            **{
+                'meta.geo': {
+                    'top_left': {'lat': north, 'lon': west},
+                    'bottom_right': {'lat': south, 'lon': east},
+                }
+            },
+        )
+        .source(['meta.geo'] + [f'data.{field}' for field in fields or []])
+        .sort('data._id')
+    )
+
+    lats = []
+    lngs = []
+    records = None if fields is None else []
+    after = None
+    while len(lats) < max_points:
+        page = search.extra(from_=0, size=min(page_size, max_points - len(lats)))
+        if after is not None:
+            page = page.extra(search_after=after)
+        hits = page.execute().to_dict()['hits']['hits']
+        for hit in hits:
+            # the location is indexed as a "lat,lon" string
+            lat, lng = hit['_source']['meta']['geo'].split(',')
+            lats.append(float(lat))
+            lngs.append(float(lng))
+            if records is not None:
+                records.append(hit['_source'].get('data', {}))
+        if len(hits) < page_size:
+            break
+        after = hits[-1]['sort']
+    return np.array(lats, dtype=np.float64), np.array(lngs, dtype=np.float64), records
+
+
+def render_tile(query, z, x, y, size, style, params):
+    """
+    Renders a tile of the records in the given query in the given style.
+
+    :param query: the decoded query body, see decode_query_body
+    :param z: the zoom level of the tile
+    :param x: the column of the tile
+    :param y: the row of the tile
+    :param size: the width and height of the tile in pixels
+    :param style: the name of the style (plot, gridded or heatmap)
+    :param params: a dict of the style's parameters, see PARAM_TYPES
+    :returns: the tile as PNG bytes
+    """
+    # include the points just outside the tile which overlap it
+    margin = params.get('point_radius', 0) / size
+    lats, lngs, _ = search_points(query, tile_bounds(z, x, y, margin))
+    columns, rows = project(lats, lngs, z, x, y, size)
+    if style == 'plot':
+        image = render_plot(
+            columns,
+            rows,
+            size,
+            params['point_radius'],
+            params['point_colour'],
+            params['border_width'],
+            params['border_colour'],
+        )
+    elif style == 'gridded':
+        image = render_gridded(
+            columns,
+            rows,
+            size,
+            params['grid_resolution'],
+            params['cold_colour'],
+            params['hot_colour'],
+            params['range_size'],
+        )
+    else:
+        image = render_heatmap(
+            columns,
+            rows,
+            size,
+            params['point_radius'],
+            params['cold_colour'],
+            params['hot_colour'],
+            params['intensity'],
+        )
+    return encode_png(image)
+
+
+def render_grid_tile(query, z, x, y, size, grid_resolution, fields):
+    """
+    Creates the UTFGrid for a tile of the records in the given query.
+
+    :param query: the decoded query body, see decode_query_body
+    :param z: the zoom level of the tile
+    :param x: the column of the tile
+    :param y: the row of the tile
+    :param size: the width and height of the tile in pixels
+    :param grid_resolution: the width and height of the grid cells in pixels
+    :param fields: the fields of the records' data to include in the grid
+    :returns: a UTFGrid dict
+    """
+    lats, lngs, records = search_points(query, tile_bounds(z, x, y), fields)
+    columns, rows = project(lats, lngs, z, x, y, size)
+    return render_utf_grid(
+        lats, lngs, columns, rows, records, z, x, y, size, grid_resolution
+    )
@@ -4,11 +4,23 @@
 # This file is part of a project
 # Created by the Natural History Museum in London, UK
 
+import threading
+import time
 import urllib.request
 
-from cachetools import TTLCache, cached
 from ckan.plugins import toolkit
 
+from ckanext.tiledmap.lib.cache import get_cache
+
+# the number of seconds after which a tile server's status is refreshed
+TILESERVER_STATUS_TTL = 60
+# the number of seconds to wait for a tile server's status endpoint to respond
+TILESERVER_STATUS_TIMEOUT = 1
+
+# the URLs of the tile servers whose statuses are being refreshed by this process
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
 
 def get_resource_datastore_fields(resource_id):
     data = {'resource_id': resource_id, 'limit': 0}
@@ -16,21 +28,139 @@ def get_resource_datastore_fields(resource_id):
     return set(field['id'] for field in all_fields)
 
 
-@cached(cache=TTLCache(maxsize=10, ttl=300))
-def get_tileserver_status():
-    tileserver_url = toolkit.config.get('versioned_tilemap.tile_server')
+def get_tile_servers():
+    """
+    Returns the tile servers defined in the config. The versioned_tilemap.tile_server
+    option is a whitespace separated list of tile server URLs, each of which can
+    optionally be followed by a | and an integer weight (e.g. http://tiles-1:4000|2).
+    Any URLs containing {s} are expanded into one tile server per subdomain listed in
+    the versioned_tilemap.tile_server.subdomains option.
+
+    :returns: a list of (url, weight) tuples
+    """
+    subdomains = toolkit.config.get('versioned_tilemap.tile_server.subdomains', 'a b c')
+    tile_servers = []
+    for entry in toolkit.config.get('versioned_tilemap.tile_server', '').split():
+        url, _, weight = entry.partition('|')
+        weight = int(weight) if weight else 1
+        if '{s}' in url:
+            for subdomain in subdomains.split():
+                tile_servers.append((url.replace('{s}', subdomain), weight))
+        else:
+            tile_servers.append((url, weight))
+    return tile_servers
+
+
+def get_available_tile_servers(fallback=None):
+    """
+    Returns the URLs of the tile servers which aren't known to be failing their status
+    checks, each repeated according to its weight. Tile URLs are spread across the
+    servers in this list by the map so servers with a higher weight will receive more
+    requests. If none of the servers are passing their status checks then the fallback
+    URL is returned if there is one (e.g. the built in renderer's, see
+    lib/renderer.py), otherwise all of the servers are returned as there's no point
+    sending the map nowhere.
+
+    :param fallback: the URL to use if there aren't any tile servers available
+    :returns: a list of URLs
+    """
+    tile_servers = get_tile_servers()
+    available = [
+        (url, weight)
+        for url, weight in tile_servers
+        if get_tileserver_status(url) != 'unavailable'
+    ]
+    if not available and fallback is not None:
+        return [fallback]
+    return [url for url, weight in (available or tile_servers) for _ in range(weight)]
+
+
+def get_tileserver_status(tileserver_url=None):
+    """
+    Returns the last known status of the given tile server, or the overall status of
+    all the tile servers if no URL is given. The status is one of "available",
+    "unavailable", "unknown" (if there are no tile servers or they haven't been checked
+    yet) or, for the overall status, "partial" (if some tile servers are available and
+    some aren't).
+
+    :param tileserver_url: the URL of the tile server to check, or None to check them
+        all
+    :returns: the status string
+    """
+    if tileserver_url is not None:
+        return _check_tileserver_status(tileserver_url)
 
-    tileserver_response_text = 'unknown'
+    statuses = {_check_tileserver_status(url) for url, _ in get_tile_servers()}
+    statuses.discard('unknown')
+    if not statuses:
+        return 'unknown'
+    if len(statuses) > 1:
+        return 'partial'
+    return statuses.pop()
 
-    if tileserver_url:
+
+def _check_tileserver_status(tileserver_url):
+    """
+    Returns the last known status of the given tile server. The statuses are cached
+    (the cache can be shared between processes, see get_cache) and when a status is
+    more than a minute old, or there isn't one yet, it's refreshed in a background
+    thread. This means tile servers which go down are dropped from (and ones that come
+    back are returned to) the list of available tile servers without a restart, and
+    a slow or unresponsive tile server never holds up the request for a map.
+
+    :param tileserver_url: the URL of the tile server
+    :returns: "available", "unavailable" or "unknown" if the tile server hasn't been
+        checked yet
+    """
+    entry = get_cache().get(f'tileserver:{tileserver_url}')
+    if entry is None or entry['checked'] + TILESERVER_STATUS_TTL <= time.time():
+        _refresh_tileserver_status(tileserver_url)
+    return 'unknown' if entry is None else entry['status']
+
+
+def _refresh_tileserver_status(tileserver_url):
+    """
+    Starts a background thread which requests the status endpoint of the given tile
+    server and caches the result, unless this process is already refreshing it.
+
+    :param tileserver_url: the URL of the tile server
+    """
+    with _refreshing_lock:
+        if tileserver_url in _refreshing:
+            return
+        _refreshing.add(tileserver_url)
+
+    def refresh():
         try:
-            with urllib.request.urlopen(tileserver_url + '/status') as response:
-                tileserver_response = response.read().decode()
-        except Exception as e:
-            tileserver_response = ''
-        if tileserver_response == 'OK':
-            tileserver_response_text = 'available'
-        else:
-            tileserver_response_text = 'unavailable'
+            get_cache().set(
+                f'tileserver:{tileserver_url}',
+                {
+                    'status': _request_tileserver_status(tileserver_url),
+                    'checked': time.time(),
+                },
+            )
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(tileserver_url)
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def _request_tileserver_status(tileserver_url):
+    """
+    Requests the status endpoint of the given tile server.
 
-    return tileserver_response_text
+    :param tileserver_url: the URL of the tile server
+    :returns: "available" or "unavailable"
+    """
+    try:
+        with urllib.request.urlopen(
+            tileserver_url + '/status', timeout=TILESERVER_STATUS_TIMEOUT
+        ) as response:
+            tileserver_response = response.read().decode()
+    except Exception:
+        tileserver_response = ''
+    if tileserver_response == 'OK':
+        return 'available'
+    else:
+        return 'unavailable'
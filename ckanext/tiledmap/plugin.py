@@ -8,14 +8,16 @@
 from ckan.common import json
 from ckan.plugins import SingletonPlugin, implements, interfaces, toolkit
 
-from ckanext.tiledmap import routes
+from ckanext.tiledmap import cli, routes
 from ckanext.tiledmap.config import config as plugin_config
-from ckanext.tiledmap.lib import validators
+from ckanext.tiledmap.lib import profiling, validators
+from ckanext.tiledmap.lib.countries import get_country_index
 from ckanext.tiledmap.lib.helpers import dwc_field_title, mustache_wrapper
 from ckanext.tiledmap.lib.utils import (
     get_resource_datastore_fields,
     get_tileserver_status,
 )
+from ckanext.tiledmap.routes._helpers import get_initial_map_info
 
 try:
     from ckanext.status.interfaces import IStatus
@@ -39,6 +41,7 @@ class VersionedTiledMapPlugin(SingletonPlugin):
     implements(interfaces.ITemplateHelpers)
     implements(interfaces.IResourceView, inherit=True)
     implements(interfaces.IConfigurable)
+    implements(interfaces.IClick)
     if status_available:
         implements(IStatus)
 
@@ -66,6 +69,13 @@ class VersionedTiledMapPlugin(SingletonPlugin):
     # from IConfigurable interface
     def configure(self, config):
         plugin_config.update(config)
+        profiling.check_config()
+        # build the country index now rather than on the first /map-country request
+        get_country_index()
+
+    # from IClick interface
+    def get_commands(self):
+        return cli.get_commands()
 
     # from IResourceView interface
     def info(self):
@@ -152,9 +162,15 @@ class VersionedTiledMapPlugin(SingletonPlugin):
                 continue
             view_options.append({'text': view['title'], 'value': view['id']})
 
+        def map_info_json():
+            # this is only called by the view template (not the form template) so that
+            # we don't hit the datastore when the view is being edited
+            return json.dumps(get_initial_map_info(resource_view, resource))
+
         return {
             'resource_json': json.dumps(resource),
             'resource_view_json': json.dumps(resource_view),
+            'map_info_json': map_info_json,
             'map_fields': [{'text': field, 'value': field} for field in fields],
             'available_views': view_options,
             'defaults': plugin_config,
@@ -173,6 +189,9 @@ class VersionedTiledMapPlugin(SingletonPlugin):
         elif tileserver_text == 'available':
             report_value = toolkit._('available')
             tileserver_state = 'good'
+        elif tileserver_text == 'partial':
+            report_value = toolkit._('partially available')
+            tileserver_state = 'neutral'
         else:
             report_value = toolkit._('unavailable')
             tileserver_state = 'bad'
@@ -6,14 +6,205 @@
 
 import base64
 import gzip
+import hashlib
+import importlib.metadata
 import json
+import logging
+import math
+import threading
+import time
 from collections import defaultdict
+from contextlib import contextmanager
+from types import MappingProxyType
 from urllib.parse import unquote
 
+from cachetools import LRUCache, TTLCache
 from ckan.common import json
 from ckan.plugins import toolkit
 
 from ckanext.tiledmap.config import config
+from ckanext.tiledmap.lib import renderer
+from ckanext.tiledmap.lib.cache import get_cache
+from ckanext.tiledmap.lib.cancellation import FetchSuperseded, fetch_tracker
+from ckanext.tiledmap.lib.query_store import get_query_store
+from ckanext.tiledmap.lib.utils import get_available_tile_servers
+
+log = logging.getLogger(__name__)
+
+# the tile sizes the tile server can render, the first is the default
+TILE_SIZES = (256, 512)
+# the maximum latitude that can be shown on a web mercator map
+MAX_LATITUDE = 85.0511
+# the names of the parameters each style passes to the tile server, these can be set on
+# the view (as <style>_<name>) or in the config (as
+# versioned_tilemap.style.<style>.<name>)
+STYLE_PARAMS = {
+    'heatmap': ('point_radius', 'cold_colour', 'hot_colour', 'intensity'),
+    'gridded': ('grid_resolution', 'hot_colour', 'cold_colour', 'range_size'),
+    'plot': ('point_radius', 'point_colour', 'border_width', 'border_colour'),
+}
+# the maximum number of compiled views kept, see compile_view
+COMPILED_VIEWS_SIZE = 1000
+# the number of seconds each resource's rounded version is cached for, new data appears
+# on the map after at most this long, see MapViewSettings.version
+ROUNDED_VERSION_TTL = 10
+
+
+class CompiledView:
+    """
+    The settings of a map view, resolved from the view dict, the resource and the
+    config. These are created by compile_view once per revision of a view and shared by
+    all the requests for it, so they can't be changed once created.
+    """
+
+    __slots__ = (
+        'view_id',
+        'revision',
+        'title',
+        'fields',
+        'repeat_map',
+        'overlapping_records_view',
+        'enable_utf_grid',
+        'plot_map_enabled',
+        'grid_map_enabled',
+        'heat_map_enabled',
+        'map_styles',
+        'style_params',
+        'info_template',
+        'quick_info_template',
+    )
+
+    def __init__(self, **settings):
+        for name in self.__slots__:
+            object.__setattr__(self, name, settings[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{self.__class__.__name__} is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{self.__class__.__name__} is immutable')
+
+
+# the compiled views, keyed on the view id. Only the latest revision of each view is
+# kept
+_compiled_views = LRUCache(maxsize=COMPILED_VIEWS_SIZE)
+_compiled_views_lock = threading.Lock()
+
+
+# the rounded versions, keyed on the resource id and the requested version
+_rounded_versions = TTLCache(maxsize=10000, ttl=ROUNDED_VERSION_TTL)
+_rounded_versions_lock = threading.Lock()
+
+
+# the map config for each language, see get_cached_map_config
+_map_configs = {}
+_map_configs_lock = threading.Lock()
+
+
+def get_view_revision(view, resource):
+    """
+    Returns the revision of the given view. Views don't have a revision number so this
+    is a hash of the view's settings and the resource's format (which chooses the
+    templates), which changes whenever the view is updated.
+
+    :param view: the view dict
+    :param resource: the resource dict
+    :returns: a hex string
+    """
+    encoded = json.dumps(
+        [view, resource.get('format')],
+        sort_keys=True,
+        separators=(',', ':'),
+        default=str,
+    )
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()[:16]
+
+
+def compile_view(view, resource):
+    """
+    Returns the compiled settings of the given view. The settings are compiled the first
+    time each revision of a view is seen (see get_view_revision) and reused until the
+    view is updated, at which point the new revision replaces the old one.
+
+    :param view: the view dict
+    :param resource: the resource dict
+    :returns: a CompiledView
+    """
+    revision = get_view_revision(view, resource)
+    with _compiled_views_lock:
+        compiled = _compiled_views.get(view['id'])
+    if compiled is not None and compiled.revision == revision:
+        return compiled
+
+    title = view.get('utf_grid_title')
+    fields = list(view.get('utf_grid_fields', []))
+    if title is not None and title not in fields:
+        fields.append(title)
+    enabled = {
+        'heatmap': bool(view.get('enable_heat_map', False)),
+        'gridded': bool(view.get('enable_grid_map', False)),
+        'plot': bool(view.get('enable_plot_map', False)),
+    }
+    style_params = {
+        style: MappingProxyType(
+            {
+                name: view.get(
+                    f'{style}_{name}', config[f'versioned_tilemap.style.{style}.{name}']
+                )
+                for name in names
+            }
+        )
+        for style, names in STYLE_PARAMS.items()
+        if enabled[style]
+    }
+    compiled = CompiledView(
+        view_id=view['id'],
+        revision=revision,
+        title=title,
+        fields=tuple(fields),
+        repeat_map=bool(view.get('repeat_map', False)),
+        overlapping_records_view=view.get('overlapping_records_view', None),
+        enable_utf_grid=bool(view.get('enable_utf_grid', False)),
+        plot_map_enabled=enabled['plot'],
+        grid_map_enabled=enabled['gridded'],
+        heat_map_enabled=enabled['heatmap'],
+        map_styles=tuple(style for style, is_enabled in enabled.items() if is_enabled),
+        style_params=MappingProxyType(style_params),
+        info_template=get_template_name(
+            config['versioned_tilemap.info_template'], resource
+        ),
+        quick_info_template=get_template_name(
+            config['versioned_tilemap.quick_info_template'], resource
+        ),
+    )
+    with _compiled_views_lock:
+        _compiled_views[view['id']] = compiled
+    return compiled
+
+
+def get_template_name(name, resource):
+    """
+    Returns the name of the mustache template to use for the given template name and
+    resource. If the resource has a format then this function will attempt to find a
+    format specific template.
+
+    :param name: the name of the template
+    :param resource: the resource dict
+    :returns: the template file name
+    """
+    # this is the base name of the template, if there's no format version available then we'll
+    # just return this
+    template_name = f'{name}.mustache'
+
+    resource_format = resource.get('format', None)
+    # if there is a format on the resource, attempt to find a format specific template
+    if resource_format is not None:
+        formatted_template_name = f'{name}.{resource_format.lower()}.mustache'
+        paths = config['computed_template_paths']
+        if any(path for path in paths if path.endswith(formatted_template_name)):
+            template_name = formatted_template_name
+
+    return template_name
 
 
 class MapViewSettings:
@@ -21,53 +212,147 @@ class MapViewSettings:
     Class that holds settings and functions used to build the map-info response.
     """
 
-    def __init__(self, fetch_id, view, resource):
+    def __init__(
+        self,
+        fetch_id,
+        view,
+        resource,
+        q=None,
+        filters=None,
+        version=None,
+        client_id=None,
+        context=None,
+    ):
         """
         :param fetch_id: the id of the request, as provided by the javascript module. This is used
                          to keep track on the javascript side of the order map-info requests.
         :param view: the view dict
         :param resource: the resource dict
+        :param q: the full text query to filter the records by, or None
+        :param filters: a dict of field names to lists of values to filter the records
+                        by, or None
+        :param version: the datastore version to show the records at, or None to show
+                        the resource's current version
+        :param client_id: the id of the javascript module making the request, if this
+                          is provided then the work is abandoned if the same client
+                          makes a newer request for the same view (see
+                          check_superseded)
+        :param context: the context to call the actions which read the records with,
+                        e.g. {'ignore_auth': True} to read them whatever the current
+                        user can see. Defaults to the current user's context
         """
         self.fetch_id = fetch_id
         self.view = view
         self.resource = resource
         self.view_id = view['id']
         self.resource_id = resource['id']
+        # the view's settings, resolved once per revision of the view
+        self.compiled = compile_view(view, resource)
+        # canonicalise the query so that logically identical queries produce identical
+        # query bodies (and therefore identical tile URLs)
+        self.q = canonicalise_q(q)
+        self.filters = canonicalise_filters(filters)
+        self.requested_version = version
+        self.client_id = client_id
+        self.context = context or {}
+        # the version is resolved the first time it's needed, see the version property
+        self._version = None
+        self._version_resolved = False
+        # the number of seconds each stage of create_map_info took and the size of the
+        # query body it created
+        self.timings = {}
+        self.query_body_size = None
+
+    @property
+    def version(self):
+        """
+        The datastore version the map's queries are pinned to. This is the requested
+        version rounded down to the version of the resource's data that was current at
+        that time, or the resource's current version if no version was requested. It's
+        only resolved once so that the query body and the extent are always for the same
+        version of the data, and the rounded versions are cached for
+        ROUNDED_VERSION_TTL seconds so that every request doesn't need a datastore
+        action. This is None if the resource has no data.
+        """
+        if not self._version_resolved:
+            key = (self.resource_id, self.requested_version)
+            with _rounded_versions_lock:
+                cached = _rounded_versions.get(key)
+            if cached is None:
+                version = toolkit.get_action('datastore_get_rounded_version')(
+                    self._context(),
+                    {
+                        'resource_id': self.resource_id,
+                        'version': self.requested_version,
+                    },
+                )
+                # the version is wrapped so that resources with no data are cached too
+                cached = (version,)
+                with _rounded_versions_lock:
+                    _rounded_versions[key] = cached
+            (self._version,) = cached
+            self._version_resolved = True
+        return self._version
+
+    def _context(self):
+        """
+        Returns a copy of the context to call actions with, as actions add to the
+        context they're given.
+
+        :returns: a dict
+        """
+        return dict(self.context)
+
+    @property
+    def is_public(self):
+        """
+        Whether anyone can see the resource's records, i.e. its dataset isn't private.
+        Responses for resources which aren't public mustn't be stored by shared caches.
+        """
+        package = toolkit.get_action('package_show')(
+            self._context(), {'id': self.resource['package_id']}
+        )
+        return not package.get('private', False)
 
     @property
     def title(self):
-        return self.view['utf_grid_title']
+        return self.compiled.title
 
     @property
     def fields(self):
-        info_fields = list(self.view.get('utf_grid_fields', []))
-        if self.title not in info_fields:
-            info_fields.append(self.title)
-        return info_fields
+        return self.compiled.fields
 
     @property
     def repeat_map(self):
-        return bool(self.view.get('repeat_map', False))
+        return self.compiled.repeat_map
 
     @property
     def overlapping_records_view(self):
-        return self.view.get('overlapping_records_view', None)
+        return self.compiled.overlapping_records_view
 
     @property
     def enable_utf_grid(self):
-        return bool(self.view.get('enable_utf_grid', False))
+        return self.compiled.enable_utf_grid
 
     @property
     def plot_map_enabled(self):
-        return bool(self.view.get('enable_plot_map', False))
+        return self.compiled.plot_map_enabled
 
     @property
     def grid_map_enabled(self):
-        return bool(self.view.get('enable_grid_map', False))
+        return self.compiled.grid_map_enabled
 
     @property
     def heat_map_enabled(self):
-        return bool(self.view.get('enable_heat_map', False))
+        return self.compiled.heat_map_enabled
+
+    @property
+    def map_styles(self):
+        """
+        The names of the map styles enabled on this view, in the same order as they
+        appear in the map info.
+        """
+        return list(self.compiled.map_styles)
 
     def is_enabled(self):
         """
@@ -78,38 +363,14 @@ class MapViewSettings:
         """
         return self.plot_map_enabled or self.grid_map_enabled or self.heat_map_enabled
 
-    def _render_template(self, name, extra_vars):
-        """
-        Render the given mustache template using the given variables. If the resource
-        this view is attached to has a format then this function will attempt to find a
-        format appropriate function.
-
-        :param name: the name of the template
-        :param extra_vars: a dict of variables to pass to the template renderer
-        :returns: a rendered template
-        """
-        # this is the base name of the template, if there's no format version available then we'll
-        # just return this
-        template_name = f'{name}.mustache'
-
-        resource_format = self.resource.get('format', None)
-        # if there is a format on the resource, attempt to find a format specific template
-        if resource_format is not None:
-            formatted_template_name = f'{name}.{resource_format.lower()}.mustache'
-            paths = config['computed_template_paths']
-            if any(path for path in paths if path.endswith(formatted_template_name)):
-                template_name = formatted_template_name
-
-        return toolkit.render(template_name, extra_vars)
-
     def render_info_template(self):
         """
         Renders the point info template and returns the result.
 
         :returns: the rendered point info template
         """
-        return self._render_template(
-            config['versioned_tilemap.info_template'],
+        return toolkit.render(
+            self.compiled.info_template,
             {
                 'title': self.title,
                 'fields': self.fields,
@@ -123,36 +384,55 @@ class MapViewSettings:
 
         :returns: the rendered point hover info template
         """
-        return self._render_template(
-            config['versioned_tilemap.quick_info_template'],
+        return toolkit.render(
+            self.compiled.quick_info_template,
             {
                 'title': self.title,
                 'fields': self.fields,
             },
         )
 
-    def get_style_params(self, style, names):
+    @contextmanager
+    def _timed(self, stage):
         """
-        Returns a dict of style params for the given style. The parameters are retrieved
-        from the user defined settings on the view and if they're missing then they're
-        retrieved from the config object.
+        Context manager which records the time taken by the code in it under the given
+        stage name in the timings dict.
+
+        :param stage: the name of the stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = time.perf_counter() - start
+
+    def check_superseded(self):
+        """
+        Checks whether the client has made a newer request for this view since this one
+        and if so, raises FetchSuperseded. This is called between the expensive stages
+        of creating the map info so that work the client is going to throw away is
+        abandoned.
+
+        :raises FetchSuperseded: if there is a newer request
+        """
+        if self.client_id is not None and fetch_tracker.is_superseded(
+            self.client_id, self.view_id, self.fetch_id
+        ):
+            raise FetchSuperseded(self.fetch_id)
+
+    def get_style_params(self, style):
+        """
+        Returns a dict of style params for the given style, see compile_view.
 
         :param style: the name of the style (plot, gridded or heatmap)
-        :param names: the names of the parameters to retrieve, these are also used as
-            the names in the dict that the parameter values are stored under
         :returns: a dict
         """
-        params = {}
-        for name in names:
-            view_param_name = f'{style}_{name}'
-            config_param_name = f'versioned_tilemap.style.{style}.{name}'
-            params[name] = self.view.get(view_param_name, config[config_param_name])
-        return params
+        return dict(self.compiled.style_params[style])
 
     def get_extent_info(self):
         """
-        Retrieves the extent information about the datastore query provided by the
-        parameters in the request. The return value is a 3-tuple containing:
+        Retrieves the extent information about the datastore query defined by the q and
+        filters on this object. The return value is a 3-tuple containing:
 
             - the total number of records in the query result
             - the total number of records in the query result that have geometric data (specifically
@@ -162,25 +442,50 @@ class MapViewSettings:
               (e.g. [[0, 4], [70, 71]]). This is how it is returned by the datastore_query_extent
               action.
 
+        The extent is pinned to the same version as the map (see the version property)
+        so it's cached per query and version, which also means prefetched map info
+        requests (see the versioned_tilemap.prefetch.enabled option) make the real request
+        fast.
+
         :returns: a 3-tuple - (int, int, list)
         """
-        q, filters = extract_q_and_filters()
+        cache = get_cache()
+        key = 'extent:' + self._cache_key()
+        extent = cache.get(key)
+        if extent is not None:
+            return tuple(extent)
+
         # get query extent and counts
         extent_info = toolkit.get_action('datastore_query_extent')(
-            {},
+            self._context(),
             {
                 'resource_id': self.resource_id,
-                'q': q,
-                'filters': filters,
+                'q': self.q,
+                'filters': self.filters,
+                'version': self.version,
             },
         )
         # total_count and geom_count will definitely be present, bounds on the other hand is an
         # optional part of the response
-        return (
+        extent = (
             extent_info['total_count'],
             extent_info['geom_count'],
             extent_info.get('bounds', ((83, -170), (-83, 170))),
         )
+        cache.set(key, extent)
+        return extent
+
+    def _cache_key(self):
+        """
+        Returns a string identifying the query on this object, for use in cache keys.
+
+        :returns: a str
+        """
+        return json.dumps(
+            [self.resource_id, self.version, self.q, self.filters],
+            sort_keys=True,
+            separators=(',', ':'),
+        )
 
     def get_query_body(self):
         """
@@ -200,61 +505,132 @@ class MapViewSettings:
             - the query body is then sent along with all tile requests to the tile server, which
               decompresses it and uses it to search elasticsearch
 
+        The query is pinned to a specific datastore version (see the version property)
+        and the JSON is serialised with sorted keys and no whitespace and the gzip header
+        doesn't include a timestamp so that the same query always produces exactly the
+        same query body. This means tiles for a query body never change and can be
+        cached indefinitely, when new data is added the query body changes instead. For
+        the same reason the query body is cached per query and version.
+
         :returns: a url safe base64 encoded, gzipped, JSON string
         """
-        q, filters = extract_q_and_filters()
+        cache = get_cache()
+        key = 'query-body:' + self._cache_key()
+        query_body = cache.get(key)
+        if query_body is not None:
+            return query_body.encode('ascii')
+
         result = toolkit.get_action('datastore_search')(
-            {},
+            self._context(),
             {
                 'resource_id': self.resource_id,
-                'q': q,
-                'filters': filters,
+                'q': self.q,
+                'filters': self.filters,
+                'version': self.version,
                 'run_query': False,
             },
         )
-        return base64.urlsafe_b64encode(
-            gzip.compress(json.dumps(result).encode('utf-8'))
+        encoded = json.dumps(result, sort_keys=True, separators=(',', ':'))
+        query_body = base64.urlsafe_b64encode(
+            gzip.compress(encoded.encode('utf-8'), mtime=0)
+        )
+        cache.set(key, query_body.decode('ascii'))
+        return query_body
+
+    def create_extent_info(self):
+        """
+        Creates the part of the /map-info response dict that depends on the extent of
+        the query, i.e. the counts, the bounds and the style schedule. Getting the
+        extent is usually the slowest part of creating the map info so this is also
+        available separately through the /map-extent endpoint, see create_map_info.
+
+        :returns: a dict
+        :raises FetchSuperseded: if the client has made a newer request
+        """
+        self.check_superseded()
+        with self._timed('extent'):
+            total_count, geom_count, bounds = self.get_extent_info()
+        # tell the client the zoom levels at which each style can be rendered at a
+        # reasonable cost given the number of records we're going to be plotting
+        style_schedule = get_style_schedule(
+            self.map_styles,
+            geom_count,
+            bounds,
+            {
+                'min': int(config['versioned_tilemap.zoom_bounds.min']),
+                'max': int(config['versioned_tilemap.zoom_bounds.max']),
+            },
+            get_tile_options()['zoom_offset'],
         )
+        return {
+            'fetch_id': self.fetch_id,
+            'total_count': total_count,
+            'geom_count': geom_count,
+            'bounds': bounds,
+            'style_schedule': style_schedule,
+        }
 
-    def create_map_info(self):
+    def create_map_info(self, deferred=False):
         """
         Using the settings available on this object, create the /map-info response dict
         and return it.
 
+        If deferred is True, the extent info (see create_extent_info) is left out of the
+        response and extent_deferred is set to True. The tiles only need the query body
+        and the style parameters so the client can start loading them straight away and
+        request the extent info separately.
+
+        :param deferred: whether to leave the extent info out of the response
         :returns: a dict
+        :raises FetchSuperseded: if the client has made a newer request
         """
         # get the standard map info dict (this provides a fresh one each time it's called)
-        map_info = get_base_map_info()
+        with self._timed('base_map_info'):
+            map_info = get_base_map_info()
 
-        # add the base64 encoded, gzipped, JSON query
-        map_info['query_body'] = self.get_query_body()
+        # add the base64 encoded, gzipped, JSON query, or a reference to it if we're
+        # storing queries for the tile server to look up
+        with self._timed('query_body'):
+            query_body = self.get_query_body()
+            self.query_body_size = len(query_body)
+            query_store = get_query_store()
+            if query_store is None:
+                map_info['query_body'] = query_body
+            else:
+                map_info['query_ref'] = query_store.put(query_body)
 
-        # add the extent data
-        total_count, geom_count, bounds = self.get_extent_info()
-        map_info['total_count'] = total_count
-        map_info['geom_count'] = geom_count
-        map_info['bounds'] = bounds
+        # add the extent data, unless the client is going to request it separately
+        if deferred:
+            map_info['extent_deferred'] = True
+            # the tiles start loading before the extent is known so use the styles
+            # which are cheap to render at any zoom level until it is
+            map_info['style_schedule'] = get_deferred_style_schedule(
+                self.map_styles, int(config['versioned_tilemap.zoom_bounds.min'])
+            )
+        else:
+            map_info.update(self.create_extent_info())
 
         # add a few basic settings
+        map_info['version'] = self.version
         map_info['repeat_map'] = self.repeat_map
         map_info['fetch_id'] = self.fetch_id
-        map_info['plugin_options']['tooltipInfo'] = {
-            'count_field': 'count',
-            'template': self.render_quick_info_template(),
-        }
-        map_info['plugin_options']['pointInfo'] = {
-            'count_field': 'count',
-            'template': self.render_info_template(),
-        }
+        self.check_superseded()
+        with self._timed('templates'):
+            map_info['plugin_options']['tooltipInfo'] = {
+                'count_field': 'count',
+                'template': self.render_quick_info_template(),
+            }
+            map_info['plugin_options']['pointInfo'] = {
+                'count_field': 'count',
+                'template': self.render_info_template(),
+            }
 
         # remove or augment the heatmap settings depending on whether it's enabled for this view
         if not self.heat_map_enabled:
             del map_info['map_styles']['heatmap']
         else:
-            params = self.get_style_params(
-                'heatmap', ['point_radius', 'cold_colour', 'hot_colour', 'intensity']
-            )
-            map_info['map_styles']['heatmap']['tile_source']['params'] = params
+            params = self.get_style_params('heatmap')
+            map_info['map_styles']['heatmap']['tile_source']['params'].update(params)
             map_info['map_style'] = 'heatmap'
 
         # remove or augment the gridded settings depending on whether it's enabled for this view
@@ -262,11 +638,8 @@ class MapViewSettings:
             del map_info['map_styles']['gridded']
         else:
             map_info['map_styles']['gridded']['has_grid'] = self.enable_utf_grid
-            params = self.get_style_params(
-                'gridded',
-                ['grid_resolution', 'hot_colour', 'cold_colour', 'range_size'],
-            )
-            map_info['map_styles']['gridded']['tile_source']['params'] = params
+            params = self.get_style_params('gridded')
+            map_info['map_styles']['gridded']['tile_source']['params'].update(params)
             map_info['map_style'] = 'gridded'
 
         # remove or augment the plot settings depending on whether it's enabled for this view
@@ -274,15 +647,273 @@ class MapViewSettings:
             del map_info['map_styles']['plot']
         else:
             map_info['map_styles']['plot']['has_grid'] = self.enable_utf_grid
-            params = self.get_style_params(
-                'plot',
-                ['point_radius', 'point_colour', 'border_width', 'border_colour'],
-            )
-            map_info['map_styles']['plot']['tile_source']['params'] = params
+            params = self.get_style_params('plot')
+            map_info['map_styles']['plot']['tile_source']['params'].update(params)
             map_info['map_style'] = 'plot'
 
+        # include the version in the tile URLs too, the query body is already specific to
+        # the version but this makes it easy for the tile server and any caches in front
+        # of it to see that the tiles are for a fixed version of the data
+        if self.version is not None:
+            for style in map_info['map_styles'].values():
+                for source in ('tile_source', 'grid_source'):
+                    if source in style:
+                        style[source]['params']['version'] = self.version
+
+        # the built in renderer checks the user can read the resource before searching
+        # it, so tell it which resource and view the tiles are for
+        if renderer.is_enabled():
+            for style in map_info['map_styles'].values():
+                for source in ('tile_source', 'grid_source'):
+                    if source in style:
+                        style[source]['params']['resource_id'] = self.resource_id
+                        style[source]['params']['view_id'] = self.view_id
+
         return map_info
 
+    def get_records(self, geo_filter, after=None, limit=None):
+        """
+        Returns a page of the records at a location on the map which match the q and
+        filters on this object. The location is given as a GeoJSON geometry, as found in
+        the geo_filter of the map's UTF grid data. If there's a __geo__ filter (i.e. the
+        user has drawn an area on the map) the records must be in both the area and the
+        location, as grid cells can extend past the area. Only the _id and the fields
+        shown in the point info are included in the records.
+
+        The records are pinned to the same version as the map (see the version
+        property) so the pages never change and are cached per location, query and
+        version.
+
+        :param geo_filter: the GeoJSON geometry string of the location
+        :param after: the cursor returned with the previous page, or None for the first
+            page
+        :param limit: the maximum number of records to return, defaults to the
+            versioned_tilemap.records.page_size option
+        :returns: a dict containing the total number of records at the location, the
+            page of records and the cursor for the next page (None on the last page)
+        """
+        if limit is None:
+            limit = int(config['versioned_tilemap.records.page_size'])
+        filters = dict(self.filters or {})
+        # the areas the user has drawn, the location replaces them in the filters
+        areas = filters.pop('__geo__', None)
+        filters['__geo__'] = [geo_filter]
+        filters = canonicalise_filters(filters)
+        if areas:
+            areas = canonicalise_filters({'__geo__': areas})['__geo__']
+        fields = ['_id'] + [field for field in self.fields if field != '_id']
+
+        cache = get_cache()
+        key = 'records:' + json.dumps(
+            [
+                self.resource_id,
+                self.version,
+                self.q,
+                filters,
+                areas,
+                fields,
+                after,
+                limit,
+            ],
+            sort_keys=True,
+            separators=(',', ':'),
+        )
+        page = cache.get(key)
+        if page is not None:
+            return page
+
+        if areas:
+            page = self._search_records_in_areas(filters, areas, fields, after, limit)
+        else:
+            result = toolkit.get_action('datastore_search')(
+                self._context(),
+                {
+                    'resource_id': self.resource_id,
+                    'q': self.q,
+                    'filters': filters,
+                    'version': self.version,
+                    'fields': fields,
+                    'limit': limit,
+                    'after': after,
+                },
+            )
+            records = result['records']
+            page = {
+                'total': result['total'],
+                'records': records,
+                # a short page means there aren't any more records
+                'after': result.get('after') if len(records) == limit else None,
+            }
+        cache.set(key, page)
+        return page
+
+    def _search_records_in_areas(self, filters, areas, fields, after, limit):
+        """
+        Searches for a page of the records which match the given filters (including
+        the location's __geo__ filter) and are in one of the given areas. The location
+        and the areas are separate __geo__ filters which must both match, so the
+        datastore builds the query for each of them and they're combined here.
+
+        :param filters: the filters, including the location's __geo__ filter
+        :param areas: the GeoJSON geometry strings of the areas
+        :param fields: the fields to include in the records
+        :param after: the cursor returned with the previous page, or None
+        :param limit: the maximum number of records to return
+        :returns: a page dict, see get_records
+        """
+        queries = []
+        for q, query_filters in ((self.q, filters), (None, {'__geo__': areas})):
+            query = toolkit.get_action('datastore_search')(
+                self._context(),
+                {
+                    'resource_id': self.resource_id,
+                    'q': q,
+                    'filters': query_filters,
+                    'version': self.version,
+                    'run_query': False,
+                },
+            )
+            queries.append(query['search'].get('query', {'match_all': {}}))
+        search = {
+            'size': limit,
+            'query': {'bool': {'must': queries}},
+            'sort': [{'data._id': 'asc'}],
+            '_source': [f'data.{field}' for field in fields],
+        }
+        if after is not None:
+            search['search_after'] = after
+        result = toolkit.get_action('datastore_search_raw')(
+            self._context(),
+            {
+                'resource_id': self.resource_id,
+                'search': search,
+                'raw_result': True,
+                # the version filter is already in the queries
+                'include_version': False,
+            },
+        )
+        hits = result['hits']['hits']
+        total = result['hits']['total']
+        return {
+            # newer versions of Elasticsearch return the total as a dict
+            'total': total['value'] if isinstance(total, dict) else total,
+            'records': [hit['_source'].get('data', {}) for hit in hits],
+            'after': hits[-1]['sort'] if len(hits) == limit else None,
+        }
+
+    def get_aggregate(self, bounds, zoom, grid_resolution):
+        """
+        Returns the number of records which match the q and filters on this object in
+        each cell of a grid over the given bounds. The cells are the same as the
+        gridded style's, i.e. grid_resolution pixels square at the given zoom level, so
+        the whole viewport can be drawn from one response instead of a PNG and UTF grid
+        tile for every tile in view. The cells are counted by Elasticsearch using a
+        geotile_grid aggregation and the response is cached per query, version and cell
+        range. The cells must line up with Elasticsearch's geotiles so the
+        grid_resolution must be a power of two no bigger than a tile.
+
+        If the viewport covers more than versioned_tilemap.aggregate.max_cells cells,
+        the cells are doubled in size until it doesn't. The grid_resolution in the
+        returned dict is the one the counts are for.
+
+        :param bounds: the north, west, south and east bounds of the viewport
+        :param zoom: the map's zoom level
+        :param grid_resolution: the width and height of the cells in pixels
+        :returns: a dict of the counts, see encode_aggregate
+        :raises ValueError: if the viewport covers more than
+            versioned_tilemap.aggregate.max_cells cells even when each cell is a whole
+            tile
+        """
+        max_cells = int(config['versioned_tilemap.aggregate.max_cells'])
+        while True:
+            _, cell_range = get_cell_range(bounds, zoom, grid_resolution)
+            first_column, first_row, last_column, last_row = cell_range
+            cell_count = (last_column - first_column) * (last_row - first_row)
+            if cell_count <= max_cells:
+                break
+            if grid_resolution >= TILE_SIZES[0]:
+                raise ValueError(f'Too many cells ({cell_count})')
+            grid_resolution = min(grid_resolution * 2, TILE_SIZES[0])
+
+        cache = get_cache()
+        key = 'aggregate:' + json.dumps(
+            [
+                self.resource_id,
+                self.version,
+                self.q,
+                self.filters,
+                zoom,
+                grid_resolution,
+                cell_range,
+            ],
+            sort_keys=True,
+            separators=(',', ':'),
+        )
+        aggregate = cache.get(key)
+        if aggregate is not None:
+            return aggregate
+
+        counts = {}
+        if cell_count > 0:
+            # get the query for the q and filters, this is already pinned to the version
+            query = toolkit.get_action('datastore_search')(
+                self._context(),
+                {
+                    'resource_id': self.resource_id,
+                    'q': self.q,
+                    'filters': self.filters,
+                    'version': self.version,
+                    'run_query': False,
+                },
+            )
+            north, west, south, east = bounds
+            search = {
+                'size': 0,
+                'query': {
+                    'bool': {
+                        'must': [query['search'].get('query', {'match_all': {}})],
+                        'filter': [
+                            {
+                                'geo_bounding_box': {
+                                    'meta.geo': {
+                                        'top_left': {'lat': north, 'lon': west},
+                                        'bottom_right': {'lat': south, 'lon': east},
+                                    }
+                                }
+                            }
+                        ],
+                    }
+                },
+                'aggs': {
+                    'cells': {
+                        'geotile_grid': {
+                            'field': 'meta.geo',
+                            # each tile at this precision is one of our cells
+                            'precision': get_geotile_precision(zoom, grid_resolution),
+                            'size': cell_count,
+                        }
+                    }
+                },
+            }
+            result = toolkit.get_action('datastore_search_raw')(
+                self._context(),
+                {
+                    'resource_id': self.resource_id,
+                    'search': search,
+                    'raw_result': True,
+                    # the version filter is already in the query
+                    'include_version': False,
+                },
+            )
+            for bucket in result['aggregations']['cells']['buckets']:
+                # the keys are zoom/x/y
+                _, column, row = map(int, bucket['key'].split('/'))
+                counts[(column, row)] = bucket['doc_count']
+
+        aggregate = encode_aggregate(counts, zoom, grid_resolution, cell_range)
+        cache.set(key, aggregate)
+        return aggregate
+
     @classmethod
     def from_request(cls):
         """
@@ -314,10 +945,53 @@ class MapViewSettings:
         except toolkit.NotAuthorized:
             return toolkit.abort(401, toolkit._('Unauthorized to read resource view'))
 
-        fetch_id = int(toolkit.request.params.get('fetch_id'))
+        fetch_id = int(toolkit.request.params.get('fetch_id', 0))
+        q, filters = extract_q_and_filters()
+        try:
+            version = extract_version()
+        except ValueError:
+            return toolkit.abort(400, toolkit._('Invalid version'))
+
+        # record the fetch so that any older requests from the same client still being
+        # worked on can be abandoned
+        client_id = toolkit.request.params.get('client_id', None)
+        if client_id:
+            fetch_tracker.start(client_id, view_id, fetch_id)
 
         # create a settings object, ready for use in the map_info call
-        return cls(fetch_id, view, resource)
+        return cls(fetch_id, view, resource, q, filters, version, client_id or None)
+
+
+def get_initial_map_info(view, resource):
+    """
+    Creates the map info for the given view using the q and filters in the current
+    request, if there are any. This is embedded in the map view page so that the map can
+    be drawn without having to request /map-info first. The q and filters used are
+    included in the returned dict so that the javascript can check they match the ones
+    it would have requested.
+
+    :param view: the view dict
+    :param resource: the resource dict
+    :returns: a dict, or None if the map info couldn't be created
+    """
+    q, filters = extract_q_and_filters()
+    try:
+        version = extract_version()
+    except ValueError:
+        # the javascript will request the map info itself and report the error
+        return None
+    view_settings = MapViewSettings(0, view, resource, q, filters, version)
+    if not view_settings.is_enabled():
+        return {'geospatial': False}
+    try:
+        map_info = view_settings.create_map_info()
+    except Exception:
+        # the javascript will request the map info itself and deal with any errors
+        log.exception(f'Failed to create the initial map info for view {view["id"]}')
+        return None
+    map_info['q'] = view_settings.q
+    map_info['filters'] = view_settings.filters
+    return map_info
 
 
 def build_url(*parts):
@@ -359,26 +1033,312 @@ def extract_q_and_filters():
     return q, filters
 
 
-def get_base_map_info():
+def extract_version():
     """
-    Creates the base map info dict of settings. All of the settings in this dict are
-    static in that they will be the same for all map views created on the currently
-    running CKAN instance (they use either always static values or ones that are pulled
-    from the config which can are set on boot).
+    Extract the version query string parameter from the request.
 
-    A few settings are missing, these are set in MapViewSettings.create_map_info as they
-    require custom per-map settings that the user has control over or are dependant on
-    the target resource.
+    :returns: the version as an int, or None if there isn't one
+    :raises ValueError: if the version isn't an integer
+    """
+    version = toolkit.request.params.get('version', None)
+    return None if version in (None, '') else int(version)
 
-    :returns: a dict of settings
+
+def canonicalise_q(q):
+    """
+    Returns the canonical form of the given full text query. Leading, trailing and
+    repeated whitespace is removed and empty queries are treated as no query.
+
+    :param q: the query string, or None
+    :returns: the canonical query string, or None
+    """
+    if q is None:
+        return None
+    q = ' '.join(q.split())
+    return q if q else None
+
+
+def canonicalise_filters(filters):
+    """
+    Returns the canonical form of the given filters. The fields are sorted by name and
+    the values of each field are deduplicated and sorted, as the datastore treats the
+    values as a set. Geometry filters are re-serialised with sorted keys and no
+    whitespace.
+
+    :param filters: a dict of field names to lists of values, or None
+    :returns: a dict of field names to sorted lists of values, or None if there are no
+        filters
+    """
+    if not filters:
+        return None
+    canonical = {}
+    for field in sorted(filters):
+        values = set(filters[field])
+        if field == '__geo__':
+            values = {_canonicalise_geometry(value) for value in values}
+        canonical[field] = sorted(values)
+    return canonical
+
+
+def _canonicalise_geometry(value):
+    """
+    Re-serialises the given GeoJSON geometry string with sorted keys and no whitespace.
+    Invalid JSON is returned as is so that the datastore can report the error.
+
+    :param value: the geometry string
+    :returns: the canonical geometry string
     """
-    png_url = build_url(config['versioned_tilemap.tile_server'], '/{z}/{x}/{y}.png')
-    utf_grid_url = build_url(
-        config['versioned_tilemap.tile_server'], '/{z}/{x}/{y}.grid.json'
+    try:
+        geometry = json.loads(value)
+    except ValueError:
+        return value
+    return json.dumps(geometry, sort_keys=True, separators=(',', ':'))
+
+
+def get_tile_options():
+    """
+    Returns the tile size options from the config. Tiles are either 256 or 512 pixels
+    square, the zoom offset is the number of zoom levels the tile URLs are shifted by to
+    cover the same area with tiles of this size (i.e. a 512 pixel tile at zoom level 4
+    covers the same area as four 256 pixel tiles at zoom level 5).
+
+    :returns: a dict
+    """
+    tile_size = int(config['versioned_tilemap.tile_size'])
+    if tile_size not in TILE_SIZES:
+        raise ValueError(
+            f'versioned_tilemap.tile_size must be one of {TILE_SIZES}, got {tile_size}'
+        )
+    return {
+        'tile_size': tile_size,
+        'zoom_offset': -int(math.log2(tile_size // TILE_SIZES[0])),
+        'detect_retina': toolkit.asbool(config['versioned_tilemap.detect_retina']),
+    }
+
+
+def estimate_tile_count(bounds, zoom):
+    """
+    Estimates the number of tiles needed to cover the given bounds at the given zoom
+    level.
+
+    :param bounds: the bounds as a pair of latitude, longitude pairs, as returned by
+        get_extent_info
+    :param zoom: the zoom level of the tiles
+    :returns: the number of tiles, always at least 1
+    """
+
+    def mercator_y(lat):
+        # clamp to the latitudes the web mercator projection can represent
+        lat = math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, lat)))
+        return (1 - math.log(math.tan(lat) + 1 / math.cos(lat)) / math.pi) / 2
+
+    (lat_1, lng_1), (lat_2, lng_2) = bounds
+    width = min(abs(lng_2 - lng_1) / 360, 1)
+    height = abs(mercator_y(lat_1) - mercator_y(lat_2))
+    tiles_per_side = 2 ** max(zoom, 0)
+    return max(1, math.ceil(width * tiles_per_side)) * max(
+        1, math.ceil(height * tiles_per_side)
+    )
+
+
+def get_cell_range(bounds, zoom, grid_resolution):
+    """
+    Works out which cells of the grid covering the world at the given zoom level the
+    given bounds cover. The bounds are clamped to the world.
+
+    :param bounds: the north, west, south and east bounds
+    :param zoom: the zoom level
+    :param grid_resolution: the width and height of the cells in pixels
+    :returns: a 2-tuple of the number of cells across the world and a 4-tuple of the
+        first column, first row, last column and last row covered (the last column
+        and row are exclusive)
+    """
+    columns = math.ceil(TILE_SIZES[0] * 2**zoom / grid_resolution)
+
+    def column(lng):
+        lng = max(-180, min(180, lng))
+        return (lng + 180) / 360 * columns
+
+    def row(lat):
+        lat = math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, lat)))
+        return (1 - math.log(math.tan(lat) + 1 / math.cos(lat)) / math.pi) / 2 * columns
+
+    north, west, south, east = bounds
+    return columns, (
+        max(0, math.floor(column(west))),
+        max(0, math.floor(row(north))),
+        min(columns, max(0, math.ceil(column(east)))),
+        min(columns, max(0, math.ceil(row(south)))),
     )
 
+
+def get_geotile_precision(zoom, grid_resolution):
+    """
+    Returns the precision of the Elasticsearch geotiles which are the cells of the grid
+    at the given zoom level, e.g. at 8 pixels a cell is a 32nd of a tile so the
+    precision is zoom + 5.
+
+    :param zoom: the zoom level
+    :param grid_resolution: the width and height of the cells in pixels, a power of two
+        no bigger than a tile
+    :returns: the precision
+    :raises ValueError: if the grid resolution isn't a power of two no bigger than a
+        tile
+    """
+    if not is_geotile_resolution(grid_resolution):
+        raise ValueError(f'Invalid grid resolution ({grid_resolution})')
+    return zoom + (TILE_SIZES[0] // grid_resolution).bit_length() - 1
+
+
+def is_geotile_resolution(grid_resolution):
+    """
+    Returns True if cells of the given size line up with Elasticsearch's geotiles, i.e.
+    the size is a power of two no bigger than a tile.
+
+    :param grid_resolution: the width and height of the cells in pixels
+    :returns: True or False
+    """
+    return (
+        0 < grid_resolution <= TILE_SIZES[0]
+        and grid_resolution & (grid_resolution - 1) == 0
+    )
+
+
+def encode_aggregate(counts, zoom, grid_resolution, cell_range):
+    """
+    Encodes the given cell counts compactly. The cells are numbered across each row of
+    the cell range from the top left (i.e. (row - first_row) * width + column -
+    first_column) and the response lists the numbers of the cells which contain
+    records in ascending order, each as the difference from the previous one, and their
+    counts in the same order. This keeps the numbers small and the response is easily
+    decoded into a typed array.
+
+    :param counts: a dict of (column, row) tuples to counts
+    :param zoom: the zoom level
+    :param grid_resolution: the width and height of the cells in pixels
+    :param cell_range: the first column, first row, last column and last row covered
+        by the counts, as returned by get_cell_range
+    :returns: a dict
+    """
+    first_column, first_row, last_column, last_row = cell_range
+    width = last_column - first_column
+    cells = sorted(
+        ((row - first_row) * width + column - first_column, count)
+        for (column, row), count in counts.items()
+        if first_column <= column < last_column and first_row <= row < last_row
+    )
+    deltas = []
+    previous = 0
+    for cell, _ in cells:
+        deltas.append(cell - previous)
+        previous = cell
+    values = [count for _, count in cells]
     return {
-        'geospatial': True,
+        'zoom': zoom,
+        'grid_resolution': grid_resolution,
+        'origin': [first_column, first_row],
+        'size': [width, last_row - first_row],
+        'cells': deltas,
+        'counts': values,
+        'max': max(values, default=0),
+    }
+
+
+def get_style_schedule(styles, geom_count, bounds, zoom_bounds, zoom_offset=0):
+    """
+    Works out the lowest zoom level at which each of the given styles can be used. Each
+    style can have a maximum number of records per tile set in the config (under
+    versioned_tilemap.style.<style>.max_tile_count), styles without one can be used at
+    any zoom level. The number of records per tile is estimated by assuming the records
+    are spread evenly across the tiles covering the bounds of the query.
+
+    :param styles: the names of the styles
+    :param geom_count: the number of records with geometric data in the query
+    :param bounds: the bounds of the records in the query
+    :param zoom_bounds: a dict containing the min and max zoom levels of the map
+    :param zoom_offset: the difference between the map zoom and the tile zoom
+    :returns: a dict of style names to the lowest zoom level the style can be used at,
+        or None if it can't be used at any zoom level
+    """
+    zoom_levels = range(zoom_bounds['min'], zoom_bounds['max'] + 1)
+    schedule = {}
+    for style in styles:
+        max_tile_count = config.get(f'versioned_tilemap.style.{style}.max_tile_count')
+        if max_tile_count in (None, ''):
+            schedule[style] = zoom_bounds['min']
+            continue
+        schedule[style] = next(
+            (
+                zoom
+                for zoom in zoom_levels
+                if geom_count / estimate_tile_count(bounds, zoom + zoom_offset)
+                <= int(max_tile_count)
+            ),
+            None,
+        )
+    return schedule
+
+
+def get_deferred_style_schedule(styles, min_zoom):
+    """
+    Creates the style schedule to use until the extent of the query is known (see
+    MapViewSettings.create_map_info). Without the extent the number of records per tile
+    can't be estimated, so the styles with a maximum number of records per tile aren't
+    available at any zoom level. If all of the styles have a maximum, the coarsest
+    (heatmap, then gridded, then plot) is made available so that the map still shows
+    something.
+
+    :param styles: the names of the styles
+    :param min_zoom: the lowest zoom level of the map
+    :returns: a dict of style names to the lowest zoom level the style can be used at,
+        or None if it can't be used at any zoom level
+    """
+    schedule = {
+        style: (
+            min_zoom
+            if config.get(f'versioned_tilemap.style.{style}.max_tile_count')
+            in (None, '')
+            else None
+        )
+        for style in styles
+    }
+    if styles and all(zoom is None for zoom in schedule.values()):
+        coarsest = next(
+            style
+            for style in ('heatmap', 'gridded', 'plot', *styles)
+            if style in styles
+        )
+        schedule[coarsest] = min_zoom
+    return schedule
+
+
+def get_map_config():
+    """
+    Creates the map config dict. All of the settings in this dict are static in that
+    they will be the same for all map views created on the currently running CKAN
+    instance (they use either always static values or ones that are pulled from the
+    config which are set on boot) in the current locale. The config is served
+    separately from the map info by the /map-config endpoint so that the browser can
+    cache it, see get_map_config_key.
+
+    The map info created by MapViewSettings.create_map_info is merged into this by the
+    javascript and provides the settings which depend on the view, the resource and the
+    query.
+
+    :returns: a dict of settings
+    """
+    # the tile server URLs are substituted in place of {s} by the map, see
+    # get_available_tile_servers
+    png_url = build_url('{s}', '/{z}/{x}/{y}.png')
+    utf_grid_url = build_url('{s}', '/{z}/{x}/{y}.grid.json')
+    tile_options = get_tile_options()
+    # the tile server renders 256 pixel tiles by default so only tell it the size when
+    # it's something else, this keeps the tile URLs the same for standard tiles
+    size_params = {}
+    if tile_options['tile_size'] != TILE_SIZES[0]:
+        size_params['tile_size'] = tile_options['tile_size']
+
+    map_config = {
         'zoom_bounds': {
             'min': int(config['versioned_tilemap.zoom_bounds.min']),
             'max': int(config['versioned_tilemap.zoom_bounds.max']),
@@ -387,6 +1347,13 @@ def get_base_map_info():
             'min': int(config['versioned_tilemap.initial_zoom.min']),
             'max': int(config['versioned_tilemap.initial_zoom.max']),
         },
+        'fetch_options': {
+            'cache_size': int(config['versioned_tilemap.info_cache.size']),
+            'debounce': int(config['versioned_tilemap.info_cache.debounce']),
+            'prefetch': toolkit.asbool(config['versioned_tilemap.prefetch.enabled']),
+            'prefetch_delay': int(config['versioned_tilemap.prefetch.delay']),
+        },
+        'tile_options': tile_options,
         'tile_layer': {
             'url': config['versioned_tilemap.tile_layer.url'],
             'attribution': config.get('versioned_tilemap.tile_layer.attribution'),
@@ -459,7 +1426,7 @@ def get_base_map_info():
                 'has_grid': False,
                 'tile_source': {
                     'url': png_url,
-                    'params': {},
+                    'params': dict(size_params),
                 },
             },
             'gridded': {
@@ -472,11 +1439,11 @@ def get_base_map_info():
                 ),
                 'tile_source': {
                     'url': png_url,
-                    'params': {},
+                    'params': dict(size_params),
                 },
                 'grid_source': {
                     'url': utf_grid_url,
-                    'params': {},
+                    'params': dict(size_params),
                 },
             },
             'plot': {
@@ -489,12 +1456,94 @@ def get_base_map_info():
                 ),
                 'tile_source': {
                     'url': png_url,
-                    'params': {},
+                    'params': dict(size_params),
                 },
                 'grid_source': {
                     'url': utf_grid_url,
-                    'params': {},
+                    'params': dict(size_params),
                 },
             },
         },
     }
+    # the grid map can be drawn by the browser from the cell counts for the viewport
+    if toolkit.asbool(config['versioned_tilemap.aggregate.enabled']):
+        map_config['map_styles']['gridded']['aggregate_url'] = toolkit.url_for(
+            'map.aggregate'
+        )
+    return map_config
+
+
+def get_map_config_key(map_config):
+    """
+    Returns the key the given map config is served under by the /map-config endpoint.
+    The key is a hash of the plugin's version, the current locale and the config
+    itself so it changes whenever any of them change, which means the config for a key
+    never changes and can be cached indefinitely.
+
+    :param map_config: the map config dict, as returned by get_map_config
+    :returns: a hex string
+    """
+    try:
+        plugin_version = importlib.metadata.version('ckanext-versioned-tiledmap')
+    except importlib.metadata.PackageNotFoundError:
+        plugin_version = None
+    encoded = json.dumps(
+        [plugin_version, toolkit.h.lang(), map_config],
+        sort_keys=True,
+        separators=(',', ':'),
+    )
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()[:16]
+
+
+def get_cached_map_config():
+    """
+    Returns the map config for the current locale and its key, see get_map_config and
+    get_map_config_key. These are only created once per locale, and again if the
+    plugin's config changes, rather than on every request. The returned dict is shared
+    so it mustn't be modified.
+
+    :returns: a 2-tuple of the map config dict and its key
+    """
+    lang = toolkit.h.lang()
+    with _map_configs_lock:
+        cached = _map_configs.get(lang)
+    if cached is None or cached[0] != config:
+        map_config = get_map_config()
+        cached = (dict(config), map_config, get_map_config_key(map_config))
+        with _map_configs_lock:
+            _map_configs[lang] = cached
+    return cached[1], cached[2]
+
+
+def get_base_map_info():
+    """
+    Creates the base map info dict. This contains the settings which can change between
+    requests but don't depend on the view, the key of the map config to merge it into,
+    and the skeleton of the per-view settings which are filled in by
+    MapViewSettings.create_map_info.
+
+    :returns: a dict of settings
+    """
+    _, map_config_key = get_cached_map_config()
+    # fall back to the built in renderer if it's enabled and no tile servers are up
+    fallback = toolkit.url_for('/map-tiles') if renderer.is_enabled() else None
+    return {
+        'geospatial': True,
+        'config_url': toolkit.url_for('map.map_config', key=map_config_key),
+        # the available tile servers are checked periodically so these can change
+        'tile_servers': get_available_tile_servers(fallback),
+        'plugin_options': {},
+        'map_styles': {
+            'heatmap': {
+                'tile_source': {'params': {}},
+            },
+            'gridded': {
+                'tile_source': {'params': {}},
+                'grid_source': {'params': {}},
+            },
+            'plot': {
+                'tile_source': {'params': {}},
+                'grid_source': {'params': {}},
+            },
+        },
+    }
@@ -4,24 +4,382 @@
 # This file is part of ckanext-versioned-tiledmap
 # Created by the Natural History Museum in London, UK
 
-from flask import Blueprint, jsonify
+import json
+import os
 
+from ckan.plugins import toolkit
+from flask import Blueprint, jsonify, make_response
+
+from ..config import config
+from ..lib import admission, profiling, renderer
+from ..lib.cancellation import FetchSuperseded
+from ..lib.countries import get_country_index
+from ..lib.query_store import get_query_store
 from . import _helpers
 
 blueprint = Blueprint(name='map', import_name=__name__, url_prefix='')
 
 
 @blueprint.route('/map-info')
+@admission.admit
 def info():
     """
-    Returns metadata about a given map in JSON form.
+    Returns metadata about a given map in JSON form. If the deferred parameter is true
+    then the extent info (counts, bounds and style schedule) is left out and should be
+    requested from /map-extent instead.
 
     :returns: A JSON encoded string representing the metadata
     """
     view_settings = _helpers.MapViewSettings.from_request()
+    deferred = toolkit.asbool(toolkit.request.params.get('deferred', False))
+
+    # ensure we have at least one map style enabled
+    if not view_settings.is_enabled():
+        return jsonify({'geospatial': False})
+
+    try:
+        if not profiling.should_profile():
+            return jsonify(view_settings.create_map_info(deferred))
+
+        # profile the serialisation as well as the creation of the map info
+        response, profile_path = profiling.profile(
+            f'map-info-{view_settings.view_id}',
+            lambda: jsonify(view_settings.create_map_info(deferred)),
+        )
+    except FetchSuperseded as e:
+        return superseded(e)
+    # let the requester know which profile is theirs
+    response.headers[profiling.PROFILE_HEADER] = os.path.basename(profile_path)
+    return response
+
+
+@blueprint.route('/map-extent')
+@admission.admit
+def extent():
+    """
+    Returns the extent info about a given map in JSON form. This takes the same
+    parameters as /map-info and is used alongside deferred /map-info requests.
+
+    :returns: A JSON encoded string representing the extent info
+    """
+    view_settings = _helpers.MapViewSettings.from_request()
 
     # ensure we have at least one map style enabled
     if not view_settings.is_enabled():
         return jsonify({'geospatial': False})
 
-    return jsonify(view_settings.create_map_info())
+    try:
+        return jsonify(view_settings.create_extent_info())
+    except FetchSuperseded as e:
+        return superseded(e)
+
+
+@blueprint.route('/map-config/<key>')
+def map_config(key):
+    """
+    Returns the map config in JSON form. This holds the settings that are the same for
+    every map on this CKAN instance and is merged into the map info by the javascript.
+    The /map-info response includes the URL of the current config. Its key changes
+    whenever the config changes so the response can be cached indefinitely. If the key
+    isn't the current one (e.g. the config has changed since the URL was given
+    out) the current config is returned but isn't cached.
+
+    :param key: the config's key
+    :returns: A JSON encoded string representing the map config
+    """
+    config_dict, current_key = _helpers.get_cached_map_config()
+    response = jsonify(config_dict)
+    if key == current_key:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@blueprint.route('/map-records')
+@admission.admit
+def records():
+    """
+    Returns a page of the records at a location on the map in JSON form. This takes the
+    same parameters as /map-info plus the location's GeoJSON geometry in the geo_filter
+    parameter, the number of records to return in the limit parameter and the cursor
+    returned with the previous page in the after parameter.
+
+    :returns: A JSON encoded string containing the total number of records at the
+        location, the page of records and the cursor for the next page
+    """
+    view_settings = _helpers.MapViewSettings.from_request()
+    params = toolkit.request.params
+
+    geo_filter = params.get('geo_filter', None)
+    if not geo_filter:
+        return toolkit.abort(400, toolkit._('Missing geo filter'))
+    try:
+        after = json.loads(params['after']) if params.get('after') else None
+        limit = int(params.get('limit', config['versioned_tilemap.records.page_size']))
+    except ValueError:
+        return toolkit.abort(400, toolkit._('Invalid after or limit'))
+    max_limit = int(config['versioned_tilemap.records.max_page_size'])
+    if not 0 < limit <= max_limit:
+        return toolkit.abort(
+            400, toolkit._('The limit must be between 1 and {}').format(max_limit)
+        )
+
+    return jsonify(view_settings.get_records(geo_filter, after, limit))
+
+
+@blueprint.route('/map-aggregate')
+@admission.admit
+def aggregate():
+    """
+    Returns the number of records in each grid map cell in the viewport in JSON form.
+    This takes the same parameters as /map-info plus the viewport's bounds in the bbox
+    parameter (as west,south,east,north), the map's zoom level in the zoom parameter
+    and, optionally, the size of the cells in the grid_resolution parameter (which
+    defaults to the view's grid map resolution, and must be a power of two no bigger
+    than a tile).
+
+    :returns: A JSON encoded string containing the cell counts, see
+        _helpers.encode_aggregate
+    """
+    if not toolkit.asbool(config['versioned_tilemap.aggregate.enabled']):
+        return toolkit.abort(404, toolkit._('Aggregation not enabled'))
+    view_settings = _helpers.MapViewSettings.from_request()
+    if not view_settings.grid_map_enabled:
+        return toolkit.abort(
+            400, toolkit._('The grid map is not enabled for this view')
+        )
+    params = toolkit.request.params
+
+    try:
+        west, south, east, north = map(float, params['bbox'].split(','))
+        zoom = int(params['zoom'])
+        grid_resolution = int(
+            params.get(
+                'grid_resolution',
+                view_settings.get_style_params('gridded')['grid_resolution'],
+            )
+        )
+    except (KeyError, ValueError):
+        return toolkit.abort(400, toolkit._('Invalid or missing bbox or zoom'))
+    max_zoom = int(config['versioned_tilemap.zoom_bounds.max'])
+    if not (0 <= zoom <= max_zoom and _helpers.is_geotile_resolution(grid_resolution)):
+        return toolkit.abort(400, toolkit._('Invalid zoom or grid resolution'))
+
+    try:
+        return jsonify(
+            view_settings.get_aggregate(
+                (north, west, south, east), zoom, grid_resolution
+            )
+        )
+    except ValueError:
+        return toolkit.abort(400, toolkit._('The bbox covers too many cells'))
+
+
+@blueprint.route('/map-country')
+def country():
+    """
+    Returns the country at the point given by the lat and lng parameters in JSON form.
+    The response contains the country's id, name and GeoJSON geometry (which can be used
+    as a __geo__ filter) under the country key, or null if there isn't a country at the
+    point.
+
+    :returns: A JSON encoded string representing the country
+    """
+    try:
+        lat = float(toolkit.request.params['lat'])
+        lng = float(toolkit.request.params['lng'])
+    except (KeyError, ValueError):
+        return toolkit.abort(400, toolkit._('Invalid or missing lat or lng'))
+
+    response = jsonify({'country': get_country_index().hit_test(lat, lng)})
+    # the countries only change when the plugin is upgraded
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+
+@blueprint.route('/map-tiles/<int:z>/<int:x>/<int:y>.png')
+@admission.admit(rate_limit=False)
+def tile(z, x, y):
+    """
+    Renders a tile with the built in renderer (see lib/renderer.py). This takes the same
+    parameters as a tile server's PNG tiles (the query or query_ref, the style, the
+    style's parameters, and optionally the tile_size and version) plus the resource_id
+    and view_id.
+
+    :param z: the zoom level of the tile
+    :param x: the column of the tile
+    :param y: the row of the tile
+    :returns: the tile as a PNG
+    """
+    query, size, style, view_settings = get_tile_request(z, x, y)
+    params = toolkit.request.params
+    try:
+        style_params = {
+            name: renderer.PARAM_TYPES[name](
+                params.get(name, config[f'versioned_tilemap.style.{style}.{name}'])
+            )
+            for name in _helpers.STYLE_PARAMS[style]
+        }
+        renderer.check_style_params(style_params, size)
+    except ValueError:
+        return toolkit.abort(400, toolkit._('Invalid style parameters'))
+
+    response = make_response(
+        renderer.render_tile(query, z, x, y, size, style, style_params)
+    )
+    response.headers['Content-Type'] = 'image/png'
+    return cache_tile(response, view_settings)
+
+
+@blueprint.route('/map-tiles/<int:z>/<int:x>/<int:y>.grid.json')
+@admission.admit(rate_limit=False)
+def grid(z, x, y):
+    """
+    Creates a UTFGrid tile with the built in renderer (see lib/renderer.py). This takes
+    the same parameters as a tile server's UTFGrid tiles (the query or query_ref, the
+    style, and optionally the grid_resolution, tile_size and version) plus the
+    resource_id and view_id. The records in the grid only include the _id and the
+    fields shown by the view.
+
+    :param z: the zoom level of the tile
+    :param x: the column of the tile
+    :param y: the row of the tile
+    :returns: A JSON encoded UTFGrid
+    """
+    query, size, style, view_settings = get_tile_request(z, x, y)
+    try:
+        grid_resolution = int(
+            toolkit.request.params.get(
+                'grid_resolution',
+                config[f'versioned_tilemap.style.{style}.grid_resolution'],
+            )
+        )
+    except (KeyError, ValueError):
+        return toolkit.abort(400, toolkit._('Invalid grid resolution'))
+    if not 0 < grid_resolution <= size:
+        return toolkit.abort(400, toolkit._('Invalid grid resolution'))
+
+    fields = ['_id'] + [field for field in view_settings.fields if field != '_id']
+    return cache_tile(
+        jsonify(
+            renderer.render_grid_tile(query, z, x, y, size, grid_resolution, fields)
+        ),
+        view_settings,
+    )
+
+
+def get_tile_request(z, x, y):
+    """
+    Checks the built in renderer is enabled and pulls the decoded query, the tile size
+    and the style out of the current tile request, aborting if any of them are missing
+    or invalid. The query is searched directly in elasticsearch, so the user must be
+    able to read the resource and view in the request and the query must only search
+    the resource's indexes.
+
+    :param z: the zoom level of the tile
+    :param x: the column of the tile
+    :param y: the row of the tile
+    :returns: a 4-tuple of the query, the tile size, the style and the view's
+        MapViewSettings
+    """
+    if not renderer.is_enabled():
+        return toolkit.abort(404, toolkit._('Renderer not enabled'))
+    if not renderer.is_available():
+        return toolkit.abort(501, toolkit._('The renderer needs numpy'))
+    if not (0 <= z <= 30 and 0 <= x < 2**z and 0 <= y < 2**z):
+        return toolkit.abort(404, toolkit._('Tile not found'))
+
+    # this checks the user can read the resource and the view
+    view_settings = _helpers.MapViewSettings.from_request()
+    if view_settings.view.get('resource_id') != view_settings.resource_id:
+        return toolkit.abort(400, toolkit._('The view is not for the resource'))
+
+    params = toolkit.request.params
+    query_body = params.get('query')
+    if not query_body and params.get('query_ref'):
+        query_store = get_query_store()
+        if query_store is not None and query_store.is_valid_key(params['query_ref']):
+            query_body = query_store.get(params['query_ref'])
+    if not query_body:
+        return toolkit.abort(400, toolkit._('Missing or unknown query'))
+    try:
+        query = renderer.decode_query_body(query_body)
+        size = int(params.get('tile_size', _helpers.TILE_SIZES[0]))
+    except ValueError:
+        return toolkit.abort(400, toolkit._('Invalid query or tile size'))
+    if size not in _helpers.TILE_SIZES or not (
+        isinstance(query, dict) and isinstance(query.get('search'), dict)
+    ):
+        return toolkit.abort(400, toolkit._('Invalid query or tile size'))
+    # the resource's indexes are the ones in the view's own query, which is cached
+    indexes = renderer.decode_query_body(view_settings.get_query_body())['indexes']
+    if query.get('indexes') != indexes:
+        return toolkit.abort(403, toolkit._('The query is not for the resource'))
+
+    style = params.get('style')
+    if style not in _helpers.STYLE_PARAMS:
+        return toolkit.abort(400, toolkit._('Invalid style'))
+    return query, size, style, view_settings
+
+
+def cache_tile(response, view_settings):
+    """
+    Sets the caching headers on the given tile response. Tiles for a fixed version of
+    the data never change so they can be cached indefinitely, tiles for the latest
+    version are only cached briefly. Tiles for resources which aren't public are only
+    cached by the user's browser, not by shared caches (e.g. a CDN) which would serve
+    them to other users.
+
+    :param response: the response
+    :param view_settings: the tile's MapViewSettings
+    :returns: the response
+    """
+    visibility = 'public' if view_settings.is_public else 'private'
+    if 'version' in toolkit.request.params:
+        cache_control = f'{visibility}, max-age=31536000, immutable'
+    else:
+        cache_control = f'{visibility}, max-age=60'
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
+def superseded(error):
+    """
+    Creates the response for a request which was abandoned because the client made a
+    newer one.
+
+    :param error: the FetchSuperseded exception
+    :returns: a response
+    """
+    response = jsonify({'fetch_id': error.fetch_id, 'superseded': True})
+    response.status_code = 409
+    return response
+
+
+@blueprint.route('/map-query/<key>')
+def query(key):
+    """
+    Returns the encoded query body stored under the given key. This is used by the tile
+    server to look up the queries referenced in tile URLs when a query store is
+    configured. As the key is a hash of the query body, the response never changes and
+    can be cached indefinitely. The query could be for a private resource and there's
+    no way to tell which resource it's for from the key, so it's never stored by shared
+    caches.
+
+    :param key: the query body's key
+    :returns: the encoded query body as plain text
+    """
+    query_store = get_query_store()
+    if query_store is None:
+        return toolkit.abort(404, toolkit._('Query store not enabled'))
+    if not query_store.is_valid_key(key):
+        return toolkit.abort(404, toolkit._('Query not found'))
+    query_body = query_store.get(key)
+    if query_body is None:
+        return toolkit.abort(404, toolkit._('Query not found'))
+
+    response = make_response(query_body)
+    response.headers['Content-Type'] = 'text/plain'
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
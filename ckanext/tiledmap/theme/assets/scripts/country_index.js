@@ -0,0 +1,90 @@
+this.tiledmap = this.tiledmap || {};
+
+(function (my, $) {
+  /**
+   * Converts a packed geometry from the geometry worker into a list of polygons, each of which is
+   * a list of rings of LatLngs (the outer ring first, then the holes).
+   */
+  my.unpackGeometry = function (packed) {
+    var polygons = [];
+    var c = 0;
+    var r = 0;
+    for (var i = 0; i < packed.polygon_sizes.length; i++) {
+      var rings = [];
+      for (var j = 0; j < packed.polygon_sizes[i]; j++) {
+        var size = packed.ring_sizes[r++];
+        var ring = new Array(size);
+        for (var k = 0; k < size; k++) {
+          ring[k] = new L.LatLng(packed.coords[c + 1], packed.coords[c]);
+          c += 2;
+        }
+        rings.push(ring);
+      }
+      polygons.push(rings);
+    }
+    return polygons;
+  };
+
+  /**
+   * Creates a Leaflet layer for the given packed geometry from the geometry worker.
+   */
+  my.geometryLayer = function (packed, options) {
+    var polygons = my.unpackGeometry(packed);
+    if (polygons.length === 1) {
+      return L.polygon(polygons[0], options);
+    }
+    return L.multiPolygon(polygons, options);
+  };
+
+  /**
+   * Index of the world's countries which lives in a web worker (see
+   * public/scripts/geometry_worker.js) so that parsing the countries and hit-testing points
+   * against them doesn't block the main thread.
+   */
+  my.CountryIndex = function (worker_url) {
+    this.worker = new Worker(worker_url);
+    this.callbacks = {};
+    this.next_id = 0;
+
+    this.worker.onmessage = $.proxy(function (e) {
+      var callback = this.callbacks[e.data.id];
+      delete this.callbacks[e.data.id];
+      if (e.data.error) {
+        console.log('geometry worker error: ' + e.data.error);
+      }
+      callback(e.data);
+    }, this);
+
+    /**
+     * Send the given message to the worker and call the callback with the reply.
+     */
+    this._send = function (message, callback) {
+      message.id = this.next_id++;
+      this.callbacks[message.id] = callback;
+      this.worker.postMessage(message);
+    };
+
+    /**
+     * Load the countries from the given URL. The callback is called with the packed outlines of
+     * all the countries, or null if they couldn't be loaded.
+     */
+    this.load = function (url, callback) {
+      this._send({ type: 'load', url: url }, function (reply) {
+        callback(reply.error ? null : reply.outlines);
+      });
+    };
+
+    /**
+     * Find the country at the given LatLng. The callback is called with an object containing the
+     * country's id, name and packed geometry, or null if there is no country there.
+     */
+    this.hitTest = function (latlng, callback) {
+      this._send(
+        { type: 'hit', lat: latlng.lat, lng: latlng.lng },
+        function (reply) {
+          callback(reply.error ? null : reply.country);
+        },
+      );
+    };
+  };
+})(this.tiledmap, jQuery);
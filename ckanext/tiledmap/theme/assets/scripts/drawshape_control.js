@@ -1,6 +1,23 @@
 this.tiledmap = this.tiledmap || {};
 
 (function (my, $) {
+  // the style of the country outlines shown when selecting a country
+  var country_style = {
+    stroke: true,
+    color: '#000',
+    opacity: 1,
+    weight: 1,
+    fill: true,
+    fillColor: '#FFF',
+    fillOpacity: 0.25,
+    clickable: false,
+  };
+  // the style of the country under the mouse
+  var highlight_style = $.extend({}, country_style, {
+    fillColor: '#54F',
+    fillOpacity: 0.75,
+  });
+
   /**
    * Extend draw shape control to add country selection support and a way to clear the current selection.
    */
@@ -9,11 +26,12 @@ this.tiledmap = this.tiledmap || {};
       this.view = view;
       this.active = false;
       this.country = options.draw.country;
+      // the countries are only loaded when the user starts selecting a country
+      this.country_index = null;
+      this.countries = null;
+      this.highlight = null;
       L.Control.Draw.prototype.initialize.call(this, options);
       L.Util.setOptions(this, options);
-      if (this.country) {
-        this._loadCountries();
-      }
     },
 
     onAdd: function (map) {
@@ -52,82 +70,131 @@ this.tiledmap = this.tiledmap || {};
     },
 
     /**
-     * Internal method to load the countries data
+     * Internal method to load the countries data. The countries are loaded, parsed and hit-tested
+     * in a web worker, only their outlines are sent back to be drawn. They're only needed to show
+     * the outlines and highlight the country under the mouse, clicks are hit-tested by the server.
      */
     _loadCountries: function () {
-      $.ajax('/data/countries.geojson', {
-        dataType: 'json',
-        error: function (xhr, status, error) {
-          console.log('failed to load countries');
-        },
-        success: $.proxy(function (data, status, xhr) {
-          this.countries = data;
+      this.country_index = new my.CountryIndex('/scripts/geometry_worker.js');
+      this.country_index.load(
+        '/data/countries.geojson',
+        $.proxy(function (outlines) {
+          if (outlines === null) {
+            console.log('failed to load countries');
+            return;
+          }
+          this.countries = my.unpackGeometry(outlines);
+          if (this.active) {
+            this.view._addLayer('countries', this.layers()[0].layer, true);
+          }
         }, this),
-      });
+      );
     },
 
     /**
      * Plugin hook called when adding layers to a map.
      */
     layers: function () {
-      var self = this;
       if (!this.active || !this.countries) {
         return [];
       }
-      // The main layer is used only for hovers
-      var l = new L.geoJson(this.countries, {
-        style: function () {
-          return {
-            stroke: true,
-            color: '#000',
-            opacity: 1,
-            weight: 1,
-            fill: true,
-            fillColor: '#FFF',
-            fillOpacity: 0.25,
-          };
+      // The outlines are only for display, hovers and clicks are hit-tested by the country index
+      var layers = [
+        {
+          name: 'countries',
+          layer: L.multiPolygon(this.countries, country_style),
         },
-        onEachFeature: function (feature, layer) {
-          layer.on({
-            mouseover: function (e) {
-              layer.setStyle({
-                stroke: true,
-                color: '#000',
-                opacity: 1,
-                weight: 1,
-                fill: true,
-                fillColor: '#54F',
-                fillOpacity: 0.75,
-              });
-            },
-            mouseout: function (e) {
-              layer.setStyle({
-                stroke: true,
-                color: '#000',
-                opacity: 1,
-                weight: 1,
-                fill: true,
-                fillColor: '#FFF',
-                fillOpacity: 0.25,
-              });
-            },
-            click: function (e) {
-              self.view.map.fire('draw:created', {
-                layer: layer,
-                layerType: 'country',
-              });
-              self._disactivate();
-            },
+      ];
+      if (this.highlight !== null) {
+        layers.push({
+          name: 'country_highlight',
+          layer: this.highlight.layer,
+        });
+      }
+      return layers;
+    },
+
+    /**
+     * Highlight the country at the given LatLng. Only one hit-test is sent to the worker at a time,
+     * if the mouse moves while we're waiting for the result then the latest position is tested
+     * once it arrives.
+     */
+    _hover: function (latlng) {
+      if (this.countries === null) {
+        return;
+      }
+      if (this.hit_pending) {
+        this.next_hover = latlng;
+        return;
+      }
+      this.hit_pending = true;
+      this.country_index.hitTest(
+        latlng,
+        $.proxy(function (country) {
+          this.hit_pending = false;
+          if (!this.active) {
+            return;
+          }
+          var id = country ? country.id : null;
+          var current = this.highlight ? this.highlight.id : null;
+          if (id !== current) {
+            this.view._removeLayer('country_highlight');
+            this.highlight = null;
+            if (country) {
+              this.highlight = {
+                id: id,
+                layer: my.geometryLayer(country.geometry, highlight_style),
+              };
+              this.view._addLayer('country_highlight', this.highlight.layer);
+            }
+          }
+          if (this.next_hover) {
+            var next = this.next_hover;
+            this.next_hover = null;
+            this._hover(next);
+          }
+        }, this),
+      );
+    },
+
+    _onMouseMove: function (e) {
+      this._hover(e.latlng);
+    },
+
+    /**
+     * Select the country that was clicked on, if there is one. The server has an index of the
+     * countries so this works whether or not we've finished loading them.
+     */
+    _onMapClick: function (e) {
+      $.ajax({
+        url: ckan.SITE_ROOT + '/map-country',
+        type: 'GET',
+        data: { lat: e.latlng.lat, lng: e.latlng.lng },
+        success: $.proxy(function (data) {
+          if (!this.active || !data.country) {
+            return;
+          }
+          this.active = false;
+          this._disactivate();
+          this.view.map.fire('draw:created', {
+            layer: L.GeoJSON.geometryToLayer(data.country.geometry),
+            layerType: 'country',
           });
-        },
+        }, this),
       });
-      return [{ name: 'countries', layer: l }];
     },
 
     _activate: function () {
+      if (this.country_index === null) {
+        this._loadCountries();
+      }
       // Add the layer
       var l = this.layers();
-      this.view._addLayer('countries', l[0].layer, true);
+      if (l.length > 0) {
+        this.view._addLayer('countries', l[0].layer, true);
+      }
+      this.view.map.on('mousemove', this._onMouseMove, this);
+      this.view.map.on('click', this._onMapClick, this);
       // Add action
       var action_inner = $('<a>')
         .attr('href', '#')
@@ -145,6 +212,11 @@ this.tiledmap = this.tiledmap || {};
     _disactivate: function () {
       // Remove layer
       this.view._removeLayer('countries', true);
+      this.view._removeLayer('country_highlight');
+      this.highlight = null;
+      this.next_hover = null;
+      this.view.map.off('mousemove', this._onMouseMove, this);
+      this.view.map.off('click', this._onMapClick, this);
       // Hide actions
       this.action.remove();
       $('ul.leaflet-draw-actions').css('display', 'none');
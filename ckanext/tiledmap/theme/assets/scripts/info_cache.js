@@ -0,0 +1,77 @@
+this.tiledmap = this.tiledmap || {};
+
+(function (my, $) {
+  /**
+   * Small least recently used cache used to hold map-info responses in the browser so that
+   * returning to a filter state we've already seen doesn't require a round trip to the server.
+   *
+   * Values are deep copied on the way in and out as the map view mutates the map info objects it
+   * is given.
+   */
+  my.InfoCache = function (max_size) {
+    /**
+     * Set up the object
+     */
+    this.initialize = function () {
+      this.max_size = typeof max_size === 'undefined' ? 20 : max_size;
+      this.clear();
+    };
+
+    /**
+     * Build a cache key from the parts of a map-info request that affect the response.
+     */
+    this.key = function (view_id, filters, q) {
+      return JSON.stringify([view_id, filters || '', q || '']);
+    };
+
+    /**
+     * Return a copy of the value stored under the given key, or undefined if there isn't one. A
+     * successful lookup marks the entry as the most recently used.
+     */
+    this.get = function (key) {
+      if (!this.values.hasOwnProperty(key)) {
+        return undefined;
+      }
+      this._touch(key);
+      return $.extend(true, {}, this.values[key]);
+    };
+
+    /**
+     * Store a copy of the given value under the given key, evicting the least recently used
+     * entries if the cache is full.
+     */
+    this.set = function (key, value) {
+      if (this.max_size <= 0) {
+        return this;
+      }
+      this.values[key] = $.extend(true, {}, value);
+      this._touch(key);
+      while (this.order.length > this.max_size) {
+        delete this.values[this.order.shift()];
+      }
+      return this;
+    };
+
+    /**
+     * Remove all entries from the cache.
+     */
+    this.clear = function () {
+      this.values = {};
+      this.order = [];
+      return this;
+    };
+
+    /**
+     * Move the given key to the most recently used end of the order list.
+     */
+    this._touch = function (key) {
+      var pos = $.inArray(key, this.order);
+      if (pos >= 0) {
+        this.order.splice(pos, 1);
+      }
+      this.order.push(key);
+    };
+
+    this.initialize();
+  };
+})(this.tiledmap, jQuery);
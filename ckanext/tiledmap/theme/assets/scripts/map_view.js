@@ -4,6 +4,95 @@ this.tiledmap = this.tiledmap || {};
  * Custom backbone view to display the Windshaft based maps.
  */
 (function (my, $) {
+  /**
+   * Returns a string representation of the given filters object (a mapping of field names to a
+   * value or a list of values) which doesn't depend on the order of the fields or values.
+   */
+  function normaliseFilters(filters) {
+    var normalised = [];
+    for (var name in filters) {
+      var values = $.isArray(filters[name]) ? filters[name] : [filters[name]];
+      normalised.push([name, values.slice().sort()]);
+    }
+    normalised.sort(function (a, b) {
+      return a[0] < b[0] ? -1 : a[0] > b[0] ? 1 : 0;
+    });
+    return JSON.stringify(normalised);
+  }
+
+  /**
+   * Serialise the given value as JSON with the keys of every object sorted, so that the same
+   * geometry always produces the same string whatever order its keys were in.
+   */
+  function canonicalJSON(value) {
+    if ($.isArray(value)) {
+      return '[' + $.map(value, canonicalJSON).join(',') + ']';
+    }
+    if (value !== null && typeof value === 'object') {
+      var keys = [];
+      for (var key in value) {
+        keys.push(key);
+      }
+      keys.sort();
+      return (
+        '{' +
+        $.map(keys, function (key) {
+          return JSON.stringify(key) + ':' + canonicalJSON(value[key]);
+        }).join(',') +
+        '}'
+      );
+    }
+    return JSON.stringify(value);
+  }
+
+  /**
+   * Returns true if the given positive integer is a power of two.
+   */
+  function isPowerOfTwo(value) {
+    return (value & (value - 1)) === 0;
+  }
+
+  /**
+   * Serialise the given parameters object into a query string with the parameters in a stable
+   * order, so that the same parameters always produce exactly the same URL (which means they can
+   * be cached by the browser and any CDN in front of the tile server).
+   */
+  function stableParam(params) {
+    var names = [];
+    for (var name in params) {
+      names.push(name);
+    }
+    names.sort();
+    return $.param(
+      $.map(names, function (name) {
+        return { name: name, value: params[name] };
+      }),
+    );
+  }
+
+  /**
+   * Returns the canonical form of the given full text query, matching the server's
+   * canonicalisation.
+   */
+  function canonicalQ(q) {
+    return $.trim(q || '').replace(/\s+/g, ' ');
+  }
+
+  /**
+   * Merges the given map info into a copy of the given map config. The config has the settings
+   * for every map style but only the styles enabled on the view are in the map info, so the other
+   * styles are left out.
+   */
+  function mergeMapInfo(config, info) {
+    var merged = $.extend(true, {}, config, info);
+    for (var style in merged.map_styles) {
+      if (typeof info.map_styles[style] === 'undefined') {
+        delete merged.map_styles[style];
+      }
+    }
+    return merged;
+  }
+
   my.NHMMap = Backbone.View.extend({
     className: 'tiled-map',
     template:
@@ -18,11 +107,34 @@ this.tiledmap = this.tiledmap || {};
       this.map_ready = false;
       this.visible = true;
       this.fetch_count = 0;
+      // identifies this map to the server, which abandons work on our superseded requests
+      this.client_id = Math.random().toString(36).slice(2);
       this.resource_id = this.options.resource_id;
       this.view_id = this.options.view_id;
       this.filters = this.options.filters;
+      // the datastore version to show, or undefined for the resource's current version
+      this.version = this.options.version;
       this.countries = null;
       this.layers = {};
+      // the map config the map info is merged into, see _loadConfig
+      this.map_config = null;
+      this.map_config_url = null;
+      // the decoded /map-aggregate response the grid map is drawn from when it's drawn in the
+      // browser, the request it was for and the request in flight, see _fetchAggregate. If a
+      // request fails, the grid map is drawn from tiles until the query changes
+      this.aggregate = null;
+      this.aggregate_request = null;
+      this.aggregate_jqxhr = null;
+      this.aggregate_failed = null;
+      // map-info responses we've already seen, keyed on the request parameters. The size and the
+      // debounce window are updated from the fetch options in the first map-info response
+      this.info_cache = new my.InfoCache();
+      this.info_debounce = 0;
+      this.refresh_timeout = null;
+      // the map-info prefetch for the filter link the user is hovering over, see _prefetchLink
+      this.prefetch_delay = null;
+      this.prefetch_timeout = null;
+      this.prefetch_jqxhr = null;
       // Setup the sidebar
       this.sidebar_view = new my.PointDetailView();
       // Handle window resize
@@ -46,17 +158,28 @@ this.tiledmap = this.tiledmap || {};
       this.el.find('.close').click(this.closeSidebar);
       $('.panel.sidebar', this.el).append(this.sidebar_view.el);
       this.map_ready = false;
+      this._useInitialMapInfo();
       this._fetchMapInfo(
         $.proxy(function (info) {
           this.map_info = info;
           this.map_info.draw = true;
           this.map_ready = true;
+          // the style the user wants, this may not be the style displayed if it is too
+          // expensive to render at the current zoom level
+          this.preferred_style = this.map_info.map_style;
+          this._applyFetchOptions();
           this._setupMap();
+          this.map_info.map_style = this._scheduledStyle();
           this.redraw();
           if (this.visible) {
             this.show();
           }
         }, this),
+        $.proxy(function () {
+          // the map was set up without the extent info, zoom to the records now we have it
+          this._fitBounds();
+          this._extentLoaded();
+        }, this),
         $.proxy(function (message) {
           this.map_info = {
             draw: false,
@@ -106,6 +229,11 @@ this.tiledmap = this.tiledmap || {};
      */
     updateRecordCounter: function () {
       var $rri = $('.tiled-map-info', this.el);
+      if (typeof this.map_info.total_count === 'undefined') {
+        // the extent info hasn't arrived yet
+        $rri.html('Counting records...');
+        return;
+      }
       var template = [
         'Displaying <span class="doc-count">{{geoRecordCount}}</span>',
         ' of ',
@@ -184,6 +312,7 @@ this.tiledmap = this.tiledmap || {};
         bounds = this.map.getBounds();
         this.disablePlugins();
         this.map.remove();
+        this.layers = {};
       }
       /* Fix map jump issue, see: https://github.com/Leaflet/Leaflet/issues/1228 */
       L.Map.addInitHook(function () {
@@ -202,13 +331,11 @@ this.tiledmap = this.tiledmap || {};
       if (this.map_info.geom_count > 0 || !bounds) {
         bounds = this.map_info.bounds;
       }
-      this.map.fitBounds(this.map_info.bounds, {
-        animate: false,
-        maxZoom: this.map_info.initial_zoom.max,
-      });
-      if (this.map.getZoom() < this.map_info.initial_zoom.min) {
-        var center = this.map.getCenter();
-        this.map.setView(center, this.map_info.initial_zoom.min);
+      if (typeof this.map_info.bounds !== 'undefined') {
+        this._fitBounds();
+      } else {
+        // the extent info is being fetched separately, show the whole world until it arrives
+        this.map.fitWorld();
       }
       L.tileLayer(this.map_info.tile_layer.url, {
         attribution: this.map_info.tile_layer.attribution,
@@ -264,22 +391,174 @@ this.tiledmap = this.tiledmap || {};
         self.invoke('active', true);
         self.layers['plot'].setOpacity(1);
       });
+      // Switch styles as the zoom level changes if the schedule requires it
+      this.map.on('zoomend', function (e) {
+        self._applyStyleSchedule();
+      });
+      // fetch the cell counts for the new viewport if the grid map is drawn from them
+      this.map.on('moveend', function (e) {
+        self._fetchAggregate();
+      });
       this._resize();
     },
 
     /**
-     * Internal method to fetch extra map info (such as the number of records with geoms)
-     *
-     * Called internally during render, and calls the provided callback function on success
-     * after updating map_info
+     * Zoom the map to the bounds of the records in the current map info.
      */
-    _fetchMapInfo: function (callback, error_cb) {
-      this.fetch_count++;
+    _fitBounds: function () {
+      this.map.fitBounds(this.map_info.bounds, {
+        animate: false,
+        maxZoom: this.map_info.initial_zoom.max,
+      });
+      if (this.map.getZoom() < this.map_info.initial_zoom.min) {
+        var center = this.map.getCenter();
+        this.map.setView(center, this.map_info.initial_zoom.min);
+      }
+    },
+
+    /**
+     * Called when the extent info for the current map info arrives after the map has been drawn.
+     * The record counts can now be shown and the style schedule applied.
+     */
+    _extentLoaded: function () {
+      this.updateRecordCounter();
+      this._applyStyleSchedule();
+    },
+
+    /**
+     * Update the info cache size and the refresh debounce window using the fetch options provided
+     * in the current map info.
+     */
+    _applyFetchOptions: function () {
+      var options = this.map_info.fetch_options;
+      if (typeof options === 'undefined') {
+        return;
+      }
+      this.info_cache.max_size = options.cache_size;
+      this.info_debounce = options.debounce;
+      if (options.prefetch && this.prefetch_delay === null) {
+        this.prefetch_delay = options.prefetch_delay;
+        // links on the page which set filters, e.g. the facets
+        var links = 'a[href*="filters="]';
+        $(window.parent.document)
+          .on('mouseenter focusin', links, $.proxy(this, '_prefetchLink'))
+          .on('mouseleave focusout', links, $.proxy(this, '_cancelPrefetch'));
+      }
+    },
+
+    /**
+     * Prefetch the map info for the filters on the link the user is hovering over (or has focused)
+     * as they're likely to click it. After the prefetch delay, the map info is requested with low
+     * priority so the server handles it after the requests for the maps being shown. The response
+     * fills the server's caches, so the map for the link's page is drawn quickly, and our info
+     * cache. Only one prefetch is in flight at a time.
+     */
+    _prefetchLink: function (e) {
+      this._cancelPrefetch();
+      var url = new my.CkanFilterUrl(e.currentTarget.href);
+      // only links to this page change the map's filters
+      var page = window.parent.location.href.split(/[?#]/)[0];
+      if (url.base.split('#')[0] !== page) {
+        return;
+      }
+      var params = {
+        resource_id: this.resource_id,
+        view_id: this.view_id,
+        filters: url.get_filters(),
+      };
+      var q = canonicalQ((url.qs['q'] || '').replace(/\+/g, ' '));
+      if (q) {
+        params['q'] = q;
+      }
+      if (this.version) {
+        params['version'] = this.version;
+      }
+      var key = this._infoCacheKey(params);
+      if (
+        key === this._infoCacheKey(this._fetchParams()) ||
+        typeof this.info_cache.get(key) !== 'undefined'
+      ) {
+        return;
+      }
+
+      this.prefetch_timeout = setTimeout(
+        $.proxy(function () {
+          this.prefetch_timeout = null;
+          if (this.prefetch_jqxhr !== null) {
+            this.prefetch_jqxhr.abort();
+          }
+          this.prefetch_jqxhr = $.ajax({
+            url: ckan.SITE_ROOT + '/map-info',
+            type: 'GET',
+            data: stableParam($.extend({ priority: 'low' }, params)),
+            success: $.proxy(function (data) {
+              this.prefetch_jqxhr = null;
+              if (data.geospatial) {
+                this.info_cache.set(key, data);
+              }
+            }, this),
+            error: $.proxy(function (jqXHR, status) {
+              if (status !== 'abort') {
+                this.prefetch_jqxhr = null;
+              }
+            }, this),
+          });
+        }, this),
+        this.prefetch_delay,
+      );
+    },
+
+    /**
+     * Cancel the prefetch waiting for the prefetch delay, if there is one. A prefetch which has
+     * already been requested is left to fill the caches.
+     */
+    _cancelPrefetch: function () {
+      if (this.prefetch_timeout !== null) {
+        clearTimeout(this.prefetch_timeout);
+        this.prefetch_timeout = null;
+      }
+    },
+
+    /**
+     * If the page was rendered with map info for the same filters as we're about to request, put
+     * it in the info cache so that the map can be drawn without requesting it.
+     */
+    _useInitialMapInfo: function () {
+      var info = this.options.map_info;
+      if (!info || !info.geospatial) {
+        return;
+      }
+      var fields = $.extend({}, this.filters.fields);
+      if (this.filters.geom) {
+        fields['__geo__'] = canonicalJSON(this.filters.geom);
+      }
+      var initial_fields = $.extend({}, info.filters);
+      if (typeof initial_fields['__geo__'] !== 'undefined') {
+        // the server sends the geometry with its keys sorted, while Leaflet puts the type
+        // before the coordinates, so serialise both the same way before comparing them
+        initial_fields['__geo__'] = $.map(
+          initial_fields['__geo__'],
+          function (geom) {
+            return canonicalJSON(JSON.parse(geom));
+          },
+        );
+      }
+      if (
+        canonicalQ(this.filters.q) === (info.q || '') &&
+        normaliseFilters(fields) === normaliseFilters(initial_fields)
+      ) {
+        this.info_cache.set(this._infoCacheKey(this._fetchParams()), info);
+      }
+    },
 
+    /**
+     * Build the map-info request parameters for the current filters. The fetch_id is not included
+     * as it changes on every request.
+     */
+    _fetchParams: function () {
       var params = {
         resource_id: this.resource_id,
         view_id: this.view_id,
-        fetch_id: this.fetch_count,
       };
 
       var filters = new my.CkanFilterUrl().set_filters(this.filters.fields);
@@ -288,56 +567,225 @@ this.tiledmap = this.tiledmap || {};
       }
       params['filters'] = filters.get_filters();
 
-      if (this.filters.q) {
-        params['q'] = this.filters.q;
+      var q = canonicalQ(this.filters.q);
+      if (q) {
+        params['q'] = q;
+      }
+      if (this.version) {
+        params['version'] = this.version;
       }
+      return params;
+    },
 
-      if (typeof this.jqxhr !== 'undefined' && this.jqxhr !== null) {
-        this.jqxhr.abort();
+    /**
+     * Returns the info cache key for the given map-info request parameters.
+     */
+    _infoCacheKey: function (params) {
+      return this.info_cache.key(params.view_id, params.filters, params.q);
+    },
+
+    /**
+     * Internal method to fetch extra map info (such as the number of records with geoms)
+     *
+     * Called internally during render, and calls the provided callback function on success
+     * after updating map_info. If we've already seen a response for the current filters then the
+     * callback is called straight away with the cached copy and no request is made.
+     *
+     * The tiles only need the query from the map info so the map info is requested without the
+     * extent info (the counts, bounds and style schedule), which can be slow to work out on large
+     * resources, and the extent info is requested from /map-extent at the same time. If the map
+     * info arrives first the callback is called with it straight away and the extent info is
+     * added to it when it arrives, after which the extent callback is called.
+     */
+    _fetchMapInfo: function (callback, extent_cb, error_cb) {
+      this.fetch_count++;
+
+      var params = this._fetchParams();
+      var cache_key = this._infoCacheKey(params);
+      params['fetch_id'] = this.fetch_count;
+      params['client_id'] = this.client_id;
+
+      this._abortFetches();
+
+      var cached = this.info_cache.get(cache_key);
+      if (typeof cached !== 'undefined') {
+        this._loadConfig(
+          cached.config_url,
+          function (config) {
+            callback(mergeMapInfo(config, cached));
+          },
+          error_cb,
+        );
+        return;
       }
 
-      this.jqxhr = $.ajax({
+      // the map info as it was received, which is what's cached, and the map info merged into the
+      // map config, which is what's used
+      var info = null;
+      var merged = null;
+      var extent = null;
+      var complete = $.proxy(function () {
+        $.extend(info, extent);
+        delete info.extent_deferred;
+        $.extend(merged, extent);
+        delete merged.extent_deferred;
+        this.info_cache.set(cache_key, info);
+      }, this);
+
+      this.jqxhr = my.retryingAjax({
         url: ckan.SITE_ROOT + '/map-info',
         type: 'GET',
-        data: params,
+        data: stableParam($.extend({ deferred: true }, params)),
         success: $.proxy(function (data, status, jqXHR) {
           this.jqxhr = null;
           // Ensure this is the result we want, not a previous query!
           if (data.fetch_id === this.fetch_count) {
             if (typeof data.geospatial !== 'undefined' && data.geospatial) {
-              callback(data);
+              this._loadConfig(
+                data.config_url,
+                function (config) {
+                  if (data.fetch_id !== this.fetch_count) {
+                    return;
+                  }
+                  info = data;
+                  merged = mergeMapInfo(config, data);
+                  if (extent !== null) {
+                    complete();
+                  }
+                  callback(merged);
+                },
+                error_cb,
+              );
             } else {
               error_cb('This data does not have geospatial information');
             }
           }
         }, this),
         error: function (jqXHR, status, error) {
-          if (status !== 'abort') {
+          // 409 responses are for requests the server abandoned as we'd made a newer one
+          if (status !== 'abort' && jqXHR.status !== 409) {
             error_cb('Error while loading the map');
           }
         },
       });
+
+      this.extent_jqxhr = my.retryingAjax({
+        url: ckan.SITE_ROOT + '/map-extent',
+        type: 'GET',
+        data: stableParam(params),
+        success: $.proxy(function (data, status, jqXHR) {
+          this.extent_jqxhr = null;
+          if (data.fetch_id === this.fetch_count) {
+            extent = data;
+            if (merged !== null) {
+              complete();
+              extent_cb();
+            }
+          }
+        }, this),
+        error: $.proxy(function (jqXHR, status, error) {
+          if (status !== 'abort' && jqXHR.status !== 409) {
+            // the map can still be used without the extent info
+            $('.tiled-map-info', this.el).html(
+              'Error while counting the records',
+            );
+          }
+        }, this),
+      });
+    },
+
+    /**
+     * Call the callback with the map config at the given URL. The config only changes when the
+     * URL does and the browser caches it, so it's only requested when the URL changes.
+     */
+    _loadConfig: function (url, callback, error_cb) {
+      if (this.map_config_url === url) {
+        callback.call(this, this.map_config);
+        return;
+      }
+      $.ajax({
+        url: url,
+        type: 'GET',
+        dataType: 'json',
+        success: $.proxy(function (config) {
+          this.map_config = config;
+          this.map_config_url = url;
+          callback.call(this, config);
+        }, this),
+        error: function (jqXHR, status, error) {
+          error_cb('Error while loading the map');
+        },
+      });
+    },
+
+    /**
+     * Abort any map info, extent and prefetch requests in flight.
+     */
+    _abortFetches: function () {
+      // don't let a prefetch compete with the map info we actually need
+      this._cancelPrefetch();
+      if (this.prefetch_jqxhr !== null) {
+        this.prefetch_jqxhr.abort();
+        this.prefetch_jqxhr = null;
+      }
+      if (typeof this.jqxhr !== 'undefined' && this.jqxhr !== null) {
+        this.jqxhr.abort();
+        this.jqxhr = null;
+      }
+      if (
+        typeof this.extent_jqxhr !== 'undefined' &&
+        this.extent_jqxhr !== null
+      ) {
+        this.extent_jqxhr.abort();
+        this.extent_jqxhr = null;
+      }
     },
 
     /**
      * Reload the number of records. Called when filters change without a page reload.
+     *
+     * Requests are debounced so that a burst of filter changes only results in one map-info
+     * request, unless the response for the new filters is already cached in which case the map is
+     * redrawn immediately.
      */
     _refreshInfo: function () {
       var $rri = $('.tiled-map-info', this.el);
       $rri.html('Loading...');
+      if (this.refresh_timeout !== null) {
+        clearTimeout(this.refresh_timeout);
+        this.refresh_timeout = null;
+      }
+      var cached = this.info_cache.get(this._infoCacheKey(this._fetchParams()));
+      if (typeof cached !== 'undefined' || !this.info_debounce) {
+        this._doRefreshInfo();
+      } else {
+        this.refresh_timeout = setTimeout(
+          $.proxy(function () {
+            this.refresh_timeout = null;
+            this._doRefreshInfo();
+          }, this),
+          this.info_debounce,
+        );
+      }
+    },
+
+    /**
+     * Fetch the map info for the current filters and redraw the map with it.
+     */
+    _doRefreshInfo: function () {
       this._fetchMapInfo(
         $.proxy(function (info) {
-          // cache the currently selected map style
-          var currentMapStyle = this.map_info.map_style;
           // update the map_info property with the new data
           this.map_info = info;
-          // and then write the current selection back into the object
-          this.map_info.map_style = currentMapStyle;
+          // and then write the style for the current selection back into the object, the new
+          // data may have changed the zoom levels the styles are available at
+          this.map_info.map_style = this._scheduledStyle();
           this.map_info.draw = true;
           this.updateRecordCounter();
           // and redraw the map
           this.redraw();
         }, this),
+        $.proxy(this, '_extentLoaded'),
         function () {
           /* NO OP */
         },
@@ -384,6 +832,74 @@ this.tiledmap = this.tiledmap || {};
       this._refreshInfo();
     },
 
+    /**
+     * Set the style the user wants to see and redraw the map. If the style can't be displayed at
+     * the current zoom level then it will be displayed once the user zooms in far enough.
+     */
+    setStyle: function (style) {
+      this.preferred_style = style;
+      this.map_info.map_style = this._scheduledStyle();
+      this.redraw();
+    },
+
+    /**
+     * Returns true if the given style can be displayed at the current zoom level according to the
+     * style schedule in the map info.
+     */
+    isStyleAvailable: function (style) {
+      var schedule = this.map_info.style_schedule;
+      if (typeof schedule === 'undefined' || !this.map) {
+        return true;
+      }
+      return schedule[style] !== null && schedule[style] <= this.map.getZoom();
+    },
+
+    /**
+     * Returns the style that should be displayed at the current zoom level. This is the preferred
+     * style if it's available, otherwise the first available style in order of detail. If none
+     * are available then the style which becomes available at the lowest zoom level is used.
+     */
+    _scheduledStyle: function () {
+      var styles = this.map_info.map_styles;
+      var schedule = this.map_info.style_schedule;
+      var preferred = this.preferred_style;
+      if (this.isStyleAvailable(preferred)) {
+        return preferred;
+      }
+      var order = ['plot', 'gridded', 'heatmap'];
+      for (var i = 0; i < order.length; i++) {
+        if (order[i] in styles && this.isStyleAvailable(order[i])) {
+          return order[i];
+        }
+      }
+      var best = preferred;
+      for (var style in styles) {
+        if (
+          schedule[style] !== null &&
+          (schedule[best] === null || schedule[style] < schedule[best])
+        ) {
+          best = style;
+        }
+      }
+      return best;
+    },
+
+    /**
+     * Redraw the map if the style that should be displayed at the current zoom level has changed.
+     */
+    _applyStyleSchedule: function () {
+      if (!this.map_ready || !this.map_info.draw) {
+        return;
+      }
+      var style = this._scheduledStyle();
+      if (style !== this.map_info.map_style) {
+        this.map_info.map_style = style;
+        this.redraw();
+      } else {
+        this.controls['mapType'].updateSelection();
+      }
+    },
+
     /**
      * Redraw the map
      *
@@ -398,7 +914,12 @@ this.tiledmap = this.tiledmap || {};
       }
       // Setup tile request parameters
       var params = {};
-      params['query'] = this.map_info.query_body;
+      if (this.map_info.query_ref) {
+        // the tile server looks the query up using this reference
+        params['query_ref'] = this.map_info.query_ref;
+      } else {
+        params['query'] = this.map_info.query_body;
+      }
       params['style'] = this.map_info.map_style;
       var style = this.map_info.map_styles[this.map_info.map_style];
 
@@ -407,38 +928,84 @@ this.tiledmap = this.tiledmap || {};
       if (style.tile_source.params) {
         tile_params = $.extend(tile_params, style.tile_source.params);
       }
-      var tile_url = style.tile_source.url + '?' + $.param(tile_params);
+      var tile_url = style.tile_source.url + '?' + stableParam(tile_params);
 
-      for (var i in this.layers) {
-        this.map.removeLayer(this.layers[i]);
+      // Remove everything except the tile and grid layers which are only replaced if their URLs
+      // have changed (see below)
+      for (var name in this.layers) {
+        if (name !== 'plot' && name !== 'grid') {
+          this._removeLayer(name);
+        }
       }
-      this._removeAllLayers();
       if (this.filters.geom) {
         this._addLayer('selection', L.geoJson(this.filters.geom));
       }
-      this._addLayer(
-        'plot',
-        L.tileLayer(tile_url, {
-          noWrap: !this.map_info.repeat_map,
-        }),
-      );
+      var plot = this.layers['plot'];
+      var no_wrap = !this.map_info.repeat_map;
+      var tile_options = this._tileOptions();
+      // draw the grid map from the cell counts for the viewport instead of from tiles
+      // the counts are for elasticsearch's geotiles, so the cells must be a power of two pixels
+      // square to be drawn from them
+      var aggregate =
+        style.aggregate_url &&
+        isPowerOfTwo(this._aggregateResolution(style)) &&
+        this.aggregate_failed !== this._aggregateQuery(style);
+      if (aggregate) {
+        this._addAggregateLayers(style, no_wrap);
+      } else if (
+        !(plot instanceof my.PrioritisedTileLayer) ||
+        plot.options.noWrap !== no_wrap ||
+        !this._sameTileOptions(plot, tile_options)
+      ) {
+        this._addLayer(
+          'plot',
+          new my.PrioritisedTileLayer(
+            tile_url,
+            $.extend({ noWrap: no_wrap }, tile_options),
+          ),
+        );
+      } else if (plot._url !== tile_url) {
+        // this cancels the requests for the old tiles and loads the new ones
+        plot.setUrl(tile_url);
+      }
 
-      if (style.has_grid) {
+      if (style.has_grid && !aggregate) {
         var grid_params = $.extend({}, params);
         if (style.grid_source.params) {
           grid_params = $.extend(grid_params, style.grid_source.params);
         }
-        var grid_url = style.grid_source.url + '?' + $.param(grid_params);
+        var grid_url = style.grid_source.url + '?' + stableParam(grid_params);
 
-        this._addLayer(
-          'grid',
-          new L.UtfGrid(grid_url, {
-            resolution: style.grid_resolution,
-            useJsonP: false,
-            maxRequests: 4,
-            pointerCursor: false,
-          }),
-        );
+        // the grid resolution is given in tile pixels, convert it to screen pixels as the
+        // tiles may be displayed at a different size to the one they're rendered at
+        var resolution =
+          (style.grid_resolution * tile_options.tileSize) /
+          this.map_info.tile_options.tile_size;
+        var grid = this.layers['grid'];
+        if (
+          typeof grid === 'undefined' ||
+          grid._url !== grid_url ||
+          grid.options.resolution !== resolution ||
+          !this._sameTileOptions(grid, tile_options)
+        ) {
+          this._addLayer(
+            'grid',
+            new my.PrioritisedUtfGrid(
+              grid_url,
+              $.extend(
+                {
+                  resolution: resolution,
+                  useJsonP: false,
+                  maxRequests: 4,
+                  pointerCursor: false,
+                },
+                tile_options,
+              ),
+            ),
+          );
+        }
+      } else if (!aggregate) {
+        this._removeLayer('grid');
       }
       // Ensure that click events on the selection get passed to the map.
       if (typeof this.layers['selection'] !== 'undefined') {
@@ -450,6 +1017,7 @@ this.tiledmap = this.tiledmap || {};
       // Update controls & plugins
       this.updateControls();
       this.updatePlugins();
+      this.controls['mapType'].updateSelection();
 
       // Add plugin defined layers & call redraw on plugins.
       var extra_layers = this.invoke('layers');
@@ -459,6 +1027,180 @@ this.tiledmap = this.tiledmap || {};
       this.invoke('redraw', this.layers);
     },
 
+    /**
+     * Adds the layers which draw the grid map from the cell counts for the viewport, see
+     * _fetchAggregate. The counts we already have are drawn straight away if they're for the
+     * current query.
+     */
+    _addAggregateLayers: function (style, no_wrap) {
+      var params = style.tile_source.params || {};
+      var plot = new my.AggregateGridLayer({
+        noWrap: no_wrap,
+        coldColour: params.cold_colour,
+        hotColour: params.hot_colour,
+        rangeSize: parseInt(params.range_size, 10),
+      });
+      var grid = new my.AggregateGrid();
+      this._addLayer('plot', plot);
+      this._addLayer('grid', grid);
+      var request = this.aggregate_request;
+      if (request !== null && request.query === this._aggregateQuery(style)) {
+        plot.setGrid(this.aggregate);
+        grid.setGrid(this.aggregate);
+      }
+      this._fetchAggregate();
+    },
+
+    /**
+     * Returns the parameters of the /map-aggregate request for the current query, without the
+     * viewport, as a string.
+     */
+    _aggregateQuery: function (style) {
+      return stableParam(
+        $.extend(this._fetchParams(), {
+          grid_resolution: this._aggregateResolution(style),
+        }),
+      );
+    },
+
+    /**
+     * Returns the size of the grid map's cells in screen pixels.
+     */
+    _aggregateResolution: function (style) {
+      // the grid resolution is given in tile pixels, convert it to screen pixels as the tiles
+      // may be displayed at a different size to the one they're rendered at
+      var resolution =
+        ((style.tile_source.params.grid_resolution || style.grid_resolution) *
+          this._tileOptions().tileSize) /
+        this.map_info.tile_options.tile_size;
+      return Math.max(1, Math.round(resolution));
+    },
+
+    /**
+     * Fetch the cell counts for the viewport from /map-aggregate if the grid map is being drawn
+     * from them. The counts are requested for the tiles covering the viewport so that small pans
+     * don't need another request, and aren't requested again if we already have them.
+     */
+    _fetchAggregate: function () {
+      if (!(this.layers['plot'] instanceof my.AggregateGridLayer)) {
+        return;
+      }
+      var style = this.map_info.map_styles[this.map_info.map_style];
+      var zoom = this.map.getZoom();
+      var pixel_bounds = this.map.getPixelBounds();
+      var north_west = this.map.unproject(
+        L.point(
+          Math.floor(pixel_bounds.min.x / 256) * 256,
+          Math.floor(pixel_bounds.min.y / 256) * 256,
+        ),
+        zoom,
+      );
+      var south_east = this.map.unproject(
+        L.point(
+          Math.ceil(pixel_bounds.max.x / 256) * 256,
+          Math.ceil(pixel_bounds.max.y / 256) * 256,
+        ),
+        zoom,
+      );
+      var west = north_west.lng;
+      var east = south_east.lng;
+      // move the bounds into the world, if they go across the antimeridian just fetch the
+      // whole width of the world
+      var shift = Math.floor((west + 180) / 360) * 360;
+      west -= shift;
+      east -= shift;
+      if (east - west >= 360 || east > 180) {
+        west = -180;
+        east = 180;
+      }
+      var bounds = L.latLngBounds(
+        [south_east.lat, west],
+        [north_west.lat, east],
+      );
+
+      var query = this._aggregateQuery(style);
+      var request = this.aggregate_request;
+      if (
+        request !== null &&
+        request.query === query &&
+        request.zoom === zoom &&
+        request.bounds.contains(bounds)
+      ) {
+        return;
+      }
+      if (this.aggregate_jqxhr !== null) {
+        this.aggregate_jqxhr.abort();
+      }
+      request = { query: query, zoom: zoom, bounds: bounds };
+      this.aggregate_jqxhr = my.retryingAjax({
+        url: style.aggregate_url,
+        type: 'GET',
+        dataType: 'json',
+        data:
+          query +
+          '&' +
+          $.param({
+            bbox: [west, bounds.getSouth(), east, bounds.getNorth()].join(','),
+            zoom: zoom,
+          }),
+        success: $.proxy(function (data) {
+          this.aggregate_jqxhr = null;
+          this.aggregate = my.decodeAggregate(data);
+          this.aggregate_request = request;
+          if (this.layers['plot'] instanceof my.AggregateGridLayer) {
+            this.layers['plot'].setGrid(this.aggregate);
+            this.layers['grid'].setGrid(this.aggregate);
+          }
+        }, this),
+        error: $.proxy(function (jqXHR, status, error) {
+          if (status !== 'abort') {
+            // fall back to drawing the grid map from tiles for this query
+            this.aggregate_jqxhr = null;
+            this.aggregate_failed = query;
+            this.redraw();
+          }
+        }, this),
+      });
+    },
+
+    /**
+     * Returns true if the given layer was created with the same tile options as the given ones.
+     */
+    _sameTileOptions: function (layer, tile_options) {
+      return (
+        layer.options.tileSize === tile_options.tileSize &&
+        layer.options.zoomOffset === tile_options.zoomOffset &&
+        layer.options.subdomains.join(' ') ===
+          tile_options.subdomains.join(' ')
+      );
+    },
+
+    /**
+     * Returns the Leaflet layer options for the tile size in use. On high-DPI screens, when
+     * enabled, tiles larger than the standard 256 pixels are displayed at half their size and one
+     * zoom level higher which gives sharper tiles without increasing the number of requests.
+     */
+    _tileOptions: function () {
+      var tile_options = this.map_info.tile_options;
+      var options = {
+        tileSize: tile_options.tile_size,
+        zoomOffset: tile_options.zoom_offset,
+        // the tile URLs are spread across the available tile servers
+        subdomains: this.map_info.tile_servers,
+      };
+      if (
+        tile_options.detect_retina &&
+        L.Browser.retina &&
+        options.tileSize > 256
+      ) {
+        options.tileSize = options.tileSize / 2;
+        options.zoomOffset++;
+      }
+      // make sure we never ask for tiles at a zoom level below 0
+      options.minZoom = Math.max(0, -options.zoomOffset);
+      return options;
+    },
+
     /**
      * Open the sidebar.
      */
@@ -16,15 +16,32 @@ this.tiledmap = this.tiledmap || {};
         if ($active.length > 0 && $active.attr('stylecontrol') === style) {
           return;
         }
-        this.view.map_info.map_style = style;
-        $active.removeClass('active-selection');
-        $('a[stylecontrol=' + style + ']').addClass('active-selection');
-        this.view.redraw();
+        this.view.setStyle(style);
         e.stopPropagation();
         return false;
       }, this);
     },
 
+    /**
+     * Update the buttons to show which style is currently displayed and which styles can't be
+     * displayed at the current zoom level.
+     */
+    updateSelection: function () {
+      if (!this.$bar) {
+        return;
+      }
+      var view = this.view;
+      $('a', this.$bar).each(function () {
+        var style = $(this).attr('stylecontrol');
+        var title = view.map_info.map_styles[style].name;
+        var available = view.isStyleAvailable(style);
+        $(this)
+          .toggleClass('active-selection', style === view.map_info.map_style)
+          .toggleClass('unavailable-selection', !available)
+          .attr('title', available ? title : title + ' (zoom in to view)');
+      });
+    },
+
     onAdd: function (map) {
       this.$bar = $('<div>').addClass('leaflet-bar');
       for (var style in this.view.map_info.map_styles) {
@@ -41,6 +58,7 @@ this.tiledmap = this.tiledmap || {};
           $elem.addClass('active-selection');
         }
       }
+      this.updateSelection();
       return L.DomUtil.get(this.$bar.get(0));
     },
   });
@@ -11,6 +11,23 @@ this.tiledmap = this.tiledmap || {};
     this.enable = function () {
       this.grid = null;
       this.isactive = true;
+      this.paging = null;
+      view.sidebar_view.el.on(
+        'click.pointinfo',
+        '.point-detail-previous',
+        $.proxy(function (e) {
+          e.preventDefault();
+          this._showRecord(this.paging.index - 1);
+        }, this),
+      );
+      view.sidebar_view.el.on(
+        'click.pointinfo',
+        '.point-detail-next',
+        $.proxy(function (e) {
+          e.preventDefault();
+          this._showRecord(this.paging.index + 1);
+        }, this),
+      );
     };
 
     /**
@@ -19,6 +36,8 @@ this.tiledmap = this.tiledmap || {};
     this.disable = function () {
       // remove handlers
       this._disable_event_handlers();
+      view.sidebar_view.el.off('click.pointinfo');
+      this._stopPaging();
     };
 
     /**
@@ -59,6 +78,7 @@ this.tiledmap = this.tiledmap || {};
       if (!this.isactive) {
         return;
       }
+      this._stopPaging();
       if (typeof this.animation !== 'undefined') {
         if (this.animation_restart) {
           clearTimeout(this.animation_restart);
@@ -137,6 +157,9 @@ this.tiledmap = this.tiledmap || {};
           );
         }
         view.sidebar_view.render(props.data, options['template']);
+        if (props.data._multiple && props.data.geo_filter) {
+          this._startPaging(props.data);
+        }
         var ensure_point = view.map.latLngToContainerPoint([lat, lng]);
         view.openSidebar(ensure_point.x, ensure_point.y);
       } else {
@@ -147,6 +170,97 @@ this.tiledmap = this.tiledmap || {};
       }
     };
 
+    /**
+     * Start paging through the records at the clicked location in the sidebar. The records are
+     * requested from /map-records a page at a time and shown one at a time, starting with the
+     * first.
+     */
+    this._startPaging = function (data) {
+      this.paging = {
+        data: data,
+        records: [],
+        index: 0,
+        total: 0,
+        after: null,
+        done: false,
+      };
+      this._showRecord(0);
+    };
+
+    /**
+     * Stop paging through the records, aborting any request in flight.
+     */
+    this._stopPaging = function () {
+      if (this.records_jqxhr) {
+        this.records_jqxhr.abort();
+        this.records_jqxhr = null;
+      }
+      this.paging = null;
+    };
+
+    /**
+     * Show the record at the given index in the sidebar, requesting the next page of records
+     * first if it hasn't been loaded yet.
+     */
+    this._showRecord = function (index) {
+      var paging = this.paging;
+      if (!paging || index < 0 || this.records_jqxhr) {
+        return;
+      }
+      if (index < paging.records.length) {
+        paging.index = index;
+        var data = $.extend({}, paging.data, {
+          data: paging.records[index],
+          _pager: {
+            position: index + 1,
+            total: paging.total,
+            has_previous: index > 0,
+            has_next: index + 1 < paging.total,
+          },
+        });
+        view.sidebar_view.render(data, options['template']);
+      } else if (!paging.done) {
+        this._fetchRecords(
+          $.proxy(function () {
+            if (index < paging.records.length) {
+              this._showRecord(index);
+            }
+          }, this),
+        );
+      }
+    };
+
+    /**
+     * Request the next page of records at the location being paged through and call the callback
+     * once it has been added to the loaded records.
+     */
+    this._fetchRecords = function (callback) {
+      var paging = this.paging;
+      var params = view._fetchParams();
+      params['geo_filter'] = JSON.stringify(paging.data.geo_filter);
+      if (paging.after !== null) {
+        params['after'] = JSON.stringify(paging.after);
+      }
+      this.records_jqxhr = my.retryingAjax({
+        url: ckan.SITE_ROOT + '/map-records',
+        type: 'GET',
+        data: params,
+        success: $.proxy(function (page) {
+          this.records_jqxhr = null;
+          paging.total = page.total;
+          paging.records = paging.records.concat(page.records);
+          paging.after = page.after;
+          paging.done = page.after === null;
+          callback();
+        }, this),
+        error: $.proxy(function (jqXHR, status, error) {
+          this.records_jqxhr = null;
+          // the sidebar keeps showing the record from the grid, or the last record shown
+          paging.done = true;
+        }, this),
+      });
+    };
+
     /**
      * Animate
      */
@@ -0,0 +1,58 @@
+this.tiledmap = this.tiledmap || {};
+
+(function (my, $) {
+  // the number of times a rejected request is retried before giving up
+  var MAX_RETRIES = 3;
+
+  /**
+   * Make an ajax request with the given options. If the server's admission control rejects the
+   * request because it's busy (503) or we've made too many requests (429), the request is sent
+   * again after the number of seconds in the Retry-After header, up to MAX_RETRIES times, and the
+   * error callback is only called if the retries run out.
+   *
+   * Returns an object with an abort function, like a jqXHR, which aborts the request in flight
+   * and cancels any retry which is waiting.
+   */
+  my.retryingAjax = function (options) {
+    var retries = 0;
+    var timeout = null;
+    var jqxhr = null;
+    var error = options.error;
+
+    var send = function () {
+      timeout = null;
+      jqxhr = $.ajax(
+        $.extend({}, options, {
+          error: function (jqXHR, status, thrown) {
+            var retry_after = parseInt(
+              jqXHR.getResponseHeader('Retry-After'),
+              10,
+            );
+            if (
+              (jqXHR.status === 429 || jqXHR.status === 503) &&
+              !isNaN(retry_after) &&
+              retries < MAX_RETRIES
+            ) {
+              retries++;
+              timeout = setTimeout(send, retry_after * 1000);
+            } else if (error) {
+              error.apply(this, arguments);
+            }
+          },
+        }),
+      );
+    };
+
+    send();
+    return {
+      abort: function () {
+        if (timeout !== null) {
+          clearTimeout(timeout);
+          timeout = null;
+        } else {
+          jqxhr.abort();
+        }
+      },
+    };
+  };
+})(this.tiledmap, jQuery);
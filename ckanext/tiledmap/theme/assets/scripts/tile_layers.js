@@ -0,0 +1,478 @@
+this.tiledmap = this.tiledmap || {};
+
+(function (my, $) {
+  /**
+   * Returns the position of the centre of the map's viewport in tile coordinates.
+   */
+  function viewportCentre(map, tileSize) {
+    return map.getPixelBounds().getCenter().divideBy(tileSize);
+  }
+
+  /**
+   * Tile layer which limits the number of tile requests in flight and issues queued requests in
+   * order of their distance from the current viewport centre. Requests for tiles which are no
+   * longer needed (because they've scrolled out of view, the zoom level has changed or the layer's
+   * URL has been replaced) are dropped from the queue or cancelled if they're already in flight.
+   */
+  my.PrioritisedTileLayer = L.TileLayer.extend({
+    options: {
+      maxRequests: 6,
+      // tiles that scroll out of view are removed, which cancels their requests
+      unloadInvisibleTiles: true,
+    },
+
+    initialize: function (url, options) {
+      L.TileLayer.prototype.initialize.call(this, url, options);
+      this._pending = [];
+      this._inFlight = {};
+      this._inFlightCount = 0;
+    },
+
+    onRemove: function (map) {
+      this._cancelAll();
+      L.TileLayer.prototype.onRemove.call(this, map);
+    },
+
+    _reset: function (e) {
+      // the tiles are about to be thrown away so cancel everything we've got queued or in flight
+      this._cancelAll();
+      L.TileLayer.prototype._reset.call(this, e);
+    },
+
+    _update: function () {
+      L.TileLayer.prototype._update.call(this);
+      // start the requests for any tiles that have just been queued, this also reorders the queue
+      // as the viewport may have moved
+      this._processQueue();
+    },
+
+    _removeTile: function (key) {
+      var tile = this._tiles[key];
+      if (this._cancel(tile)) {
+        // the tile will never load so make sure the layer's load accounting stays correct
+        this._tileLoaded();
+      }
+      L.TileLayer.prototype._removeTile.call(this, key);
+    },
+
+    _loadTile: function (tile, tilePoint) {
+      tile._layer = this;
+      tile.onload = this._tileOnLoad;
+      tile.onerror = this._tileOnError;
+      // record the key and the unwrapped position of the tile before the point is adjusted
+      tile._tileKey = tilePoint.x + ':' + tilePoint.y;
+      tile._tileCentre = L.point(tilePoint.x + 0.5, tilePoint.y + 0.5);
+
+      this._adjustTilePoint(tilePoint);
+      tile._pendingUrl = this.getTileUrl(tilePoint);
+
+      // the request is started when the queue is processed at the end of the update
+      this._pending.push(tile);
+    },
+
+    _tileOnLoad: function () {
+      this._layer._requestFinished(this);
+      L.TileLayer.prototype._tileOnLoad.call(this);
+    },
+
+    _tileOnError: function () {
+      this._layer._requestFinished(this);
+      L.TileLayer.prototype._tileOnError.call(this);
+    },
+
+    /**
+     * Start as many of the pending requests as we're allowed, nearest to the viewport centre
+     * first.
+     */
+    _processQueue: function () {
+      if (!this._map || this._pending.length === 0) {
+        return;
+      }
+      var centre = viewportCentre(this._map, this._getTileSize());
+      this._pending.sort(function (a, b) {
+        return (
+          a._tileCentre.distanceTo(centre) - b._tileCentre.distanceTo(centre)
+        );
+      });
+      while (
+        this._pending.length > 0 &&
+        this._inFlightCount < this.options.maxRequests
+      ) {
+        var tile = this._pending.shift();
+        this._inFlight[tile._tileKey] = tile;
+        this._inFlightCount++;
+        tile.src = tile._pendingUrl;
+        this.fire('tileloadstart', {
+          tile: tile,
+          url: tile.src,
+        });
+      }
+    },
+
+    /**
+     * Called when a tile request completes, successfully or otherwise.
+     */
+    _requestFinished: function (tile) {
+      if (this._inFlight[tile._tileKey] === tile) {
+        delete this._inFlight[tile._tileKey];
+        this._inFlightCount--;
+      }
+      this._processQueue();
+    },
+
+    /**
+     * Remove the given tile from the queue, or cancel its request if it is in flight. Returns
+     * true if the tile was waiting on a request, false if not.
+     */
+    _cancel: function (tile) {
+      var pos = $.inArray(tile, this._pending);
+      if (pos >= 0) {
+        this._pending.splice(pos, 1);
+        return true;
+      }
+      if (this._inFlight[tile._tileKey] === tile) {
+        delete this._inFlight[tile._tileKey];
+        this._inFlightCount--;
+        // changing the source of the image aborts the request
+        tile.onload = tile.onerror = null;
+        tile.src = L.Util.emptyImageUrl;
+        return true;
+      }
+      return false;
+    },
+
+    /**
+     * Cancel all queued and in flight requests.
+     */
+    _cancelAll: function () {
+      for (var key in this._inFlight) {
+        var tile = this._inFlight[key];
+        tile.onload = tile.onerror = null;
+        tile.src = L.Util.emptyImageUrl;
+      }
+      this._pending = [];
+      this._inFlight = {};
+      this._inFlightCount = 0;
+    },
+  });
+
+  /**
+   * UtfGrid layer which issues queued grid requests in order of their distance from the current
+   * viewport centre and aborts any outstanding requests when it is removed from the map (i.e.
+   * when the query it was created for has been superseded).
+   */
+  my.PrioritisedUtfGrid = L.UtfGrid.extend({
+    options: {
+      // as with tile layers, the difference between the map's zoom level and the zoom level
+      // used in the grid URLs
+      zoomOffset: 0,
+    },
+
+    initialize: function (url, options) {
+      L.UtfGrid.prototype.initialize.call(this, url, options);
+      // the base class defines these on its prototype which means they're shared between
+      // instances, make sure each layer has its own
+      this._requests = {};
+      this._request_queue = [];
+      this._requests_in_process = [];
+    },
+
+    onRemove: function (map) {
+      // drop the queue first so that aborting the requests in flight doesn't start queued ones
+      this._request_queue = [];
+      var keys = [];
+      for (var key in this._requests) {
+        keys.push(key);
+      }
+      for (var i = 0; i < keys.length; i++) {
+        this._abort_request(keys[i]);
+      }
+      L.UtfGrid.prototype.onRemove.call(this, map);
+    },
+
+    _loadTile: function (zoom, x, y) {
+      // the same as the base class except that the zoom offset is applied to the URL, the key
+      // needs to use the map's zoom level as that's what the lookups use
+      var url = L.Util.template(
+        this._url,
+        L.Util.extend(
+          {
+            s: L.TileLayer.prototype._getSubdomain.call(this, { x: x, y: y }),
+            z: zoom + this.options.zoomOffset,
+            x: x,
+            y: y,
+          },
+          this.options,
+        ),
+      );
+
+      var key = zoom + '_' + x + '_' + y;
+      var self = this;
+      this._queue_request(key, function () {
+        return L.Util.ajax(url, function (data) {
+          self._cache[key] = data;
+          self._finish_request(key);
+        });
+      });
+    },
+
+    _process_queued_requests: function () {
+      while (
+        this._request_queue.length > 0 &&
+        (this.options.maxRequests == 0 ||
+          this._requests_in_process.length < this.options.maxRequests)
+      ) {
+        this._process_request(this._nearestQueuedRequest());
+      }
+    },
+
+    /**
+     * Remove and return the queued request key nearest to the viewport centre.
+     */
+    _nearestQueuedRequest: function () {
+      if (!this._map) {
+        return this._request_queue.pop();
+      }
+      var zoom = this._map.getZoom();
+      var max = this._map.options.crs.scale(zoom) / this.options.tileSize;
+      var centre = viewportCentre(this._map, this.options.tileSize);
+      var best = 0;
+      var best_distance = Infinity;
+      for (var i = 0; i < this._request_queue.length; i++) {
+        var parts = this._request_queue[i].split('_');
+        // tiles from other zoom levels go to the back of the queue
+        var distance = Infinity;
+        if (parseInt(parts[0], 10) === zoom) {
+          // the keys use wrapped coordinates so take the shortest way round the world
+          var dx = Math.abs(parseInt(parts[1], 10) + 0.5 - centre.x) % max;
+          var dy = parseInt(parts[2], 10) + 0.5 - centre.y;
+          dx = Math.min(dx, max - dx);
+          distance = Math.sqrt(dx * dx + dy * dy);
+        }
+        if (distance < best_distance || i === 0) {
+          best = i;
+          best_distance = distance;
+        }
+      }
+      return this._request_queue.splice(best, 1)[0];
+    },
+  });
+
+  /**
+   * Decodes a /map-aggregate response. The response lists the numbers of the cells containing
+   * records, each as the difference from the previous one, and the cells are numbered across each
+   * row of the response's cell range from the top left. The counts are decoded into a typed array
+   * with an entry for every cell in the range.
+   */
+  my.decodeAggregate = function (aggregate) {
+    var width = aggregate.size[0];
+    var height = aggregate.size[1];
+    var counts = new Uint32Array(width * height);
+    var cell = 0;
+    for (var i = 0; i < aggregate.cells.length; i++) {
+      cell += aggregate.cells[i];
+      counts[cell] = aggregate.counts[i];
+    }
+    return {
+      zoom: aggregate.zoom,
+      resolution: aggregate.grid_resolution,
+      // the number of cells across the world
+      columns: Math.ceil(
+        (256 * Math.pow(2, aggregate.zoom)) / aggregate.grid_resolution,
+      ),
+      column: aggregate.origin[0],
+      row: aggregate.origin[1],
+      width: width,
+      height: height,
+      counts: counts,
+      max: aggregate.max,
+    };
+  };
+
+  /**
+   * Returns the number of records in the given cell of the given decoded aggregate, or 0 if the
+   * cell is empty or outside the aggregate.
+   */
+  function cellCount(grid, column, row) {
+    // wrap the column around the world
+    column = ((column % grid.columns) + grid.columns) % grid.columns;
+    column -= grid.column;
+    row -= grid.row;
+    if (column < 0 || column >= grid.width || row < 0 || row >= grid.height) {
+      return 0;
+    }
+    return grid.counts[row * grid.width + column];
+  }
+
+  /**
+   * Parses a #rrggbb colour into an array of its red, green and blue values.
+   */
+  function parseColour(colour) {
+    colour = colour.replace('#', '');
+    return [0, 2, 4].map(function (i) {
+      return parseInt(colour.substr(i, 2), 16);
+    });
+  }
+
+  /**
+   * Canvas layer which draws the grid map from the cell counts of a /map-aggregate response
+   * instead of loading PNG tiles. The cells are coloured on a log scale from the cold colour for
+   * the emptiest to the hot colour for the fullest, like the tile server's grid map.
+   */
+  my.AggregateGridLayer = L.TileLayer.Canvas.extend({
+    options: {
+      coldColour: '#f4f11a',
+      hotColour: '#f02323',
+      rangeSize: 12,
+    },
+
+    initialize: function (options) {
+      L.setOptions(this, options);
+      this._grid = null;
+      var cold = parseColour(this.options.coldColour);
+      var hot = parseColour(this.options.hotColour);
+      var steps = Math.max(this.options.rangeSize - 1, 1);
+      this._colours = [];
+      for (var level = 0; level < this.options.rangeSize; level++) {
+        var colour = [0, 1, 2].map(function (i) {
+          return Math.round(cold[i] + ((hot[i] - cold[i]) * level) / steps);
+        });
+        this._colours.push('rgb(' + colour.join(',') + ')');
+      }
+    },
+
+    /**
+     * Sets the decoded aggregate to draw and redraws the layer.
+     */
+    setGrid: function (grid) {
+      this._grid = grid;
+      this.redraw();
+    },
+
+    drawTile: function (canvas, tilePoint, zoom) {
+      var context = canvas.getContext('2d');
+      context.clearRect(0, 0, canvas.width, canvas.height);
+      var grid = this._grid;
+      if (grid === null || grid.zoom !== zoom) {
+        return;
+      }
+      var tileSize = this.options.tileSize;
+      var resolution = grid.resolution;
+      var left = tilePoint.x * tileSize;
+      var top = tilePoint.y * tileSize;
+      var scale = Math.log(grid.max + 1);
+      var range = this._colours.length;
+      for (
+        var row = Math.floor(top / resolution);
+        row * resolution < top + tileSize;
+        row++
+      ) {
+        for (
+          var column = Math.floor(left / resolution);
+          column * resolution < left + tileSize;
+          column++
+        ) {
+          var count = cellCount(grid, column, row);
+          if (count > 0) {
+            var level = Math.floor((Math.log(count + 1) / scale) * range);
+            context.fillStyle = this._colours[Math.min(level, range - 1)];
+            context.fillRect(
+              column * resolution - left,
+              row * resolution - top,
+              resolution,
+              resolution,
+            );
+          }
+        }
+      }
+    },
+  });
+
+  /**
+   * Stands in for the UtfGrid layer when the grid map is drawn from a /map-aggregate response. It
+   * fires the same mouseover and mouseout events with the same data (the count and a geo_filter
+   * covering the cell) so the tooltip plugins work with either.
+   */
+  my.AggregateGrid = L.Class.extend({
+    includes: L.Mixin.Events,
+
+    initialize: function () {
+      this._grid = null;
+      this._mouseOn = null;
+      this._mouseOnKey = null;
+    },
+
+    onAdd: function (map) {
+      this._map = map;
+      map.on('mousemove', this._move, this);
+    },
+
+    onRemove: function (map) {
+      map.off('mousemove', this._move, this);
+      this._map = null;
+    },
+
+    /**
+     * Sets the decoded aggregate the events are fired for.
+     */
+    setGrid: function (grid) {
+      this._grid = grid;
+    },
+
+    _move: function (e) {
+      var grid = this._grid;
+      var key = null;
+      var count = 0;
+      if (grid !== null && grid.zoom === this._map.getZoom()) {
+        var point = this._map.project(e.latlng);
+        var column = Math.floor(point.x / grid.resolution);
+        var row = Math.floor(point.y / grid.resolution);
+        count = cellCount(grid, column, row);
+        key = column + ':' + row;
+      }
+      if (count === 0) {
+        key = null;
+      }
+      if (key === this._mouseOnKey) {
+        return;
+      }
+      if (this._mouseOn !== null) {
+        this.fire('mouseout', { latlng: e.latlng, data: this._mouseOn });
+      }
+      this._mouseOnKey = key;
+      this._mouseOn = null;
+      if (key !== null) {
+        this._mouseOn = {
+          count: count,
+          geo_filter: this._cellGeometry(column, row, grid.resolution),
+        };
+        this.fire('mouseover', { latlng: e.latlng, data: this._mouseOn });
+      }
+    },
+
+    /**
+     * Returns the GeoJSON polygon covering the given cell.
+     */
+    _cellGeometry: function (column, row, resolution) {
+      var map = this._map;
+      var zoom = map.getZoom();
+      var nw = map.unproject(L.point(column, row).multiplyBy(resolution), zoom);
+      var se = map.unproject(
+        L.point(column + 1, row + 1).multiplyBy(resolution),
+        zoom,
+      );
+      return {
+        type: 'Polygon',
+        coordinates: [
+          [
+            [nw.lng, nw.lat],
+            [se.lng, nw.lat],
+            [se.lng, se.lat],
+            [nw.lng, se.lat],
+            [nw.lng, nw.lat],
+          ],
+        ],
+      };
+    },
+  });
+})(this.tiledmap, jQuery);
@@ -9,6 +9,9 @@ this.ckan.module('tiledmap', function ($) {
       this.el = $(this.el);
       this.options.resource = JSON.parse(this.options.resource);
       this.options.resource_view = JSON.parse(this.options.resource_view);
+      this.options.map_info = this.options.map_info
+        ? JSON.parse(this.options.map_info)
+        : null;
 
       this.el.ready($.proxy(this, '_onReady'));
     },
@@ -49,6 +52,7 @@ this.ckan.module('tiledmap', function ($) {
       var geom = '';
       var fields = {};
       var q = '';
+      var version;
       if (window.parent.ckan && window.parent.ckan.views.filters) {
         var filters = window.parent.ckan.views.filters.get();
         for (var pname in filters) {
@@ -59,10 +63,13 @@ this.ckan.module('tiledmap', function ($) {
           }
         }
         q = window.parent.ckan.views.filters._searchParams.q;
+        version = window.parent.ckan.views.filters._searchParams.version;
       }
       this.view = new tiledmap.NHMMap({
         resource_id: this.options.resource.id,
         view_id: this.options.resource_view.id,
+        map_info: this.options.map_info,
+        version: version,
         filters: {
           fields: fields,
           geom: geom,
@@ -0,0 +1,232 @@
+/**
+ * Web worker which does the map's geometry work off the main thread. It loads and parses the
+ * countries GeoJSON, hit-tests points against the countries and converts their geometries into
+ * packed coordinate arrays which are transferred back to the main thread (rather than copied) and
+ * can be turned into Leaflet layers there without any further parsing.
+ *
+ * Messages sent to the worker are objects with a type, an id which is included in the reply and
+ * any parameters:
+ *
+ *  - {type: 'load', id: id, url: url} loads the countries from the given URL and replies with the
+ *    outlines of all the countries
+ *  - {type: 'hit', id: id, lat: lat, lng: lng} replies with the country at the given point, if
+ *    there is one
+ *
+ * Packed geometries are objects with three properties:
+ *
+ *  - coords: a Float64Array of the lng, lat pairs of every ring
+ *  - ring_sizes: an Int32Array of the number of points in each ring
+ *  - polygon_sizes: an Int32Array of the number of rings in each polygon, the first ring of each
+ *    polygon is its outer ring and the rest are its holes
+ */
+
+// the loaded countries, each with a name, a bbox and its packed geometry
+var countries = [];
+
+/**
+ * Returns the polygons of the given GeoJSON geometry as a list of lists of rings.
+ */
+function polygonsOf(geometry) {
+  if (geometry.type === 'Polygon') {
+    return [geometry.coordinates];
+  }
+  if (geometry.type === 'MultiPolygon') {
+    return geometry.coordinates;
+  }
+  return [];
+}
+
+/**
+ * Packs the given list of polygons into typed arrays.
+ */
+function pack(polygons) {
+  var point_count = 0;
+  var ring_count = 0;
+  var i, j, k;
+  for (i = 0; i < polygons.length; i++) {
+    ring_count += polygons[i].length;
+    for (j = 0; j < polygons[i].length; j++) {
+      point_count += polygons[i][j].length;
+    }
+  }
+  var packed = {
+    coords: new Float64Array(point_count * 2),
+    ring_sizes: new Int32Array(ring_count),
+    polygon_sizes: new Int32Array(polygons.length),
+  };
+  var c = 0;
+  var r = 0;
+  for (i = 0; i < polygons.length; i++) {
+    packed.polygon_sizes[i] = polygons[i].length;
+    for (j = 0; j < polygons[i].length; j++) {
+      var ring = polygons[i][j];
+      packed.ring_sizes[r++] = ring.length;
+      for (k = 0; k < ring.length; k++) {
+        packed.coords[c++] = ring[k][0];
+        packed.coords[c++] = ring[k][1];
+      }
+    }
+  }
+  return packed;
+}
+
+/**
+ * Returns a copy of the given packed geometry, so that it can be transferred without losing ours.
+ */
+function copy(packed) {
+  return {
+    coords: new Float64Array(packed.coords),
+    ring_sizes: new Int32Array(packed.ring_sizes),
+    polygon_sizes: new Int32Array(packed.polygon_sizes),
+  };
+}
+
+/**
+ * Returns the buffers of the given packed geometry, for transferring.
+ */
+function buffers(packed) {
+  return [
+    packed.coords.buffer,
+    packed.ring_sizes.buffer,
+    packed.polygon_sizes.buffer,
+  ];
+}
+
+/**
+ * Returns the [min lng, min lat, max lng, max lat] bounding box of the given packed geometry.
+ */
+function bboxOf(packed) {
+  var bbox = [Infinity, Infinity, -Infinity, -Infinity];
+  for (var i = 0; i < packed.coords.length; i += 2) {
+    bbox[0] = Math.min(bbox[0], packed.coords[i]);
+    bbox[1] = Math.min(bbox[1], packed.coords[i + 1]);
+    bbox[2] = Math.max(bbox[2], packed.coords[i]);
+    bbox[3] = Math.max(bbox[3], packed.coords[i + 1]);
+  }
+  return bbox;
+}
+
+/**
+ * Returns true if the point is inside the ring of the given size starting at the given offset
+ * into the coordinates array (using the ray casting algorithm).
+ */
+function inRing(coords, start, size, x, y) {
+  var inside = false;
+  for (var i = 0, j = size - 1; i < size; j = i++) {
+    var xi = coords[(start + i) * 2];
+    var yi = coords[(start + i) * 2 + 1];
+    var xj = coords[(start + j) * 2];
+    var yj = coords[(start + j) * 2 + 1];
+    if (yi > y !== yj > y && x < ((xj - xi) * (y - yi)) / (yj - yi) + xi) {
+      inside = !inside;
+    }
+  }
+  return inside;
+}
+
+/**
+ * Returns true if the point is inside the given packed geometry.
+ */
+function inGeometry(packed, x, y) {
+  var point = 0;
+  var ring = 0;
+  for (var i = 0; i < packed.polygon_sizes.length; i++) {
+    var inside = false;
+    for (var j = 0; j < packed.polygon_sizes[i]; j++) {
+      var size = packed.ring_sizes[ring++];
+      if (j === 0) {
+        inside = inRing(packed.coords, point, size, x, y);
+      } else if (inside && inRing(packed.coords, point, size, x, y)) {
+        // the point is in one of the polygon's holes
+        inside = false;
+      }
+      point += size;
+    }
+    if (inside) {
+      return true;
+    }
+  }
+  return false;
+}
+
+/**
+ * Load the countries from the given URL and return the outlines of all of them.
+ */
+function load(url) {
+  var request = new XMLHttpRequest();
+  request.open('GET', url, false);
+  request.send();
+  if (request.status !== 200) {
+    throw new Error('failed to load countries');
+  }
+  var data = JSON.parse(request.responseText);
+  // the file may hold a single feature collection or a list of them
+  var collections = Array.isArray(data) ? data : [data];
+  var outlines = [];
+  countries = [];
+  for (var i = 0; i < collections.length; i++) {
+    var features = collections[i].features;
+    for (var j = 0; j < features.length; j++) {
+      var polygons = polygonsOf(features[j].geometry);
+      if (polygons.length === 0) {
+        continue;
+      }
+      var packed = pack(polygons);
+      countries.push({
+        name: features[j].properties.name,
+        bbox: bboxOf(packed),
+        packed: packed,
+      });
+      outlines = outlines.concat(polygons);
+    }
+  }
+  return pack(outlines);
+}
+
+/**
+ * Returns the index of the country at the given point, or -1 if there isn't one.
+ */
+function hitTest(lat, lng) {
+  // the map repeats so bring the longitude back into the normal range
+  lng = ((((lng + 180) % 360) + 360) % 360) - 180;
+  for (var i = 0; i < countries.length; i++) {
+    var bbox = countries[i].bbox;
+    if (
+      lng >= bbox[0] &&
+      lat >= bbox[1] &&
+      lng <= bbox[2] &&
+      lat <= bbox[3] &&
+      inGeometry(countries[i].packed, lng, lat)
+    ) {
+      return i;
+    }
+  }
+  return -1;
+}
+
+self.onmessage = function (e) {
+  var message = e.data;
+  var reply = { id: message.id };
+  var transfer = [];
+  try {
+    if (message.type === 'load') {
+      reply.outlines = load(message.url);
+      transfer = buffers(reply.outlines);
+    } else if (message.type === 'hit') {
+      var index = hitTest(message.lat, message.lng);
+      reply.country = null;
+      if (index >= 0) {
+        var geometry = copy(countries[index].packed);
+        reply.country = {
+          id: index,
+          name: countries[index].name,
+          geometry: geometry,
+        };
+        transfer = buffers(geometry);
+      }
+    }
+  } catch (error) {
+    reply.error = error.message;
+  }
+  self.postMessage(reply, transfer);
+};
@@ -0,0 +1,23 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from ckanext.tiledmap.routes import _helpers
+
+
+@pytest.fixture
+def actions():
+    """
+    A dict of mock CKAN actions keyed on name, which tests add the actions they need
+    to. The toolkit used by the route helpers and the CLI is patched so that
+    get_action returns the actions from this dict. The datastore_get_rounded_version
+    action is included and rounds every version to 1000, the rounded versions already
+    cached are cleared so that it's called.
+    """
+    _helpers._rounded_versions.clear()
+    actions = {'datastore_get_rounded_version': MagicMock(return_value=1000)}
+    mock_toolkit = MagicMock(get_action=lambda name: actions[name])
+    with patch('ckanext.tiledmap.routes._helpers.toolkit', mock_toolkit), patch(
+        'ckanext.tiledmap.cli.toolkit', mock_toolkit
+    ):
+        yield actions
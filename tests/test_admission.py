@@ -0,0 +1,192 @@
+import threading
+from unittest.mock import MagicMock, patch
+
+from ckanext.tiledmap.config import config
+from ckanext.tiledmap.lib import admission
+from ckanext.tiledmap.lib.admission import (
+    BULK,
+    INTERACTIVE,
+    AdmissionController,
+    RateLimiter,
+    admit,
+    get_client,
+    get_priority,
+)
+
+
+class TestAdmissionController:
+    def test_limit(self):
+        controller = AdmissionController(2)
+        assert controller.acquire(INTERACTIVE, 0)
+        assert controller.acquire(INTERACTIVE, 0)
+        assert not controller.acquire(INTERACTIVE, 0)
+        controller.release()
+        assert controller.acquire(INTERACTIVE, 0)
+
+    def test_priority(self):
+        controller = AdmissionController(1)
+        assert controller.acquire(INTERACTIVE, 0)
+
+        admitted = []
+
+        def wait(priority, name):
+            if controller.acquire(priority, 5):
+                admitted.append(name)
+                controller.release()
+
+        bulk = threading.Thread(target=wait, args=(BULK, 'bulk'))
+        bulk.start()
+        # make sure the bulk request is queued first
+        while not controller._waiting:
+            pass
+        interactive = threading.Thread(target=wait, args=(INTERACTIVE, 'interactive'))
+        interactive.start()
+        while len(controller._waiting) < 2:
+            pass
+
+        controller.release()
+        bulk.join()
+        interactive.join()
+        assert admitted == ['interactive', 'bulk']
+
+
+class TestRateLimiter:
+    def test_burst(self):
+        limiter = RateLimiter(1, 2)
+        with patch('ckanext.tiledmap.lib.admission.time.monotonic', return_value=10):
+            assert limiter.take('client') == 0
+            assert limiter.take('client') == 0
+            assert limiter.take('client') == 1
+            # other clients have their own buckets
+            assert limiter.take('other') == 0
+
+    def test_refill(self):
+        limiter = RateLimiter(2, 1)
+        with patch('ckanext.tiledmap.lib.admission.time.monotonic') as monotonic:
+            monotonic.return_value = 10
+            assert limiter.take('client') == 0
+            assert limiter.take('client') == 0.5
+            monotonic.return_value = 10.5
+            assert limiter.take('client') == 0
+
+    def test_wait_time(self):
+        limiter = RateLimiter(2, 1)
+        with patch('ckanext.tiledmap.lib.admission.time.monotonic', return_value=10):
+            # checking doesn't take the token
+            assert limiter.wait_time('client') == 0
+            assert limiter.take('client') == 0
+            assert limiter.wait_time('client') == 0.5
+
+
+class TestGetPriority:
+    def test_priority(self):
+        cases = [
+            ({}, {}, BULK),
+            ({}, {'X-Requested-With': 'XMLHttpRequest'}, INTERACTIVE),
+            ({'priority': 'low'}, {'X-Requested-With': 'XMLHttpRequest'}, BULK),
+        ]
+        for params, headers, expected in cases:
+            mock_toolkit = MagicMock(request=MagicMock(params=params, headers=headers))
+            with patch('ckanext.tiledmap.lib.admission.toolkit', mock_toolkit):
+                assert get_priority() == expected
+
+
+class TestGetClient:
+    def mock_toolkit(self, user=None, remote_addr='10.0.0.1', headers=None):
+        return MagicMock(
+            c=MagicMock(user=user),
+            request=MagicMock(remote_addr=remote_addr, headers=headers or {}),
+        )
+
+    def test_user(self):
+        with patch(
+            'ckanext.tiledmap.lib.admission.toolkit', self.mock_toolkit(user='dave')
+        ):
+            assert get_client() == 'user:dave'
+
+    @patch.dict(config, {'versioned_tilemap.admission.client_header': ''})
+    def test_remote_addr(self):
+        headers = {'X-Forwarded-For': '1.2.3.4'}
+        with patch(
+            'ckanext.tiledmap.lib.admission.toolkit',
+            self.mock_toolkit(headers=headers),
+        ):
+            assert get_client() == 'ip:10.0.0.1'
+
+    @patch.dict(
+        config, {'versioned_tilemap.admission.client_header': 'X-Forwarded-For'}
+    )
+    def test_client_header(self):
+        cases = [
+            ({'X-Forwarded-For': '1.2.3.4'}, 'ip:1.2.3.4'),
+            # only the address added by our proxy can be trusted
+            ({'X-Forwarded-For': '5.6.7.8, 1.2.3.4'}, 'ip:1.2.3.4'),
+            ({}, 'ip:10.0.0.1'),
+        ]
+        for headers, expected in cases:
+            with patch(
+                'ckanext.tiledmap.lib.admission.toolkit',
+                self.mock_toolkit(headers=headers),
+            ):
+                assert get_client() == expected
+
+
+class TestAdmit:
+    @patch.dict(
+        config,
+        {
+            'versioned_tilemap.admission.enabled': True,
+            'versioned_tilemap.admission.max_concurrent': 1,
+            'versioned_tilemap.admission.queue_timeout': 1,
+            'versioned_tilemap.admission.rate': 1,
+            'versioned_tilemap.admission.burst': 1,
+        },
+    )
+    def test_rate_limit(self):
+        limited = admit(lambda: 'ok')
+        unlimited = admit(rate_limit=False)(lambda: 'ok')
+        mock_toolkit = MagicMock(
+            asbool=bool,
+            c=MagicMock(user='dave'),
+            request=MagicMock(params={}, headers={}),
+        )
+        with patch('ckanext.tiledmap.lib.admission.toolkit', mock_toolkit), patch(
+            'ckanext.tiledmap.lib.admission.reject', return_value='rejected'
+        ), patch.dict(admission._rate_limiters, clear=True):
+            assert limited() == 'ok'
+            assert limited() == 'rejected'
+            assert unlimited() == 'ok'
+
+    @patch.dict(
+        config,
+        {
+            'versioned_tilemap.admission.enabled': True,
+            'versioned_tilemap.admission.max_concurrent': 1,
+            'versioned_tilemap.admission.queue_timeout': 1,
+            'versioned_tilemap.admission.rate': 1,
+            'versioned_tilemap.admission.burst': 2,
+        },
+    )
+    def test_low_priority(self):
+        view = admit(lambda: 'ok')
+        params = {}
+        mock_toolkit = MagicMock(
+            asbool=bool,
+            c=MagicMock(user='dave'),
+            request=MagicMock(params=params, headers={}),
+        )
+        with patch('ckanext.tiledmap.lib.admission.toolkit', mock_toolkit), patch(
+            'ckanext.tiledmap.lib.admission.reject', return_value='rejected'
+        ), patch(
+            'ckanext.tiledmap.lib.admission.time.monotonic', return_value=10
+        ), patch.dict(admission._rate_limiters, clear=True):
+            params['priority'] = 'low'
+            assert view() == 'ok'
+            # the low priority request didn't use up an interactive token
+            params.clear()
+            assert view() == 'ok'
+            assert view() == 'ok'
+            # the low priority bucket still has a token but the client is over its
+            # limit, so the low priority request is the one rejected
+            params['priority'] = 'low'
+            assert view() == 'rejected'
@@ -0,0 +1,233 @@
+import sqlite3
+import threading
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from ckanext.tiledmap.config import config
+from ckanext.tiledmap.lib.cache import (
+    ExternalCache,
+    LocalClient,
+    MemoryCache,
+    SQLiteCache,
+    deserialise,
+    get_cache,
+    serialise,
+)
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'external'])
+def cache(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryCache(10000)
+    elif request.param == 'sqlite':
+        return SQLiteCache(str(tmp_path / 'cache.db'), 10000)
+    else:
+        return ExternalCache(client=LocalClient())
+
+
+def test_serialise():
+    small = {'total': 1}
+    large = {'records': [{'_id': i, 'name': 'beans'} for i in range(100)]}
+    assert deserialise(serialise(small)) == small
+    assert deserialise(serialise(large)) == large
+    # large values are compressed
+    assert len(serialise(large)) < len(str(large)) / 4
+
+
+def test_set_and_get(cache):
+    assert cache.get('beans') is None
+    cache.set('beans', {'total': 3, 'records': [1, 2, 3]})
+    assert cache.get('beans') == {'total': 3, 'records': [1, 2, 3]}
+    cache.set('beans', 'lemons')
+    assert cache.get('beans') == 'lemons'
+
+
+def test_ttl(cache):
+    cache.set('beans', 'lemons', ttl=-1)
+    assert cache.get('beans') is None
+
+
+@pytest.mark.parametrize('cache_class', [MemoryCache, SQLiteCache])
+def test_evicts_least_recently_used(cache_class, tmp_path):
+    if cache_class is SQLiteCache:
+        cache = SQLiteCache(str(tmp_path / 'cache.db'), 100)
+    else:
+        cache = MemoryCache(100)
+    # each of these serialises to 31 bytes
+    for key in ['one', 'two', 'three']:
+        cache.set(key, 'x' * 28)
+    cache.get('one')
+    cache.set('four', 'x' * 28)
+    assert cache.get('two') is None
+    assert cache.get('one') is not None
+    assert cache.get('four') is not None
+
+
+def test_sqlite_is_shared(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    SQLiteCache(path, 10000).set('beans', 'lemons')
+    assert SQLiteCache(path, 10000).get('beans') == 'lemons'
+
+
+def test_sqlite_reads_dont_write(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = SQLiteCache(path, 10000)
+    cache.set('beans', 'lemons')
+
+    # hold the write lock, reads should still work
+    connection = sqlite3.connect(path)
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        assert cache.get('beans') == 'lemons'
+    finally:
+        connection.rollback()
+        connection.close()
+
+
+def test_sqlite_keeps_total_size(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = SQLiteCache(path, 10000)
+    cache.set('beans', 'x' * 28)
+    cache.set('lemons', 'x' * 28)
+    cache.set('beans', 'x' * 8)
+    cache.set('goats', 'x', ttl=-1)
+    assert cache.get('goats') is None
+
+    connection = sqlite3.connect(path)
+    try:
+        (total,) = connection.execute('SELECT total FROM cache_size').fetchone()
+        (size,) = connection.execute('SELECT SUM(size) FROM cache').fetchone()
+    finally:
+        connection.close()
+    assert total == size == 31 + 11
+
+
+class InterleavingConnection:
+    """
+    Wraps an SQLite connection and calls interleave after the size of the value being
+    replaced has been read.
+    """
+
+    def __init__(self, connection, interleave):
+        self.connection = connection
+        self.interleave = interleave
+
+    def __enter__(self):
+        return self.connection.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self.connection.__exit__(*exc_info)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def execute(self, sql, *args):
+        cursor = self.connection.execute(sql, *args)
+        if sql.startswith('SELECT size'):
+            self.interleave()
+        return cursor
+
+
+def test_sqlite_writes_dont_interleave(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = SQLiteCache(path, 10000)
+    other = SQLiteCache(path, 10000)
+    cache.set('beans', 'x' * 8)
+    # another process replaces the value while this one is replacing it
+    writer = threading.Thread(target=other.set, args=('beans', 'x' * 28))
+
+    def interleave():
+        writer.start()
+        writer.join(0.5)
+
+    connect = cache._connect
+    with patch.object(
+        cache, '_connect', lambda: InterleavingConnection(connect(), interleave)
+    ):
+        cache.set('beans', 'x' * 18)
+    writer.join()
+
+    connection = sqlite3.connect(path)
+    try:
+        (total,) = connection.execute('SELECT total FROM cache_size').fetchone()
+        (size,) = connection.execute('SELECT SUM(size) FROM cache').fetchone()
+    finally:
+        connection.close()
+    # the other process's write waited for this one's and then replaced it
+    assert cache.get('beans') == 'x' * 28
+    assert total == size == 31
+
+
+def test_sqlite_counts_existing_values(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute(
+            'CREATE TABLE cache (key TEXT PRIMARY KEY, value BLOB, size INTEGER, '
+            'expires REAL, accessed REAL)'
+        )
+        connection.execute(
+            "INSERT INTO cache VALUES ('a', x'6a31', 80, NULL, 0), "
+            "('b', x'6a31', 80, NULL, 1)"
+        )
+    connection.close()
+
+    cache = SQLiteCache(path, 180)
+    # this takes the total over the maximum so the oldest value is evicted
+    cache.set('beans', 'x' * 28)
+    assert cache._get('a') is None
+    assert cache._get('b') is not None
+
+
+class BrokenCache(MemoryCache):
+    def _get(self, key):
+        raise ConnectionError()
+
+    def _set(self, key, data, ttl):
+        raise ConnectionError()
+
+
+def test_errors_are_misses():
+    cache = BrokenCache(10000)
+    with patch('ckanext.tiledmap.lib.cache.log', MagicMock()) as log:
+        cache.set('beans', 'lemons')
+        assert cache.get('beans') is None
+    assert log.warning.call_count == 2
+
+
+class TestGetCache:
+    @patch.dict(
+        config,
+        {'versioned_tilemap.cache': 'memory', 'versioned_tilemap.cache.max_size': 10},
+    )
+    def test_memory(self):
+        assert isinstance(get_cache(), MemoryCache)
+        assert get_cache() is get_cache()
+
+    @patch.dict(
+        config,
+        {
+            'versioned_tilemap.cache': 'sqlite',
+            'versioned_tilemap.cache.max_size': 10,
+            'versioned_tilemap.cache.path': None,
+        },
+    )
+    def test_sqlite_needs_path(self):
+        with pytest.raises(ValueError):
+            get_cache()
+
+    @patch.dict(
+        config,
+        {
+            'versioned_tilemap.cache': 'ckanext.tiledmap.lib.cache:MemoryCache',
+            'versioned_tilemap.cache.max_size': 20,
+        },
+    )
+    def test_custom(self):
+        assert isinstance(get_cache(), MemoryCache)
+
+    @patch.dict(config, {'versioned_tilemap.cache': 'beans'})
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            get_cache()
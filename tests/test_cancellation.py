@@ -0,0 +1,72 @@
+from unittest.mock import patch
+
+import pytest
+
+from ckanext.tiledmap.lib.cache import MemoryCache, SQLiteCache
+from ckanext.tiledmap.lib.cancellation import FetchSuperseded, FetchTracker
+from ckanext.tiledmap.routes._helpers import MapViewSettings
+
+
+class TestFetchTracker:
+    def test_superseded(self):
+        tracker = FetchTracker(MemoryCache(10000))
+        tracker.start('client', 'view', 1)
+        assert not tracker.is_superseded('client', 'view', 1)
+        tracker.start('client', 'view', 2)
+        assert tracker.is_superseded('client', 'view', 1)
+        assert not tracker.is_superseded('client', 'view', 2)
+
+    def test_out_of_order(self):
+        tracker = FetchTracker(MemoryCache(10000))
+        tracker.start('client', 'view', 2)
+        # an older request arriving late doesn't make the newer one superseded
+        tracker.start('client', 'view', 1)
+        assert not tracker.is_superseded('client', 'view', 2)
+        assert tracker.is_superseded('client', 'view', 1)
+
+    def test_separate(self):
+        tracker = FetchTracker(MemoryCache(10000))
+        tracker.start('client', 'view', 1)
+        tracker.start('client', 'other_view', 5)
+        tracker.start('other_client', 'view', 5)
+        assert not tracker.is_superseded('client', 'view', 1)
+
+    def test_unknown(self):
+        tracker = FetchTracker(MemoryCache(10000))
+        assert not tracker.is_superseded('client', 'view', 1)
+
+    def test_shared_between_processes(self, tmp_path):
+        path = str(tmp_path / 'cache.db')
+        tracker = FetchTracker(SQLiteCache(path, 10000))
+        other = FetchTracker(SQLiteCache(path, 10000))
+        tracker.start('client', 'view', 1)
+        # the newer request went to another process
+        other.start('client', 'view', 2)
+        assert tracker.is_superseded('client', 'view', 1)
+
+    def test_forgotten(self):
+        tracker = FetchTracker(MemoryCache(10000), ttl=-1)
+        tracker.start('client', 'view', 2)
+        assert not tracker.is_superseded('client', 'view', 1)
+
+
+class TestCheckSuperseded:
+    view = {'id': 'view', 'enable_plot_map': True}
+    resource = {'id': 'resource'}
+
+    def test_no_client(self):
+        settings = MapViewSettings(1, self.view, self.resource)
+        settings.check_superseded()
+
+    def test_superseded(self):
+        tracker = FetchTracker(MemoryCache(10000))
+        tracker.start('client', 'view', 2)
+        settings = MapViewSettings(1, self.view, self.resource, client_id='client')
+        with patch('ckanext.tiledmap.routes._helpers.fetch_tracker', tracker):
+            with pytest.raises(FetchSuperseded):
+                settings.check_superseded()
+            # the extent shouldn't be looked up
+            with patch.object(MapViewSettings, 'get_extent_info') as get_extent_info:
+                with pytest.raises(FetchSuperseded):
+                    settings.create_extent_info()
+                get_extent_info.assert_not_called()
@@ -0,0 +1,93 @@
+from unittest.mock import MagicMock, patch
+
+from click.testing import CliRunner
+
+from ckanext.tiledmap.cli import evict_queries, format_report, profile_view
+from ckanext.tiledmap.routes._helpers import MapViewSettings
+
+
+def add_view_actions(actions, view):
+    actions['resource_view_show'] = MagicMock(return_value=view)
+    actions['resource_show'] = MagicMock(return_value={'id': 'resource'})
+
+
+class TestProfileView:
+    def test_profile(self, actions):
+        view = {'id': 'view', 'resource_id': 'resource', 'enable_plot_map': True}
+        add_view_actions(actions, view)
+
+        def create_map_info(self):
+            self.timings['extent'] = 0.5
+            self.query_body_size = 120
+            return {'geom_count': 23}
+
+        with patch.object(MapViewSettings, 'create_map_info', create_map_info):
+            row = profile_view('view')
+
+        assert row['view_id'] == 'view'
+        assert row['resource_id'] == 'resource'
+        assert row['extent'] == 0.5
+        assert row['query_body_size'] == 120
+        assert row['geom_count'] == 23
+        assert row['total'] >= 0
+        assert 'error' not in row
+
+    def test_ignores_auth(self, actions):
+        view = {'id': 'view', 'resource_id': 'resource', 'enable_plot_map': True}
+        add_view_actions(actions, view)
+
+        def create_map_info(self):
+            return {'geom_count': self.version}
+
+        with patch.object(MapViewSettings, 'create_map_info', create_map_info):
+            row = profile_view('view')
+
+        assert row['geom_count'] == 1000
+        # the datastore actions are called without checking the user can see them
+        context = actions['datastore_get_rounded_version'].call_args[0][0]
+        assert context == {'ignore_auth': True}
+
+    def test_error(self, actions):
+        view = {'id': 'view', 'resource_id': 'resource', 'enable_plot_map': True}
+        add_view_actions(actions, view)
+
+        with patch.object(
+            MapViewSettings, 'create_map_info', side_effect=Exception('oh no')
+        ):
+            row = profile_view('view')
+
+        assert row == {'view_id': 'view', 'resource_id': 'resource', 'error': 'oh no'}
+
+    def test_not_enabled(self, actions):
+        add_view_actions(actions, {'id': 'view', 'resource_id': 'resource'})
+
+        row = profile_view('view')
+
+        assert row['error'] == 'no map styles enabled'
+
+
+def test_format_report():
+    rows = [
+        {'view_id': 'a', 'total': 1.5, 'geom_count': 10},
+        {'view_id': 'b', 'error': 'oh no'},
+    ]
+    lines = format_report(rows).split('\n')
+    assert lines[0].startswith('view_id')
+    assert 'total (ms)' in lines[0]
+    assert lines[1].split() == ['a', '1500.0', '10']
+    assert lines[2].split() == ['b', 'oh', 'no']
+
+
+class TestEvictQueries:
+    def test_evict(self):
+        query_store = MagicMock(evict=MagicMock(return_value=3))
+        with patch('ckanext.tiledmap.cli.get_query_store', return_value=query_store):
+            result = CliRunner().invoke(evict_queries, ['--max-age', '2'])
+        assert result.exit_code == 0
+        assert 'Deleted 3 queries' in result.output
+        query_store.evict.assert_called_once_with(2 * 24 * 60 * 60)
+
+    def test_not_enabled(self):
+        with patch('ckanext.tiledmap.cli.get_query_store', return_value=None):
+            result = CliRunner().invoke(evict_queries)
+        assert result.exit_code != 0
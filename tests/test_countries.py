@@ -0,0 +1,60 @@
+from ckanext.tiledmap.lib.countries import CountryIndex, get_country_index
+
+
+def square(x, y, size):
+    return [[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]
+
+
+class TestCountryIndex:
+    features = [
+        {
+            'properties': {'adm0_a3': 'A', 'name': 'With a hole'},
+            'geometry': {
+                'type': 'Polygon',
+                'coordinates': [square(0, 0, 10), square(4, 4, 2)],
+            },
+        },
+        {
+            'properties': {'adm0_a3': 'B', 'name': 'Islands'},
+            'geometry': {
+                'type': 'MultiPolygon',
+                'coordinates': [[square(20, 20, 1)], [square(170, -40, 5)]],
+            },
+        },
+        {
+            'properties': {'adm0_a3': 'C', 'name': 'Not a polygon'},
+            'geometry': {'type': 'Point', 'coordinates': [50, 50]},
+        },
+    ]
+
+    def test_hit(self):
+        index = CountryIndex(self.features)
+        assert index.hit_test(1, 1)['id'] == 'A'
+        assert index.hit_test(20.5, 20.5)['name'] == 'Islands'
+
+    def test_hole(self):
+        index = CountryIndex(self.features)
+        assert index.hit_test(5, 5) is None
+        assert index.hit_test(3.5, 5) is not None
+
+    def test_miss(self):
+        index = CountryIndex(self.features)
+        assert index.hit_test(-1, -1) is None
+        assert index.hit_test(50, 50) is None
+        assert index.hit_test(95, 0) is None
+
+    def test_wrapped(self):
+        index = CountryIndex(self.features)
+        assert index.hit_test(1, 361)['id'] == 'A'
+        assert index.hit_test(-37, 172 - 360)['id'] == 'B'
+
+    def test_returns_geometry(self):
+        index = CountryIndex(self.features)
+        assert index.hit_test(1, 1)['geometry'] == self.features[0]['geometry']
+
+
+def test_countries_dataset():
+    index = get_country_index()
+    assert index.hit_test(51.5, -0.1)['name'] == 'United Kingdom'
+    assert index.hit_test(-25, 134)['id'] == 'AUS'
+    assert index.hit_test(0, -30) is None
@@ -0,0 +1,127 @@
+import pstats
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from ckanext.tiledmap.config import config
+from ckanext.tiledmap.lib import profiling
+
+
+def mock_request(headers=None, sysadmin=False):
+    mock_toolkit = MagicMock(
+        asbool=lambda value: str(value).lower() == 'true',
+        request=MagicMock(headers=headers or {}),
+    )
+    mock_authz = MagicMock(is_sysadmin=MagicMock(return_value=sysadmin))
+    return (
+        patch('ckanext.tiledmap.lib.profiling.toolkit', mock_toolkit),
+        patch('ckanext.tiledmap.lib.profiling.authz', mock_authz),
+    )
+
+
+class TestShouldProfile:
+    @patch.dict(
+        config,
+        {
+            'versioned_tilemap.profiling.enabled': 'false',
+            'versioned_tilemap.profiling.sample_rate': '1',
+        },
+    )
+    def test_disabled(self):
+        toolkit_patch, authz_patch = mock_request({profiling.PROFILE_HEADER: '1'}, True)
+        with toolkit_patch, authz_patch:
+            assert not profiling.should_profile()
+
+    @patch.dict(
+        config,
+        {
+            'versioned_tilemap.profiling.enabled': 'true',
+            'versioned_tilemap.profiling.path': '/tmp/profiles',
+            'versioned_tilemap.profiling.sample_rate': '0',
+        },
+    )
+    def test_header(self):
+        toolkit_patch, authz_patch = mock_request({profiling.PROFILE_HEADER: '1'}, True)
+        with toolkit_patch, authz_patch:
+            assert profiling.should_profile()
+
+    @patch.dict(
+        config,
+        {
+            'versioned_tilemap.profiling.enabled': 'true',
+            'versioned_tilemap.profiling.path': '/tmp/profiles',
+            'versioned_tilemap.profiling.sample_rate': '0',
+        },
+    )
+    def test_header_not_sysadmin(self):
+        toolkit_patch, authz_patch = mock_request({profiling.PROFILE_HEADER: '1'})
+        with toolkit_patch, authz_patch:
+            assert not profiling.should_profile()
+
+    @patch.dict(
+        config,
+        {
+            'versioned_tilemap.profiling.enabled': 'true',
+            'versioned_tilemap.profiling.path': '/tmp/profiles',
+            'versioned_tilemap.profiling.sample_rate': '1',
+        },
+    )
+    def test_sampled(self):
+        toolkit_patch, authz_patch = mock_request()
+        with toolkit_patch, authz_patch:
+            assert profiling.should_profile()
+
+    @patch.dict(
+        config,
+        {
+            'versioned_tilemap.profiling.enabled': 'true',
+            'versioned_tilemap.profiling.sample_rate': '1',
+            'versioned_tilemap.profiling.path': '',
+        },
+    )
+    def test_no_path(self):
+        toolkit_patch, authz_patch = mock_request({profiling.PROFILE_HEADER: '1'}, True)
+        with toolkit_patch, authz_patch:
+            assert not profiling.should_profile()
+
+
+class TestCheckConfig:
+    @patch.dict(
+        config,
+        {
+            'versioned_tilemap.profiling.enabled': 'true',
+            'versioned_tilemap.profiling.path': '',
+        },
+    )
+    def test_no_path(self):
+        toolkit_patch, authz_patch = mock_request()
+        with toolkit_patch, authz_patch, pytest.raises(ValueError):
+            profiling.check_config()
+
+    @patch.dict(
+        config,
+        {
+            'versioned_tilemap.profiling.enabled': 'false',
+            'versioned_tilemap.profiling.path': '',
+        },
+    )
+    def test_disabled(self):
+        toolkit_patch, authz_patch = mock_request()
+        with toolkit_patch, authz_patch:
+            profiling.check_config()
+
+
+class TestProfile:
+    def test_profile(self, tmp_path):
+        with patch.dict(config, {'versioned_tilemap.profiling.path': str(tmp_path)}):
+            result, path = profiling.profile('test', sorted, [3, 1, 2])
+
+        assert result == [1, 2, 3]
+        assert path.startswith(str(tmp_path / 'test-'))
+        # check the profile can be read
+        pstats.Stats(path)
+
+    @patch.dict(config, {'versioned_tilemap.profiling.path': ''})
+    def test_no_path(self):
+        with pytest.raises(ValueError):
+            profiling.profile('test', sorted, [3, 1, 2])
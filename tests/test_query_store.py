@@ -0,0 +1,117 @@
+import sqlite3
+import time
+from unittest.mock import patch
+
+import pytest
+
+from ckanext.tiledmap.config import config
+from ckanext.tiledmap.lib import query_store
+from ckanext.tiledmap.lib.query_store import (
+    FileQueryStore,
+    QueryStore,
+    SQLiteQueryStore,
+    get_query_store,
+)
+
+
+@pytest.fixture(params=['file', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'file':
+        return FileQueryStore(str(tmp_path))
+    else:
+        return SQLiteQueryStore(str(tmp_path / 'queries.db'))
+
+
+def test_put_and_get(store):
+    key = store.put(b'H4sIAAAAAAAAA6tWKkktLlGyUlAqS8wpTVWqBQA')
+    assert QueryStore.is_valid_key(key)
+    assert store.get(key) == 'H4sIAAAAAAAAA6tWKkktLlGyUlAqS8wpTVWqBQA'
+
+
+def test_same_query_same_key(store):
+    assert store.put('beans') == store.put(b'beans')
+    assert store.put('beans') != store.put('lemons')
+
+
+def test_missing(store):
+    assert store.get(QueryStore.key('beans')) is None
+
+
+def test_put_skips_known_keys(store):
+    with patch.object(store, '_put', wraps=store._put) as put:
+        key = store.put('beans')
+        assert store.put('beans') == key
+        put.assert_called_once_with(key, 'beans')
+
+        # after the touch interval the query is stored again to record that it's used
+        later = time.time() + query_store.TOUCH_INTERVAL + 1
+        with patch('ckanext.tiledmap.lib.query_store.time.time', return_value=later):
+            store.put('beans')
+        assert put.call_count == 2
+
+
+def test_evict(store):
+    key = store.put('beans')
+    assert store.evict(60 * 60) == 0
+    assert store.get(key) == 'beans'
+
+    later = time.time() + 2 * 60 * 60
+    with patch('ckanext.tiledmap.lib.query_store.time.time', return_value=later):
+        assert store.evict(60 * 60) == 1
+    assert store.get(key) is None
+
+
+def test_sqlite_adds_used_column(tmp_path):
+    path = str(tmp_path / 'queries.db')
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute('CREATE TABLE queries (key TEXT PRIMARY KEY, body TEXT)')
+        connection.execute("INSERT INTO queries VALUES ('a', 'beans')")
+    connection.close()
+
+    store = SQLiteQueryStore(path)
+    assert store.get('a') == 'beans'
+    assert store.evict(60 * 60) == 0
+
+
+def test_is_valid_key():
+    assert QueryStore.is_valid_key(QueryStore.key('beans'))
+    assert not QueryStore.is_valid_key('../../etc/passwd')
+    assert not QueryStore.is_valid_key('beans')
+
+
+class TestGetQueryStore:
+    @patch.dict(config, {'versioned_tilemap.query_store': ''})
+    def test_disabled(self):
+        assert get_query_store() is None
+
+    def test_file(self, tmp_path):
+        options = {
+            'versioned_tilemap.query_store': 'file',
+            'versioned_tilemap.query_store.path': str(tmp_path),
+        }
+        with patch.dict(config, options), patch.dict(query_store._query_stores):
+            store = get_query_store()
+            assert isinstance(store, FileQueryStore)
+            assert get_query_store() is store
+
+    def test_dotted_path(self, tmp_path):
+        options = {
+            'versioned_tilemap.query_store': (
+                'ckanext.tiledmap.lib.query_store:SQLiteQueryStore'
+            ),
+            'versioned_tilemap.query_store.path': str(tmp_path / 'queries.db'),
+        }
+        with patch.dict(config, options), patch.dict(query_store._query_stores):
+            assert isinstance(get_query_store(), SQLiteQueryStore)
+
+    @patch.dict(
+        config,
+        {
+            'versioned_tilemap.query_store': 'beans',
+            'versioned_tilemap.query_store.path': '/tmp',
+        },
+    )
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            get_query_store()
@@ -0,0 +1,266 @@
+import base64
+import gzip
+import json
+import struct
+import zlib
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from ckanext.tiledmap.lib import renderer
+
+
+def decode_png(data):
+    assert data[:8] == b'\x89PNG\r\n\x1a\n'
+    position = 8
+    chunks = {}
+    while position < len(data):
+        (length,) = struct.unpack('>I', data[position : position + 4])
+        chunk_type = data[position + 4 : position + 8]
+        chunk = data[position + 8 : position + 8 + length]
+        (checksum,) = struct.unpack(
+            '>I', data[position + 8 + length : position + 12 + length]
+        )
+        assert checksum == zlib.crc32(chunk_type + chunk) & 0xFFFFFFFF
+        chunks[chunk_type] = chunk
+        position += length + 12
+    width, height = struct.unpack('>II', chunks[b'IHDR'][:8])
+    raw = np.frombuffer(zlib.decompress(chunks[b'IDAT']), dtype=np.uint8)
+    rows = raw.reshape(height, width * 4 + 1)
+    assert (rows[:, 0] == 0).all()
+    return rows[:, 1:].reshape(height, width, 4)
+
+
+def test_decode_query_body():
+    query = {'indexes': ['nhm-beans'], 'search': {'query': {'match_all': {}}}}
+    query_body = base64.urlsafe_b64encode(gzip.compress(json.dumps(query).encode()))
+    assert renderer.decode_query_body(query_body.decode()) == query
+    assert renderer.decode_query_body(query_body) == query
+
+
+def test_decode_query_body_limits_size():
+    query = {'indexes': ['nhm-beans'], 'search': {'query': {'match_all': {}}}}
+    query_body = base64.urlsafe_b64encode(gzip.compress(json.dumps(query).encode()))
+    with pytest.raises(ValueError):
+        renderer.decode_query_body(query_body, max_size=10)
+    with pytest.raises(ValueError):
+        renderer.decode_query_body(base64.urlsafe_b64encode(b'beans'))
+
+
+def test_tile_bounds():
+    north, west, south, east = renderer.tile_bounds(0, 0, 0)
+    assert north == pytest.approx(renderer.MAX_LATITUDE, abs=1e-3)
+    assert (west, east) == (-180, 180)
+    assert south == pytest.approx(-renderer.MAX_LATITUDE, abs=1e-3)
+
+    assert renderer.tile_bounds(1, 1, 0) == pytest.approx((north, 0, 0, 180), abs=1e-6)
+    # margins are clamped to the world
+    assert renderer.tile_bounds(1, 1, 0, 0.5) == pytest.approx(
+        (north, -90, -66.51326, 180), abs=1e-4
+    )
+
+
+def test_project():
+    columns, rows = renderer.project(
+        np.array([0.0, renderer.MAX_LATITUDE, 0.0]),
+        np.array([0.0, -180.0, 90.0]),
+        1,
+        0,
+        0,
+        256,
+    )
+    assert columns == pytest.approx([256, 0, 384])
+    assert rows == pytest.approx([256, 0, 256], abs=1e-2)
+
+
+def test_colour():
+    assert renderer.colour('#ee0000') == '#ee0000'
+    with pytest.raises(ValueError):
+        renderer.colour('red')
+    assert list(renderer.parse_colour('#ff8001')) == [255, 128, 1, 255]
+
+
+def test_check_style_params():
+    valid = [
+        {'point_radius': 4, 'border_width': 1},
+        {'point_radius': 32, 'border_width': 32},
+        {'point_radius': 1, 'intensity': 0.0},
+        {'point_radius': 8, 'intensity': 1.0},
+        {'grid_resolution': 8, 'range_size': 1},
+        {'grid_resolution': 256, 'range_size': 12},
+    ]
+    for params in valid:
+        renderer.check_style_params(params, 256)
+
+    invalid = [
+        {'point_radius': 5000, 'border_width': 1},
+        {'point_radius': 0, 'border_width': 0},
+        {'point_radius': 4, 'border_width': 5},
+        {'point_radius': 4, 'border_width': -1},
+        {'grid_resolution': 0, 'range_size': 12},
+        {'grid_resolution': 7, 'range_size': 12},
+        {'grid_resolution': 8, 'range_size': 0},
+        {'point_radius': 8, 'intensity': 1.5},
+        {'point_radius': 8, 'intensity': -0.1},
+    ]
+    for params in invalid:
+        with pytest.raises(ValueError):
+            renderer.check_style_params(params, 256)
+
+
+def test_bin_points():
+    columns = np.array([0.5, 1.5, 1.2, 3.9, -0.5, 4.0])
+    rows = np.array([0.5, 0.5, 0.7, 3.9, 0.5, 0.0])
+    assert renderer.bin_points(columns, rows, 4).tolist() == [
+        [1, 2, 0, 0],
+        [0, 0, 0, 0],
+        [0, 0, 0, 0],
+        [0, 0, 0, 1],
+    ]
+    assert renderer.bin_points(columns, rows, 4, cell_size=2).tolist() == [
+        [3, 0],
+        [0, 1],
+    ]
+    # the padding catches the points just outside the tile
+    assert renderer.bin_points(columns, rows, 4, pad=1).sum() == 6
+
+
+def test_render_plot():
+    image = renderer.render_plot(
+        np.array([8.5]), np.array([8.5]), 16, 3, '#ee0000', 1, '#ffffff'
+    )
+    assert image.shape == (16, 16, 4)
+    assert image[8, 8].tolist() == [238, 0, 0, 255]
+    assert image[8, 11].tolist() == [255, 255, 255, 255]
+    assert image[8, 12].tolist() == [0, 0, 0, 0]
+    assert image[0, 0].tolist() == [0, 0, 0, 0]
+
+    # points just outside the tile are drawn where they overlap it
+    image = renderer.render_plot(
+        np.array([-1.5]), np.array([8.5]), 16, 3, '#ee0000', 1, '#ffffff'
+    )
+    assert image[8, 0].tolist() == [238, 0, 0, 255]
+
+
+def test_render_gridded():
+    columns = np.array([1.0, 1.0, 1.0, 5.0])
+    rows = np.array([1.0, 1.0, 1.0, 1.0])
+    image = renderer.render_gridded(columns, rows, 8, 4, '#0000ff', '#ff0000', 4)
+    assert image[0, 0].tolist() == [255, 0, 0, 255]
+    assert image[3, 3].tolist() == [255, 0, 0, 255]
+    # the cell with fewer points is cooler
+    assert image[0, 4, 0] < 255
+    assert image[0, 4, 3] == 255
+    assert image[4, 0].tolist() == [0, 0, 0, 0]
+
+
+def test_render_heatmap():
+    image = renderer.render_heatmap(
+        np.array([8.0] * 10), np.array([8.0] * 10), 16, 4, '#0000ff', '#ff0000', 0.5
+    )
+    # the heat fades away from the points
+    assert image[8, 8, 3] > image[8, 11, 3] > image[0, 0, 3]
+    assert image[8, 8, 0] > image[8, 11, 0]
+
+
+def test_render_utf_grid():
+    lats = np.array([1.0, 2.0, 3.0])
+    lngs = np.array([4.0, 5.0, 6.0])
+    columns = np.array([1.0, 2.0, 5.0])
+    rows = np.array([1.0, 1.0, 5.0])
+    records = [{'_id': 1}, {'_id': 2}, {'_id': 3}]
+    grid = renderer.render_utf_grid(lats, lngs, columns, rows, records, 0, 0, 0, 8, 4)
+
+    assert grid['keys'] == ['', '0', '3']
+    assert grid['grid'] == ['! ', ' #']
+    assert grid['data']['0']['count'] == 2
+    assert grid['data']['0']['data'] == {'_id': 1}
+    assert grid['data']['0']['record_latitude'] == 1.0
+    assert grid['data']['3']['data'] == {'_id': 3}
+    polygon = grid['data']['3']['geo_filter']['coordinates'][0]
+    assert polygon[0] == pytest.approx([0, 0], abs=1e-6)
+    assert polygon[2] == pytest.approx([180, -renderer.MAX_LATITUDE], abs=1e-3)
+
+
+def test_utf_grid_codes_skip_escaped_characters():
+    n = 8
+    columns = np.tile(np.arange(n) + 0.5, n)
+    rows = np.repeat(np.arange(n) + 0.5, n)
+    lats = np.zeros(n * n)
+    grid = renderer.render_utf_grid(lats, lats, columns, rows, None, 0, 0, 0, n, 1)
+    characters = ''.join(grid['grid'])
+    assert '"' not in characters
+    assert '\\' not in characters
+    assert len(set(characters)) == n * n
+
+
+def test_encode_png():
+    image = np.random.randint(0, 256, (12, 10, 4), dtype=np.uint8)
+    assert (decode_png(renderer.encode_png(image)) == image).all()
+
+
+@patch('ckanext.tiledmap.lib.renderer.search_points')
+def test_render_tile(search_points):
+    search_points.return_value = (np.array([0.0]), np.array([0.0]), None)
+    params = {
+        'point_radius': 4,
+        'point_colour': '#ee0000',
+        'border_width': 1,
+        'border_colour': '#ffffff',
+    }
+    image = decode_png(renderer.render_tile({}, 0, 0, 0, 256, 'plot', params))
+    assert image[128, 128].tolist() == [238, 0, 0, 255]
+    # the search includes the points which overlap the edge of the tile
+    (_, bounds), _ = search_points.call_args
+    assert bounds[1] == -180
+
+
+def test_search_points():
+    pages = [
+        {
+            'hits': {
+                'hits': [
+                    {'_source': {'meta': {'geo': '1.5,2.5'}, 'data': {'_id': 1}}},
+                    {'_source': {'meta': {'geo': '3,4'}}, 'sort': [2]},
+                ]
+            }
+        },
+        {'hits': {'hits': [{'_source': {'meta': {'geo': '5,6'}}, 'sort': [3]}]}},
+    ]
+    search = MagicMock()
+    search.extra.return_value = search
+    search.execute.return_value.to_dict.side_effect = pages
+    for name in ('index', 'using', 'filter', 'source', 'sort'):
+        getattr(search, name).return_value = search
+    mock_search_class = MagicMock(from_dict=MagicMock(return_value=search))
+    elasticsearch_dsl = MagicMock(Search=mock_search_class)
+    common = MagicMock()
+    modules = {
+        'elasticsearch_dsl': elasticsearch_dsl,
+        'ckanext.versioned_datastore': MagicMock(lib=MagicMock(common=common)),
+        'ckanext.versioned_datastore.lib': MagicMock(common=common),
+        'ckanext.versioned_datastore.lib.common': common,
+    }
+    config = {'versioned_tilemap.renderer.max_points': 2}
+    with patch.dict('sys.modules', modules), patch.dict(renderer.config, config):
+        query = {
+            'indexes': ['nhm-beans'],
+            'search': {'query': {'term': {'beans': 1}}, 'aggs': {'beans': {}}},
+        }
+        lats, lngs, records = renderer.search_points(
+            query, (10, -10, -10, 10), ['_id', 'name']
+        )
+
+    assert lats.tolist() == [1.5, 3]
+    assert lngs.tolist() == [2.5, 4]
+    assert records == [{'_id': 1}, {}]
+    # only the query is used and only the given fields are returned
+    mock_search_class.from_dict.assert_called_once_with(
+        {'query': {'term': {'beans': 1}}}
+    )
+    search.source.assert_called_once_with(['meta.geo', 'data._id', 'data.name'])
+    # one page of at most max_points
+    search.execute.assert_called_once()
+    search.extra.assert_called_once_with(from_=0, size=2)
@@ -1,7 +1,32 @@
+import math
 from functools import wraps
 from unittest.mock import MagicMock, patch
 
-from ckanext.tiledmap.routes._helpers import extract_q_and_filters
+import pytest
+
+from ckanext.tiledmap.config import config
+from ckanext.tiledmap.lib.cache import MemoryCache
+from ckanext.tiledmap.routes import _helpers
+from ckanext.tiledmap.routes._helpers import (
+    MapViewSettings,
+    canonicalise_filters,
+    canonicalise_q,
+    compile_view,
+    encode_aggregate,
+    estimate_tile_count,
+    extract_q_and_filters,
+    extract_version,
+    get_base_map_info,
+    get_cached_map_config,
+    get_cell_range,
+    get_deferred_style_schedule,
+    get_geotile_precision,
+    get_initial_map_info,
+    get_map_config,
+    get_map_config_key,
+    get_style_schedule,
+    get_tile_options,
+)
 
 
 def mock_params(q=None, filters=None):
@@ -56,3 +81,577 @@ class TestExtractQAndFilters:
         q, filters = extract_q_and_filters()
         assert q == 'beans and cake'
         assert filters == {'colour': ['green', 'red', 'orange'], 'food': ['banana']}
+
+
+class TestGetTileOptions:
+    @patch.dict(config, {'versioned_tilemap.tile_size': 256})
+    def test_default(self):
+        options = get_tile_options()
+        assert options['tile_size'] == 256
+        assert options['zoom_offset'] == 0
+
+    @patch.dict(
+        config,
+        {
+            'versioned_tilemap.tile_size': '512',
+            'versioned_tilemap.detect_retina': 'true',
+        },
+    )
+    def test_large_tiles(self):
+        options = get_tile_options()
+        assert options['tile_size'] == 512
+        assert options['zoom_offset'] == -1
+        assert options['detect_retina']
+
+    @patch.dict(config, {'versioned_tilemap.tile_size': 300})
+    def test_invalid_size(self):
+        with pytest.raises(ValueError):
+            get_tile_options()
+
+
+class TestGetStyleSchedule:
+    zoom_bounds = {'min': 3, 'max': 18}
+    world = ((83, -170), (-83, 170))
+
+    def test_estimate_tile_count(self):
+        assert estimate_tile_count(self.world, 0) == 1
+        assert estimate_tile_count(self.world, 3) == 64
+        # a single point is always on one tile
+        assert estimate_tile_count(((10, 10), (10, 10)), 18) == 1
+
+    @patch.dict(config, {'versioned_tilemap.style.plot.max_tile_count': 1000})
+    def test_small_query(self):
+        schedule = get_style_schedule(
+            ['plot', 'gridded'], 100, self.world, self.zoom_bounds
+        )
+        assert schedule == {'plot': 3, 'gridded': 3}
+
+    @patch.dict(config, {'versioned_tilemap.style.plot.max_tile_count': 1000})
+    def test_large_query(self):
+        schedule = get_style_schedule(
+            ['plot', 'gridded'], 1000000, self.world, self.zoom_bounds
+        )
+        # the bounds cover 961 tiles at zoom 5, which is just over 1000 records per
+        # tile, and 3844 tiles at zoom 6
+        assert schedule == {'plot': 6, 'gridded': 3}
+
+    @patch.dict(config, {'versioned_tilemap.style.plot.max_tile_count': 1000})
+    def test_never_available(self):
+        schedule = get_style_schedule(
+            ['plot'], 1000000, ((10, 10), (10, 10)), self.zoom_bounds
+        )
+        assert schedule == {'plot': None}
+
+    @patch.dict(config, {'versioned_tilemap.style.plot.max_tile_count': ''})
+    def test_no_limit(self):
+        schedule = get_style_schedule(['plot'], 1000000, self.world, self.zoom_bounds)
+        assert schedule == {'plot': 3}
+
+    @patch.dict(config, {'versioned_tilemap.style.plot.max_tile_count': 1000})
+    def test_deferred(self):
+        # without the extent, the plot map could be too expensive at any zoom level
+        schedule = get_deferred_style_schedule(['plot', 'gridded', 'heatmap'], 3)
+        assert schedule == {'plot': None, 'gridded': 3, 'heatmap': 3}
+
+    @patch.dict(
+        config,
+        {
+            'versioned_tilemap.style.plot.max_tile_count': 1000,
+            'versioned_tilemap.style.gridded.max_tile_count': 1000,
+        },
+    )
+    def test_deferred_all_limited(self):
+        schedule = get_deferred_style_schedule(['plot', 'gridded'], 3)
+        assert schedule == {'plot': None, 'gridded': 3}
+
+
+class TestGetInitialMapInfo:
+    view = {'id': 'view', 'enable_plot_map': True}
+    resource = {'id': 'resource'}
+
+    @mock_params(q='beans', filters='colour:green')
+    def test_includes_query(self):
+        with patch.object(
+            MapViewSettings, 'create_map_info', return_value={'geospatial': True}
+        ):
+            map_info = get_initial_map_info(self.view, self.resource)
+        assert map_info == {
+            'geospatial': True,
+            'q': 'beans',
+            'filters': {'colour': ['green']},
+        }
+
+    @mock_params()
+    def test_not_enabled(self):
+        map_info = get_initial_map_info({'id': 'view'}, self.resource)
+        assert map_info == {'geospatial': False}
+
+    @mock_params()
+    def test_error(self):
+        with patch.object(
+            MapViewSettings, 'create_map_info', side_effect=Exception('oh no')
+        ):
+            assert get_initial_map_info(self.view, self.resource) is None
+
+
+class TestCanonicalisation:
+    def test_q(self):
+        assert canonicalise_q(None) is None
+        assert canonicalise_q('   ') is None
+        assert canonicalise_q('  beans   and\tcake ') == 'beans and cake'
+
+    def test_filters(self):
+        assert canonicalise_filters(None) is None
+        assert canonicalise_filters({}) is None
+        filters = canonicalise_filters(
+            {'food': ['banana'], 'colour': ['red', 'green', 'red']}
+        )
+        assert list(filters) == ['colour', 'food']
+        assert filters == {'colour': ['green', 'red'], 'food': ['banana']}
+
+    def test_geo_filter(self):
+        filters = canonicalise_filters(
+            {'__geo__': ['{"type": "Point",  "coordinates": [1, 2]}']}
+        )
+        assert filters == {'__geo__': ['{"coordinates":[1,2],"type":"Point"}']}
+
+    def test_query_body_is_deterministic(self):
+        view = {'id': 'view'}
+        resource = {'id': 'resource'}
+        bodies = set()
+        results = [{'a': 1, 'b': {'c': 2, 'd': 3}}, {'b': {'d': 3, 'c': 2}, 'a': 1}]
+        for result in results:
+            mock_toolkit = MagicMock(
+                get_action=MagicMock(return_value=MagicMock(return_value=result))
+            )
+            with patch('ckanext.tiledmap.routes._helpers.toolkit', mock_toolkit):
+                bodies.add(MapViewSettings(0, view, resource).get_query_body())
+        assert len(bodies) == 1
+
+
+def test_is_public(actions):
+    resource = {'id': 'resource', 'package_id': 'package'}
+    for private, expected in [(False, True), (True, False)]:
+        actions['package_show'] = MagicMock(return_value={'private': private})
+        assert MapViewSettings(0, {'id': 'view'}, resource).is_public == expected
+    actions['package_show'].assert_called_with({}, {'id': 'package'})
+
+
+class TestVersionPinning:
+    view = {'id': 'view'}
+    resource = {'id': 'resource'}
+
+    def test_extract_version(self):
+        cases = [({}, None), ({'version': ''}, None), ({'version': '42'}, 42)]
+        for params, expected in cases:
+            mock_toolkit = MagicMock(request=MagicMock(params=params))
+            with patch('ckanext.tiledmap.routes._helpers.toolkit', mock_toolkit):
+                assert extract_version() == expected
+
+    def test_extract_invalid_version(self):
+        mock_toolkit = MagicMock(request=MagicMock(params={'version': 'beans'}))
+        with patch('ckanext.tiledmap.routes._helpers.toolkit', mock_toolkit):
+            with pytest.raises(ValueError):
+                extract_version()
+
+    def test_rounded_version_is_cached(self, actions):
+        for _ in range(2):
+            assert MapViewSettings(0, self.view, self.resource).version == 1000
+            assert (
+                MapViewSettings(0, self.view, self.resource, version=5).version == 1000
+            )
+        # once for each requested version
+        assert actions['datastore_get_rounded_version'].call_count == 2
+
+        # resources with no data are cached too
+        actions['datastore_get_rounded_version'].return_value = None
+        other = {'id': 'other'}
+        assert MapViewSettings(0, self.view, other).version is None
+        assert MapViewSettings(0, self.view, other).version is None
+        assert actions['datastore_get_rounded_version'].call_count == 3
+
+    def test_query_is_pinned(self, actions):
+        actions['datastore_search'] = MagicMock(return_value={})
+        cache = MemoryCache(10000)
+        with patch('ckanext.tiledmap.routes._helpers.get_cache', return_value=cache):
+            settings = MapViewSettings(0, self.view, self.resource, version=1200)
+            settings.get_query_body()
+            assert settings.version == 1000
+
+        # the version should only be resolved once
+        actions['datastore_get_rounded_version'].assert_called_once_with(
+            {}, {'resource_id': 'resource', 'version': 1200}
+        )
+        search_params = actions['datastore_search'].call_args[0][1]
+        assert search_params['version'] == 1000
+
+
+class TestExtentInfo:
+    resource = {'id': 'resource'}
+
+    def test_map_styles(self):
+        view = {'id': 'view', 'enable_plot_map': True, 'enable_heat_map': True}
+        settings = MapViewSettings(0, view, self.resource)
+        assert settings.map_styles == ['heatmap', 'plot']
+
+    @patch.dict(
+        config,
+        {
+            'versioned_tilemap.style.plot.max_tile_count': 1000,
+            'versioned_tilemap.zoom_bounds.min': 3,
+            'versioned_tilemap.zoom_bounds.max': 18,
+            'versioned_tilemap.tile_size': 256,
+        },
+    )
+    def test_create_extent_info(self):
+        view = {'id': 'view', 'enable_plot_map': True, 'enable_grid_map': True}
+        settings = MapViewSettings(4, view, self.resource)
+        bounds = [[-90, -180], [90, 180]]
+        with patch.object(
+            MapViewSettings, 'get_extent_info', return_value=(100, 500000, bounds)
+        ):
+            extent_info = settings.create_extent_info()
+
+        assert extent_info == {
+            'fetch_id': 4,
+            'total_count': 100,
+            'geom_count': 500000,
+            'bounds': bounds,
+            # 500000 records over 1024 tiles at zoom 5 is 488 per tile
+            'style_schedule': {'gridded': 3, 'plot': 5},
+        }
+
+    def get_settings(self, cache, q=None):
+        view = {'id': 'view', 'enable_plot_map': True}
+        with patch('ckanext.tiledmap.routes._helpers.get_cache', return_value=cache):
+            settings = MapViewSettings(0, view, self.resource, q=q)
+            return settings.get_extent_info(), settings.get_query_body()
+
+    def test_extent_and_query_body_are_cached(self, actions):
+        cache = MemoryCache(10000)
+        extent = {'total_count': 10, 'geom_count': 5, 'bounds': [[1, 2], [3, 4]]}
+        actions['datastore_query_extent'] = MagicMock(return_value=extent)
+        actions['datastore_search'] = MagicMock(return_value={'search': {}})
+        first = self.get_settings(cache)
+        second = self.get_settings(cache)
+
+        assert first == second == ((10, 5, [[1, 2], [3, 4]]), first[1])
+        assert isinstance(second[1], bytes)
+        actions['datastore_query_extent'].assert_called_once()
+        actions['datastore_search'].assert_called_once()
+
+        # a different query isn't cached
+        self.get_settings(cache, q='beans')
+        assert actions['datastore_query_extent'].call_count == 2
+        assert actions['datastore_search'].call_count == 2
+
+
+class TestGetRecords:
+    view = {'id': 'view', 'utf_grid_title': 'name', 'utf_grid_fields': ['country']}
+    resource = {'id': 'resource'}
+    geo_filter = '{"type": "Point", "coordinates": [1, 2]}'
+
+    def get_records(self, actions, search_result, **kwargs):
+        actions['datastore_search'] = MagicMock(return_value=search_result)
+        settings = MapViewSettings(
+            0, self.view, self.resource, filters={'country': ['Chile']}
+        )
+        page = settings.get_records(self.geo_filter, **kwargs)
+        return page, actions['datastore_search']
+
+    @patch.dict(config, {'versioned_tilemap.records.cache_size': 0})
+    def test_search(self, actions):
+        result = {'total': 3, 'records': [{'_id': 1}, {'_id': 2}], 'after': [2]}
+        page, search = self.get_records(actions, result, after=[0], limit=2)
+
+        assert page == {'total': 3, 'records': result['records'], 'after': [2]}
+        search.assert_called_once_with(
+            {},
+            {
+                'resource_id': 'resource',
+                'q': None,
+                'filters': {
+                    '__geo__': ['{"coordinates":[1,2],"type":"Point"}'],
+                    'country': ['Chile'],
+                },
+                'version': 1000,
+                'fields': ['_id', 'country', 'name'],
+                'limit': 2,
+                'after': [0],
+            },
+        )
+
+    def test_search_in_drawn_area(self, actions):
+        area = '{"type": "Polygon", "coordinates": [[[0, 0], [1, 0], [1, 1], [0, 0]]]}'
+        queries = [{'term': {'location': 1}}, {'term': {'area': 1}}]
+        hits = [
+            {'_source': {'data': {'_id': 1}}, 'sort': [1]},
+            {'_source': {'data': {'_id': 2}}, 'sort': [2]},
+        ]
+        actions['datastore_search'] = MagicMock(
+            side_effect=[{'search': {'query': query}} for query in queries]
+        )
+        actions['datastore_search_raw'] = MagicMock(
+            return_value={'hits': {'total': 3, 'hits': hits}}
+        )
+        with patch(
+            'ckanext.tiledmap.routes._helpers.get_cache',
+            return_value=MemoryCache(10000),
+        ):
+            settings = MapViewSettings(
+                0,
+                self.view,
+                self.resource,
+                filters={'country': ['Chile'], '__geo__': [area]},
+            )
+            page = settings.get_records(self.geo_filter, after=[0], limit=2)
+
+        assert page == {'total': 3, 'records': [{'_id': 1}, {'_id': 2}], 'after': [2]}
+        # the location and the drawn area are searched for separately
+        location_search, area_search = actions['datastore_search'].call_args_list
+        assert location_search[0][1]['filters'] == {
+            '__geo__': ['{"coordinates":[1,2],"type":"Point"}'],
+            'country': ['Chile'],
+        }
+        assert area_search[0][1]['filters'] == {
+            '__geo__': ['{"coordinates":[[[0,0],[1,0],[1,1],[0,0]]],"type":"Polygon"}']
+        }
+        search = actions['datastore_search_raw'].call_args[0][1]['search']
+        assert search['query'] == {'bool': {'must': queries}}
+        assert search['search_after'] == [0]
+        assert search['size'] == 2
+
+    @patch.dict(config, {'versioned_tilemap.records.cache_size': 0})
+    def test_last_page(self, actions):
+        result = {'total': 1, 'records': [{'_id': 1}], 'after': [1]}
+        page, _ = self.get_records(actions, result, limit=2)
+        assert page['after'] is None
+
+    @patch.dict(config, {'versioned_tilemap.records.cache_size': 10})
+    def test_pages_are_cached(self, actions):
+        result = {'total': 1, 'records': [{'_id': 1}], 'after': [1]}
+        first, search = self.get_records(actions, result, limit=20)
+        second, repeat_search = self.get_records(actions, result, limit=20)
+
+        assert first == second
+        search.assert_called_once()
+        repeat_search.assert_not_called()
+
+
+class TestAggregate:
+    view = {'id': 'view', 'enable_grid_map': True}
+    resource = {'id': 'resource'}
+    # the western hemisphere at zoom 1, which is 2 by 4 cells of 128 pixels
+    bounds = (85, -180, -85, 0)
+
+    def test_get_cell_range(self):
+        assert get_cell_range(self.bounds, 1, 128) == (4, (0, 0, 2, 4))
+        assert get_cell_range((10, 10, 5, 20), 1, 128) == (4, (2, 1, 3, 2))
+        # bounds outside the world are clamped
+        assert get_cell_range((90, -200, -90, 200), 0, 256) == (1, (0, 0, 1, 1))
+
+    def test_get_geotile_precision(self):
+        assert get_geotile_precision(3, 8) == 8
+        assert get_geotile_precision(3, 256) == 3
+        assert get_geotile_precision(0, 1) == 8
+        for grid_resolution in (0, 10, 512):
+            with pytest.raises(ValueError):
+                get_geotile_precision(3, grid_resolution)
+
+    def test_encode_aggregate(self):
+        counts = {(2, 1): 5, (1, 1): 3, (3, 2): 1, (9, 9): 100}
+        aggregate = encode_aggregate(counts, 3, 8, (1, 1, 4, 3))
+        assert aggregate == {
+            'zoom': 3,
+            'grid_resolution': 8,
+            'origin': [1, 1],
+            'size': [3, 2],
+            # cells 0, 1 and 5
+            'cells': [0, 1, 4],
+            'counts': [3, 5, 1],
+            'max': 5,
+        }
+
+    def test_encode_empty_aggregate(self):
+        aggregate = encode_aggregate({}, 3, 8, (1, 1, 1, 1))
+        assert aggregate['cells'] == []
+        assert aggregate['max'] == 0
+
+    def get_aggregate(
+        self, actions, buckets, cache, bounds=None, zoom=1, grid_resolution=128
+    ):
+        query = {'indexes': ['nhm-resource'], 'search': {'query': {'term': {'a': 1}}}}
+        actions['datastore_search'] = MagicMock(return_value=query)
+        actions['datastore_search_raw'] = MagicMock(
+            return_value={'aggregations': {'cells': {'buckets': buckets}}}
+        )
+        with patch('ckanext.tiledmap.routes._helpers.get_cache', return_value=cache):
+            settings = MapViewSettings(0, self.view, self.resource)
+            aggregate = settings.get_aggregate(
+                bounds or self.bounds, zoom, grid_resolution
+            )
+        return aggregate, actions['datastore_search_raw']
+
+    def test_get_aggregate(self, actions):
+        # 128 pixel cells at zoom 1 are the geotiles at precision 2
+        buckets = [{'key': '2/0/1', 'doc_count': 2}, {'key': '2/1/3', 'doc_count': 7}]
+        aggregate, search_raw = self.get_aggregate(actions, buckets, MemoryCache(10000))
+
+        # cells 2 and 7 of the 2 cell wide range
+        assert aggregate['cells'] == [2, 5]
+        assert aggregate['counts'] == [2, 7]
+        (_, data_dict), _ = search_raw.call_args
+        assert data_dict['resource_id'] == 'resource'
+        assert not data_dict['include_version']
+        search = data_dict['search']
+        assert search['size'] == 0
+        assert search['query']['bool']['must'] == [{'term': {'a': 1}}]
+        assert search['aggs']['cells']['geotile_grid'] == {
+            'field': 'meta.geo',
+            'precision': 2,
+            'size': 8,
+        }
+
+    def test_aggregates_are_cached(self, actions):
+        cache = MemoryCache(10000)
+        buckets = [{'key': '2/0/1', 'doc_count': 2}]
+        first, search_raw = self.get_aggregate(actions, buckets, cache)
+        second, repeat_search_raw = self.get_aggregate(actions, buckets, cache)
+
+        assert first == second
+        search_raw.assert_called_once()
+        repeat_search_raw.assert_not_called()
+
+    @patch.dict(config, {'versioned_tilemap.aggregate.max_cells': 4})
+    def test_too_many_cells_are_coarsened(self, actions):
+        aggregate, _ = self.get_aggregate(actions, [], MemoryCache(10000))
+        # the 2 by 4 cells are too many so they're counted in whole tiles
+        assert aggregate['grid_resolution'] == 256
+        assert aggregate['size'] == [1, 2]
+
+    @patch.dict(config, {'versioned_tilemap.aggregate.max_cells': 1})
+    def test_too_many_cells(self, actions):
+        with pytest.raises(ValueError):
+            self.get_aggregate(actions, [], MemoryCache(10000))
+
+    def test_default_config_serves_a_viewport(self, actions):
+        # a 1280 by 768 pixel viewport at zoom 5, rounded out to the 6 by 4 tiles
+        # covering it like the map does
+        world = 256 * 2**5
+
+        def unproject(x, y):
+            lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / world))))
+            return lat, x / world * 360 - 180
+
+        north, west = unproject(768, 1792)
+        south, east = unproject(2304, 2816)
+        grid_resolution = config['versioned_tilemap.style.gridded.grid_resolution']
+        aggregate, _ = self.get_aggregate(
+            actions,
+            [],
+            MemoryCache(10000),
+            (north, west, south, east),
+            5,
+            grid_resolution,
+        )
+        width, height = aggregate['size']
+        assert width * height <= config['versioned_tilemap.aggregate.max_cells']
+
+
+class TestMapConfig:
+    def get_key(self, map_config, locale='en'):
+        mock_toolkit = MagicMock()
+        mock_toolkit.h.lang.return_value = locale
+        with patch('ckanext.tiledmap.routes._helpers.toolkit', mock_toolkit):
+            return get_map_config_key(map_config)
+
+    def test_key(self):
+        key = self.get_key({'zoom_bounds': {'min': 3, 'max': 18}})
+        assert key == self.get_key({'zoom_bounds': {'max': 18, 'min': 3}})
+        assert key != self.get_key({'zoom_bounds': {'min': 4, 'max': 18}})
+        assert key != self.get_key({'zoom_bounds': {'min': 3, 'max': 18}}, 'fr')
+
+    @patch.dict(config, {'versioned_tilemap.tile_size': 256})
+    def test_config_is_static(self):
+        with patch('ckanext.tiledmap.routes._helpers.toolkit', MagicMock()):
+            map_config = get_map_config()
+        assert 'tile_servers' not in map_config
+        assert 'query_body' not in map_config
+        assert set(map_config['map_styles']) == {'heatmap', 'gridded', 'plot'}
+
+    def test_config_is_cached(self):
+        mock_toolkit = MagicMock()
+        with patch('ckanext.tiledmap.routes._helpers.toolkit', mock_toolkit), patch(
+            'ckanext.tiledmap.routes._helpers.get_map_config',
+            side_effect=lambda: {'zoom': config['versioned_tilemap.zoom_bounds.min']},
+        ) as get_map_config, patch.dict(_helpers._map_configs, clear=True):
+            mock_toolkit.h.lang.return_value = 'en'
+            first = get_cached_map_config()
+            assert get_cached_map_config() == first
+            assert get_map_config.call_count == 1
+
+            # each locale has its own config
+            mock_toolkit.h.lang.return_value = 'fr'
+            assert get_cached_map_config()[1] != first[1]
+            assert get_map_config.call_count == 2
+
+            # the config is created again when the plugin's config changes
+            mock_toolkit.h.lang.return_value = 'en'
+            with patch.dict(config, {'versioned_tilemap.zoom_bounds.min': 7}):
+                map_config, key = get_cached_map_config()
+            assert map_config == {'zoom': 7}
+            assert key != first[1]
+            assert get_map_config.call_count == 3
+
+    def test_base_map_info_references_config(self):
+        mock_toolkit = MagicMock()
+        mock_toolkit.h.lang.return_value = 'en'
+        mock_toolkit.url_for.return_value = '/map-config/key'
+        with patch('ckanext.tiledmap.routes._helpers.toolkit', mock_toolkit), patch(
+            'ckanext.tiledmap.routes._helpers.get_map_config', return_value={}
+        ), patch(
+            'ckanext.tiledmap.routes._helpers.get_available_tile_servers',
+            return_value=['http://tiles'],
+        ), patch.dict(_helpers._map_configs, clear=True):
+            map_info = get_base_map_info()
+        assert map_info['config_url'] == '/map-config/key'
+        assert map_info['tile_servers'] == ['http://tiles']
+        assert 'control_options' not in map_info
+
+
+class TestCompileView:
+    resource = {'id': 'resource'}
+
+    def view(self, **settings):
+        return {
+            'id': 'compiled-view',
+            'utf_grid_title': 'name',
+            'utf_grid_fields': ['country'],
+            'enable_plot_map': True,
+            **settings,
+        }
+
+    @patch.dict(config, {'versioned_tilemap.style.plot.point_radius': 4})
+    def test_compile(self):
+        compiled = compile_view(self.view(plot_point_colour='#000000'), self.resource)
+        assert compiled.fields == ('country', 'name')
+        assert compiled.map_styles == ('plot',)
+        assert compiled.style_params['plot']['point_radius'] == 4
+        assert compiled.style_params['plot']['point_colour'] == '#000000'
+        assert 'heatmap' not in compiled.style_params
+        assert compiled.info_template == 'point_detail.mustache'
+
+    def test_reused_until_updated(self):
+        compiled = compile_view(self.view(), self.resource)
+        assert compile_view(self.view(), self.resource) is compiled
+        updated = compile_view(self.view(repeat_map=True), self.resource)
+        assert updated is not compiled
+        assert updated.repeat_map
+        assert compile_view(self.view(repeat_map=True), self.resource) is updated
+
+    def test_immutable(self):
+        compiled = compile_view(self.view(), self.resource)
+        with pytest.raises(AttributeError):
+            compiled.title = 'beans'
+        with pytest.raises(TypeError):
+            compiled.style_params['plot']['point_radius'] = 10
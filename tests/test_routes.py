@@ -0,0 +1,80 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+from flask import Flask
+
+from ckanext.tiledmap.routes import map as map_routes
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    with app.test_request_context(), patch(
+        'ckanext.tiledmap.lib.admission.is_enabled', return_value=False
+    ):
+        yield app
+
+
+def patch_params(params):
+    return patch(
+        'ckanext.tiledmap.routes.map.toolkit',
+        MagicMock(request=MagicMock(params=params)),
+    )
+
+
+def patch_tile_request(is_public=True):
+    view_settings = MagicMock(is_public=is_public, fields=['name'])
+    return patch(
+        'ckanext.tiledmap.routes.map.get_tile_request',
+        return_value=({'search': {}}, 256, 'plot', view_settings),
+    )
+
+
+class TestTileCaching:
+    cases = [
+        (True, {'version': '1000'}, 'public, max-age=31536000, immutable'),
+        (True, {}, 'public, max-age=60'),
+        (False, {'version': '1000'}, 'private, max-age=31536000, immutable'),
+        (False, {}, 'private, max-age=60'),
+    ]
+
+    def test_tile(self, app):
+        for is_public, params, expected in self.cases:
+            with patch_tile_request(is_public), patch_params(params), patch(
+                'ckanext.tiledmap.lib.renderer.render_tile', return_value=b'png'
+            ):
+                response = map_routes.tile(1, 0, 0)
+            assert response.headers['Cache-Control'] == expected
+
+    def test_grid(self, app):
+        for is_public, params, expected in self.cases:
+            with patch_tile_request(is_public), patch_params(params), patch(
+                'ckanext.tiledmap.lib.renderer.render_grid_tile', return_value={}
+            ):
+                response = map_routes.grid(1, 0, 0)
+            assert response.headers['Cache-Control'] == expected
+
+
+def test_invalid_style_params(app):
+    for params in [{'point_radius': '5000'}, {'border_width': '-1'}]:
+        with patch_tile_request(), patch_params(params) as mock_toolkit, patch(
+            'ckanext.tiledmap.lib.renderer.render_tile'
+        ) as render_tile:
+            mock_toolkit.abort.side_effect = Exception('aborted')
+            with pytest.raises(Exception, match='aborted'):
+                map_routes.tile(1, 0, 0)
+        mock_toolkit.abort.assert_called_once()
+        assert mock_toolkit.abort.call_args[0][0] == 400
+        render_tile.assert_not_called()
+
+
+def test_query_is_not_shared(app):
+    query_store = MagicMock(
+        is_valid_key=MagicMock(return_value=True),
+        get=MagicMock(return_value='query body'),
+    )
+    with patch_params({}), patch(
+        'ckanext.tiledmap.routes.map.get_query_store', return_value=query_store
+    ):
+        response = map_routes.query('key')
+    assert response.headers['Cache-Control'] == 'private, max-age=31536000, immutable'
@@ -1,6 +1,14 @@
+import time
 from unittest.mock import MagicMock, patch
 
-from ckanext.tiledmap.lib.utils import get_resource_datastore_fields
+from ckanext.tiledmap.lib.cache import MemoryCache
+from ckanext.tiledmap.lib.utils import (
+    _check_tileserver_status,
+    get_available_tile_servers,
+    get_resource_datastore_fields,
+    get_tile_servers,
+    get_tileserver_status,
+)
 
 
 def test_get_resource_datastore_fields():
@@ -11,3 +19,111 @@ def test_get_resource_datastore_fields():
     )
     with patch('ckanext.tiledmap.lib.utils.toolkit', mock_toolkit):
         assert get_resource_datastore_fields(MagicMock()) == expected_fields
+
+
+def test_get_tile_servers():
+    mock_toolkit = MagicMock(
+        config={
+            'versioned_tilemap.tile_server': 'http://one|3 http://{s}.two',
+            'versioned_tilemap.tile_server.subdomains': 'a b',
+        }
+    )
+    with patch('ckanext.tiledmap.lib.utils.toolkit', mock_toolkit):
+        assert get_tile_servers() == [
+            ('http://one', 3),
+            ('http://a.two', 1),
+            ('http://b.two', 1),
+        ]
+
+
+def test_get_available_tile_servers():
+    mock_toolkit = MagicMock(
+        config={'versioned_tilemap.tile_server': 'http://one|2 http://two http://three'}
+    )
+    statuses = {
+        'http://one': 'available',
+        'http://two': 'unavailable',
+        'http://three': 'available',
+    }
+    with patch('ckanext.tiledmap.lib.utils.toolkit', mock_toolkit), patch(
+        'ckanext.tiledmap.lib.utils._check_tileserver_status', statuses.get
+    ):
+        assert get_available_tile_servers() == [
+            'http://one',
+            'http://one',
+            'http://three',
+        ]
+
+
+def test_get_available_tile_servers_none_available():
+    mock_toolkit = MagicMock(
+        config={'versioned_tilemap.tile_server': 'http://one http://two'}
+    )
+    with patch('ckanext.tiledmap.lib.utils.toolkit', mock_toolkit), patch(
+        'ckanext.tiledmap.lib.utils._check_tileserver_status',
+        MagicMock(return_value='unavailable'),
+    ):
+        assert get_available_tile_servers() == ['http://one', 'http://two']
+
+
+def test_get_available_tile_servers_fallback():
+    mock_toolkit = MagicMock(config={'versioned_tilemap.tile_server': 'http://one'})
+    with patch('ckanext.tiledmap.lib.utils.toolkit', mock_toolkit), patch(
+        'ckanext.tiledmap.lib.utils._check_tileserver_status',
+        MagicMock(return_value='unavailable'),
+    ):
+        assert get_available_tile_servers('/map-tiles') == ['/map-tiles']
+
+    with patch('ckanext.tiledmap.lib.utils.toolkit', MagicMock(config={})):
+        assert get_available_tile_servers('/map-tiles') == ['/map-tiles']
+
+
+class ImmediateThread:
+    """
+    Stand-in for threading.Thread which runs the target when it's started.
+    """
+
+    def __init__(self, target, daemon=False):
+        self.target = target
+
+    def start(self):
+        self.target()
+
+
+def test_tileserver_status_is_refreshed_in_background():
+    cache = MemoryCache(10000)
+    request_status = MagicMock(return_value='available')
+    with patch('ckanext.tiledmap.lib.utils.get_cache', return_value=cache), patch(
+        'ckanext.tiledmap.lib.utils._request_tileserver_status', request_status
+    ), patch('ckanext.tiledmap.lib.utils.threading.Thread', ImmediateThread):
+        # the first check doesn't wait for the status
+        assert _check_tileserver_status('http://one') == 'unknown'
+        assert _check_tileserver_status('http://one') == 'available'
+        request_status.assert_called_once_with('http://one')
+
+        # once the status is stale it's still used while it's refreshed
+        request_status.return_value = 'unavailable'
+        with patch(
+            'ckanext.tiledmap.lib.utils.time.time', return_value=time.time() + 61
+        ):
+            assert _check_tileserver_status('http://one') == 'available'
+            assert _check_tileserver_status('http://one') == 'unavailable'
+        assert request_status.call_count == 2
+
+
+def test_get_tileserver_status():
+    mock_toolkit = MagicMock(
+        config={'versioned_tilemap.tile_server': 'http://one http://two'}
+    )
+    with patch('ckanext.tiledmap.lib.utils.toolkit', mock_toolkit):
+        for statuses, expected in [
+            (['unknown', 'unknown'], 'unknown'),
+            (['unknown', 'available'], 'available'),
+            (['unavailable', 'available'], 'partial'),
+            (['unavailable', 'unavailable'], 'unavailable'),
+        ]:
+            with patch(
+                'ckanext.tiledmap.lib.utils._check_tileserver_status',
+                side_effect=statuses,
+            ):
+                assert get_tileserver_status() == expected